@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+# 基于 redis.asyncio 的异步布隆过滤器, 用于 asyncio 的 item 处理程序和异步 pipeline 中
+# asyncio redis based bloom filter
+
+import asyncio
+
+import redis.asyncio
+from redis.commands.core import AsyncScript
+
+from bloom_filter_metrics import get_filter_metrics, record_metrics
+from redis_bloom_filter import BloomFilterRedis, get_pool_kwargs, singleton_by_config
+
+
+@singleton_by_config
+class AsyncRedisConn(object):
+    """
+    redis.asyncio 客户端连接, 相同连接参数的 AsyncRedisConn 在同一个事件循环中共用一个连接池
+    - redis.asyncio 的连接只能在创建它的事件循环中使用, 所以连接池按事件循环分开保存,
+      多次 asyncio.run 或 多个线程各自的事件循环不会拿到其他事件循环创建的连接
+    - 为新的事件循环创建连接池时, 丢弃已关闭的事件循环的连接池
+    """
+
+    def __init__(self, redis_config):
+
+        self.pool_kwargs = get_pool_kwargs(redis_config)
+        # 事件循环: 连接池, 连接池中的连接引用着事件循环, 所以不能用 WeakKeyDictionary 自动释放
+        self._pools = {}
+
+    def get_redis_cli(self):
+        """ 获取当前事件循环的 redis 客户端连接, 只能在协程中调用 """
+        loop = asyncio.get_running_loop()
+        pool_redis = self._pools.get(loop)
+        if pool_redis is None:
+            for _loop in list(self._pools):
+                if _loop.is_closed():
+                    self._pools.pop(_loop, None)
+            pool_redis = self._pools[loop] = redis.asyncio.ConnectionPool(**self.pool_kwargs)
+        return redis.asyncio.StrictRedis(connection_pool=pool_redis)
+
+
+class BloomFilterRedisAsync(BloomFilterRedis):
+    """
+    异步的 redis 版布隆过滤器
+    - 配置信息, redis key 的布局, hash 索引值和 lua 脚本都与 BloomFilterRedis 相同, 两者可以共用同一组 filter key
+    - add, add_if_absent, exists, add_many, exists_many, add_if_absent_many, get_metrics 都是协程, 需要 await,
+      多个协程可以同时判断和添加, 共用 AsyncRedisConn 中当前事件循环的连接池, 不会阻塞事件循环
+    - 实例化时不访问 redis, 在第一次调用时从 redis_meta_key 中读取 filter key 和 已保存的数据量, 也可以提前 await open()
+    - 不支持 in 判断, 使用 await exists(data); 不支持 merge, 使用 BloomFilterRedis.merge
+    """
+
+    def __init__(self, redis_db_config, redis_key_config, bf_config):
+        """
+        :param redis_db_config: redis 数据库的配置信息
+        :param redis_key_config: redis 中保存 bloom filter 内容的 key
+        :param bf_config: bloom filter 配置信息, 与 BloomFilterRedis 相同
+        """
+        # 多个协程同时第一次调用时, 只读取一次元数据
+        self._open_lock = asyncio.Lock()
+        super().__init__(redis_db_config, redis_key_config, bf_config)
+
+    @staticmethod
+    def _get_redis_cli(redis_db_config):
+        """
+        实例化时可能不在事件循环中, 这里只返回 AsyncRedisConn, 客户端在每次使用 redis_cli 时按当前事件循环获取
+        """
+        return AsyncRedisConn(redis_db_config)
+
+    @property
+    def redis_cli(self):
+        """ 当前事件循环的 redis.asyncio 客户端, 所有的 BloomFilterRedisAsync 共用 AsyncRedisConn 的连接池 """
+        return self._redis_conn.get_redis_cli()
+
+    @redis_cli.setter
+    def redis_cli(self, redis_conn):
+        """ BloomFilterRedis.__init__ 中保存 _get_redis_cli 返回的 AsyncRedisConn """
+        self._redis_conn = redis_conn
+
+    def _register_scripts(self):
+        """
+        实例化时可能不在事件循环中, 脚本不绑定客户端, 调用时通过 client 参数传入当前事件循环的客户端
+        """
+        self._add_if_absent_script = AsyncScript(None, self.LUA_ADD_IF_ABSENT.encode('utf-8'))
+
+    def _get_init_params(self):
+        """
+        实例化时不能 await, 元数据在 open 中读取
+        """
+        self._filter_list = None
+        self.data_saved = None
+
+    async def open(self):
+        """
+        从 redis 的元数据 hash key 中读取出所有的 filter key 和 已经保存的数据量, 与 BloomFilterRedis._get_init_params 相同
+        """
+        async with self._open_lock:
+            if self._filter_list is not None:
+                return
+            meta = await self.redis_cli.hgetall(self.redis_meta_key)
+            if not meta:
+                # 旧版本的 filter key, 使用 EXISTS 从 {base}_1 开始依次检测
+                _filter_list = []
+                while await self.redis_cli.exists('{}_{}'.format(self.redis_filter_key_base, len(_filter_list) + 1)):
+                    _filter_list.append('{}_{}'.format(self.redis_filter_key_base, len(_filter_list) + 1))
+                if not _filter_list:
+                    _filter_list = ['{}_1'.format(self.redis_filter_key_base)]
+                _data_saved = await self.redis_cli.get(self.redis_count_key)
+                _data_saved = int(_data_saved.decode('utf-8')) if _data_saved else 0
+
+                self._set_init_params(_filter_list, _data_saved)
+                pipe = self.redis_cli.pipeline(transaction=False)
+                self._queue_init_meta(pipe)
+                meta = (await pipe.execute())[-1]
+            self._set_init_params(*self._parse_meta(meta))
+
+    async def _check_open(self):
+        """
+        第一次调用时读取元数据
+        """
+        if self._filter_list is None:
+            await self.open()
+
+    async def close(self):
+        """
+        关闭本实例的客户端, 连接池由 AsyncRedisConn 管理, 不会被关闭
+        """
+        await self.redis_cli.aclose()
+
+    @record_metrics('add')
+    async def add(self, data):
+        """
+        向布隆过滤器中添加数据, 所有的 setbit 和 hincrby 使用一个 pipeline 发送, 只需要一次往返
+        """
+        await self._check_open()
+        pipe = self.redis_cli.pipeline(transaction=False)
+        self._queue_add(pipe, self._get_hashes(data))
+        self.data_saved = (await pipe.execute())[-1]
+
+    @record_metrics('add_if_absent')
+    async def add_if_absent(self, data):
+        """
+        在 redis 服务端使用 lua 脚本原子的 判断数据是否存在, 如果不存在就添加
+        :return: 数据在添加之前是否已经存在
+        """
+        await self._check_open()
+        if self._add_new_filter_if_full():
+            self._sync_filter_list(await self.redis_cli.eval(*self._get_extend_filters_args()))
+
+        hashes = self._get_hashes(data)
+        while True:
+            _keys, _args = self._get_add_if_absent_params(hashes)
+            is_exists, result = await self._add_if_absent_script(keys=_keys, args=_args, client=self.redis_cli)
+            if is_exists != -1:
+                self.data_saved = result
+                return bool(is_exists)
+            self._sync_filter_list(result)
+
+    @record_metrics('add_many')
+    async def add_many(self, data_list):
+        """
+        向布隆过滤器中批量添加数据, 每个 filter 使用一条 BITFIELD SET 命令, 一批数据只需要一次往返
+        """
+        await self._check_open()
+        hashes_list = [self._get_hashes(_data) for _data in data_list]
+        if not hashes_list:
+            return
+
+        pipe = self.redis_cli.pipeline(transaction=False)
+        self._queue_add_many(pipe, hashes_list)
+        self.data_saved = (await pipe.execute())[-1]
+
+    @record_metrics('exists')
+    async def exists(self, data):
+        """
+        检测数据是否存在于布隆过滤器中, 所有 filter 的 getbit 使用一个 pipeline 发送, 只需要一次往返
+        """
+        await self._check_open()
+        hashes = self._get_hashes(data)
+        while True:
+            pipe = self.redis_cli.pipeline(transaction=False)
+            self._queue_exists(pipe, hashes)
+            results = await pipe.execute()
+            if not self._sync_filter_list(results[-1]):
+                return self._parse_exists(results[:-1])
+
+    @record_metrics('exists_many')
+    async def exists_many(self, data_list):
+        """
+        批量检测数据是否存在于布隆过滤器中, 每个 filter 使用一条 BITFIELD GET 命令, 一批数据只需要一次往返
+        :return: 与 data_list 等长的 bool 列表, True 表示数据已经存在
+        """
+        await self._check_open()
+        hashes_list = [self._get_hashes(_data) for _data in data_list]
+        if not hashes_list:
+            return []
+
+        while True:
+            pipe = self.redis_cli.pipeline(transaction=False)
+            self._queue_exists_many(pipe, hashes_list)
+            results = await pipe.execute()
+            if not self._sync_filter_list(results[-1]):
+                return self._parse_exists_many(results[:-1], len(hashes_list))
+
+    @record_metrics('add_if_absent_many')
+    async def add_if_absent_many(self, data_list):
+        """
+        批量检测数据是否存在, 并把不存在的数据添加到布隆过滤器中
+        与 BloomFilterRedis.add_if_absent_many 相同, 判断和添加分为两次往返, 不是原子操作
+        :return: 与 data_list 等长的 bool 列表, True 表示数据在添加之前已经存在
+        """
+        data_list = [self._safe_data(_data) for _data in data_list]
+        mask = await self.exists_many(data_list)
+        await self.add_many(self._get_absent_data(data_list, mask))
+        return mask
+
+    async def get_fill_ratios(self):
+        """
+        每个 filter key 中值为 1 的 bit 位的比例, 与 BloomFilterRedis.get_fill_ratios 相同
+        """
+        await self._check_open()
+        pipe = self.redis_cli.pipeline(transaction=False)
+        self._queue_fill_ratios(pipe)
+        return self._parse_fill_ratios(await pipe.execute())
+
+    async def get_metrics(self, fill_ratio=True):
+        """
+        获取过滤器的监控指标, 与 BloomFilterRedis.get_metrics 相同
+        """
+        await self._check_open()
+        return get_filter_metrics(self, await self.get_fill_ratios() if fill_ratio else None)
+
+    def merge(self, other):
+        """
+        BloomFilterRedis.merge 中的 BITOP 和分块复制都是同步调用, 不能用于 redis.asyncio 客户端
+        合并时使用两个相同配置的 BloomFilterRedis, 两者共用同一组 filter key
+        """
+        raise NotImplementedError('BloomFilterRedisAsync does not support merge, use BloomFilterRedis.merge instead')
+
+    def __contains__(self, data):
+        raise TypeError('BloomFilterRedisAsync does not support "in", use "await exists(data)" instead')
+
+
+async def main_concurrent():
+    """
+    测试多个协程同时判断并添加数据
+    100 个协程同时对 1000 个 url (其中 500 个不重复) 执行 add_if_absent, 最终只有 500 个 url 被认为是不存在的
+    注意: 测试时需要手动删除 redis 中的所有相关 key
+    """
+    import time
+    redis_db_config = dict(
+        host='127.0.0.1',
+        port=6379,
+        db=0,
+        password=None,
+    )
+    redis_key_config = dict(
+        bloom_filter_key='bf_async',
+    )
+    bf_config = dict(
+        data_size_per_key=10 ** 5,
+        memory_size=1,
+        hash_seeds_num=5,
+        error_rate_threshold=1e-5,
+        hash_strategy='double',
+    )
+    bf = BloomFilterRedisAsync(redis_db_config, redis_key_config, bf_config)
+
+    urls = ['https://www.dreamingtech.net/s?kw=python{}'.format(i % 500) for i in range(1000)]
+
+    async def _worker(_urls):
+        return [await bf.add_if_absent(_url) for _url in _urls]
+
+    start = time.time()
+    results = await asyncio.gather(*[_worker(urls[i::100]) for i in range(100)])
+    print('add_if_absent with 100 coroutines cost: {:.2f}s, absent urls: <{}>, data_size: <{}>'.format(
+        time.time() - start, sum(not _r for _result in results for _r in _result), len(bf)))
+
+    mask = await bf.exists_many(urls)
+    print('all urls exist: {}'.format(all(mask)))
+    await bf.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main_concurrent())
@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+# 布隆过滤器的监控指标: 每种操作的调用次数, 命中/未命中数量, 探测的 bit 位数量, 延迟直方图,
+# 以及 bit 位的填充率和实时估算的误判率, 可以导出到 scrapy stats 和 prometheus 的文本格式中
+# bloom filter metrics
+
+import bisect
+import contextvars
+import functools
+import inspect
+import os
+import time
+
+# 延迟直方图的桶的上界, 单位为秒, 最后一个桶为 +Inf
+LATENCY_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, float('inf'))
+
+# 每种操作是否读取 / 写入 bit 位, 用于估算探测的 bit 位数量
+# 读取时最多需要判断所有的 filter, 写入时只写入最新的 filter, add_if_absent 只写入不存在的数据
+OPERATIONS = dict(
+    add=(False, True),
+    add_many=(False, True),
+    exists=(True, False),
+    exists_many=(True, False),
+    add_if_absent=(True, True),
+    add_if_absent_many=(True, True),
+)
+
+# 当前是否在记录指标的操作中, add_if_absent_many 等操作内部调用 exists_many 和 add_many 时不重复记录
+# 使用 ContextVar, 多个线程和多个协程之间互不影响
+_recording = contextvars.ContextVar('bloom_filter_metrics_recording', default=False)
+
+
+class BloomFilterMetrics(object):
+    """
+    一个过滤器的监控指标, 只在本节点/本进程中累加
+    - calls: 调用次数
+    - items: 处理的数据量
+    - hits: 已经存在的数据量, add 和 add_many 不判断, 为 0
+    - misses: 不存在的数据量
+    - probes: 探测的 bit 位数量的估算值, 读取时按判断了所有的 filter 计算, 是上限
+    - latency: 每次调用的延迟直方图
+    - filters_added: 增加 filter 的次数, 增加得越频繁, 说明 filter 越接近饱和
+    """
+
+    def __init__(self):
+        self.ops = {}
+        self.filters_added = 0
+
+    def _get_op(self, op):
+        if op not in self.ops:
+            self.ops[op] = dict(
+                calls=0, items=0, hits=0, misses=0, probes=0,
+                latency_buckets=[0] * len(LATENCY_BUCKETS), latency_sum=0.0,
+            )
+        return self.ops[op]
+
+    def observe(self, op, seconds, items, hits, probes):
+        """
+        记录一次调用
+        :param op: 操作名称, 如 exists, add_many
+        :param seconds: 本次调用的延迟
+        :param items: 本次调用处理的数据量
+        :param hits: 本次调用中已经存在的数据量, 不判断是否存在时为 None
+        :param probes: 本次调用探测的 bit 位数量
+        """
+        _op = self._get_op(op)
+        _op['calls'] += 1
+        _op['items'] += items
+        if hits is not None:
+            _op['hits'] += hits
+            _op['misses'] += items - hits
+        _op['probes'] += probes
+        _op['latency_buckets'][bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        _op['latency_sum'] += seconds
+
+    def inc_filters_added(self):
+        self.filters_added += 1
+
+    @staticmethod
+    def get_latency_quantile(op_metrics, quantile):
+        """
+        按直方图估算延迟的分位数, 返回分位数所在的桶的上界
+        """
+        _total = op_metrics['calls']
+        if not _total:
+            return 0.0
+        _cumulative = 0
+        for _le, _count in zip(LATENCY_BUCKETS, op_metrics['latency_buckets']):
+            _cumulative += _count
+            if _cumulative >= _total * quantile:
+                return _le
+        return LATENCY_BUCKETS[-1]
+
+
+def record_metrics(op):
+    """
+    装饰器, 记录过滤器的 add, exists, add_many 等操作的指标, 同时支持普通函数和协程
+    - 过滤器的 metrics 为 None (bf_config 中没有开启 metrics) 时, 直接调用, 不做任何记录
+    - 批量操作中, 可迭代对象会先转换为列表, 以便统计数据量
+    - 被装饰的方法只能有一个参数 data / data_list, 不使用 *args, **kwargs, 以减少没有开启 metrics 时的调用开销
+    """
+    read, write = OPERATIONS[op]
+    is_many = op.endswith('_many')
+
+    def _observe(self, seconds, data, result):
+        if is_many:
+            items = len(data)
+            # 内存型返回 numpy 数组, redis 型返回列表
+            hits = (int(result.sum()) if hasattr(result, 'sum') else sum(map(bool, result))) if read else None
+        else:
+            items = 1
+            hits = int(bool(result)) if read else None
+        probes = 0
+        if read:
+            probes += items * self.hash_seeds_num * len(self._filter_list)
+        if write:
+            probes += (items - (hits or 0)) * self.hash_seeds_num
+        self.metrics.observe(op, seconds, items, hits, probes)
+
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(self, data):
+                if self.metrics is None or _recording.get():
+                    return await func(self, data)
+                if is_many:
+                    data = list(data)
+                _token = _recording.set(True)
+                try:
+                    _start = time.perf_counter()
+                    result = await func(self, data)
+                    _observe(self, time.perf_counter() - _start, data, result)
+                finally:
+                    _recording.reset(_token)
+                return result
+        else:
+            @functools.wraps(func)
+            def wrapper(self, data):
+                if self.metrics is None or _recording.get():
+                    return func(self, data)
+                if is_many:
+                    data = list(data)
+                _token = _recording.set(True)
+                try:
+                    _start = time.perf_counter()
+                    result = func(self, data)
+                    _observe(self, time.perf_counter() - _start, data, result)
+                finally:
+                    _recording.reset(_token)
+                return result
+        return wrapper
+
+    return decorator
+
+
+def cal_estimated_error_rate(fill_ratios, hash_seeds_num):
+    """
+    根据每个 filter 的 bit 位填充率估算实时的误判率
+    一个不存在的数据在某个 filter 中被误判的概率约为 fill_ratio ** k, 需要判断所有的 filter,
+    整体误判率为 1 - prod(1 - fill_ratio ** k), 填充率超过 50% 之后, 误判率会迅速增加
+    """
+    _not_false_positive = 1.0
+    for _fill_ratio in fill_ratios:
+        _not_false_positive *= 1 - _fill_ratio ** hash_seeds_num
+    return 1 - _not_false_positive
+
+
+def get_filter_metrics(bf, fill_ratios=None):
+    """
+    汇总一个过滤器的所有指标, 返回 dict
+    :param bf: BloomFilterMemory, BloomFilterRedis 或其子类
+    :param fill_ratios: 每个 filter 的 bit 位填充率, 为 None 时不计算填充率和估算的误判率
+    """
+    metrics = dict(
+        data_saved=bf.data_saved,
+        capacity=bf._capacity_list[-1],
+        saturation=bf.data_saved / bf._capacity_list[-1],
+        filter_num=len(bf._filter_list),
+        error_rate_threshold=bf.error_rate_threshold,
+    )
+    if fill_ratios is not None:
+        metrics.update(
+            fill_ratios=fill_ratios,
+            # 新的数据只添加到最新的 filter 中, 最新的 filter 的填充率反映了当前的饱和程度
+            fill_ratio=fill_ratios[-1],
+            estimated_error_rate=cal_estimated_error_rate(fill_ratios, bf.hash_seeds_num),
+        )
+    if bf.metrics is not None:
+        metrics.update(ops=bf.metrics.ops, filters_added=bf.metrics.filters_added)
+    return metrics
+
+
+def metrics_to_stats(stats, metrics, prefix='bloom_filter'):
+    """
+    把 get_filter_metrics 得到的指标写入 scrapy stats 中, 如 bloom_filter/fill_ratio, bloom_filter/exists/hits
+    延迟记录为平均值和 p99 (直方图的桶的上界), 单位为毫秒
+    """
+    for _key in ('data_saved', 'capacity', 'saturation', 'filter_num', 'fill_ratio', 'estimated_error_rate', 'filters_added'):
+        if _key in metrics:
+            stats.set_value('{}/{}'.format(prefix, _key), metrics[_key])
+    for _op, _op_metrics in metrics.get('ops', {}).items():
+        _calls = _op_metrics['calls']
+        for _key in ('calls', 'items', 'hits', 'misses', 'probes'):
+            stats.set_value('{}/{}/{}'.format(prefix, _op, _key), _op_metrics[_key])
+        if not _calls:
+            continue
+        stats.set_value('{}/{}/probes_per_call'.format(prefix, _op), round(_op_metrics['probes'] / _calls, 2))
+        stats.set_value('{}/{}/latency_avg_ms'.format(prefix, _op), round(_op_metrics['latency_sum'] / _calls * 1000, 4))
+        stats.set_value('{}/{}/latency_p99_ms'.format(prefix, _op),
+                        BloomFilterMetrics.get_latency_quantile(_op_metrics, 0.99) * 1000)
+
+
+def _format_labels(labels):
+    return '{' + ','.join('{}="{}"'.format(_k, _v) for _k, _v in labels.items()) + '}'
+
+
+def _format_le(le):
+    return '+Inf' if le == float('inf') else repr(le)
+
+
+def format_prometheus(metrics_dict, namespace='bloom_filter'):
+    """
+    把多个过滤器的指标转换为 prometheus 的文本格式
+    :param metrics_dict: {过滤器名称: get_filter_metrics 得到的指标}, 过滤器名称作为 filter 标签
+    :param namespace: 指标名称的前缀
+    """
+    lines = []
+
+    def _add_metric(name, metric_type, samples):
+        if not samples:
+            return
+        lines.append('# TYPE {}_{} {}'.format(namespace, name, metric_type))
+        for _suffix, _labels, _value in samples:
+            lines.append('{}_{}{}{} {}'.format(namespace, name, _suffix, _format_labels(_labels), _value))
+
+    for _key in ('data_saved', 'capacity', 'saturation', 'filter_num', 'error_rate_threshold', 'estimated_error_rate'):
+        _add_metric(_key, 'gauge', [
+            ('', dict(filter=_name), _metrics[_key]) for _name, _metrics in metrics_dict.items() if _key in _metrics
+        ])
+    _add_metric('fill_ratio', 'gauge', [
+        ('', dict(filter=_name, index=_i), _fill_ratio)
+        for _name, _metrics in metrics_dict.items() for _i, _fill_ratio in enumerate(_metrics.get('fill_ratios', []))
+    ])
+    _add_metric('filters_added_total', 'counter', [
+        ('', dict(filter=_name), _metrics['filters_added'])
+        for _name, _metrics in metrics_dict.items() if 'filters_added' in _metrics
+    ])
+
+    for _key in ('calls', 'items', 'hits', 'misses', 'probes'):
+        _add_metric('{}_total'.format(_key), 'counter', [
+            ('', dict(filter=_name, op=_op), _op_metrics[_key])
+            for _name, _metrics in metrics_dict.items() for _op, _op_metrics in _metrics.get('ops', {}).items()
+        ])
+
+    _samples = []
+    for _name, _metrics in metrics_dict.items():
+        for _op, _op_metrics in _metrics.get('ops', {}).items():
+            _cumulative = 0
+            for _le, _count in zip(LATENCY_BUCKETS, _op_metrics['latency_buckets']):
+                _cumulative += _count
+                _samples.append(('_bucket', dict(filter=_name, op=_op, le=_format_le(_le)), _cumulative))
+            _samples.append(('_sum', dict(filter=_name, op=_op), _op_metrics['latency_sum']))
+            _samples.append(('_count', dict(filter=_name, op=_op), _op_metrics['calls']))
+    _add_metric('latency_seconds', 'histogram', _samples)
+
+    return '\n'.join(lines) + '\n'
+
+
+def dump_prometheus(path, metrics_dict, namespace='bloom_filter'):
+    """
+    把 prometheus 格式的指标写入文件, 供 node_exporter 的 textfile collector 读取
+    先写入临时文件再替换, 以免读取到写了一半的文件
+    """
+    tmp_path = '{}.tmp'.format(path)
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(format_prometheus(metrics_dict, namespace))
+    os.replace(tmp_path, path)
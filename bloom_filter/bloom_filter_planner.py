@@ -0,0 +1,332 @@
+# -*- coding: utf-8 -*-
+# 布隆过滤器参数规划: 根据数据量 n 和误判率 p 计算 bit 位长度 m 和 hash 种子数量 k, 生成 bf_config, 并测量实际误判率和吞吐量
+# python bloom_filter_planner.py -n 140000000 -p 1e-6 -t redis
+# python bloom_filter_planner.py -n 1000000 -p 1e-4 -t memory --hash-strategy double --benchmark
+
+import argparse
+import json
+import math
+import time
+
+from memory_bloom_filter import BloomFilterMemory
+from redis_bloom_filter import BloomFilterRedis
+
+# memory_size 的单位, 1MB 对应的 bit 位长度
+BITS_PER_MB = 1024 * 1024 * 8
+# BloomFilterRedis 要求 0 < memory_size < 512 (redis 中单个 string key 最大为 512MB) 且 0 < hash_seeds_num < 10
+REDIS_MAX_MEMORY_SIZE = 511
+REDIS_MAX_HASH_SEEDS_NUM = 9
+
+
+def cal_optimal_bit_size(data_size, error_rate):
+    """
+    计算保存 data_size (n) 个数据, 误判率为 error_rate (p) 时所需的最小 bit 位长度 m
+    m = ceil((n * log(p)) / log(1 / pow(2, log(2))))
+    """
+    return math.ceil((data_size * math.log(error_rate)) / math.log(1 / pow(2, math.log(2))))
+
+
+def cal_error_rate(data_size, bit_size, hash_seeds_num):
+    """
+    计算 n 个数据保存到 m 个 bit 位中, 使用 k 个 hash 种子时的误判率 p, 与 BloomFilterMemory._cal_error_rate 相同
+    p = pow(1 - exp(-k / (m / n)), k)
+    """
+    return pow(1 - math.exp(-hash_seeds_num / (bit_size / data_size)), hash_seeds_num)
+
+
+def cal_optimal_hash_seeds_num(data_size, bit_size):
+    """
+    计算误判率最小的 hash 种子数量 k
+    k = (m / n) * log(2) 不是整数, 分别计算向下和向上取整时的误判率, 取误判率较小的一个
+    """
+    k = bit_size / data_size * math.log(2)
+    candidates = {max(1, math.floor(k)), max(1, math.ceil(k))}
+    return min(candidates, key=lambda _k: (cal_error_rate(data_size, bit_size, _k), _k))
+
+
+def cal_bit_size(data_size, error_rate, hash_seeds_num):
+    """
+    计算使用 k 个 hash 种子保存 n 个数据, 误判率不超过 p 时所需的最小 bit 位长度 m
+    m = ceil(-k * n / log(1 - pow(p, 1 / k)))
+    """
+    return math.ceil(-hash_seeds_num * data_size / math.log(1 - pow(error_rate, 1 / hash_seeds_num)))
+
+
+def cal_min_hash_seeds_num(data_size, bit_size, error_rate, max_hash_seeds_num):
+    """
+    计算误判率不超过 error_rate 的最小的 hash 种子数量 k, k 越小, 每次判断和添加的 bit 位越少
+    k 不超过 max_hash_seeds_num 时都无法满足时返回 None
+    """
+    for k in range(1, max_hash_seeds_num + 1):
+        if cal_error_rate(data_size, bit_size, k) <= error_rate:
+            return k
+    return None
+
+
+def _cal_memory_size(data_size, error_rate, target):
+    """
+    计算一个 filter 的 memory_size (MB)
+    - memory: 使用误判率最小的 k 时所需的最小 m
+    - redis: k 不能超过 REDIS_MAX_HASH_SEEDS_NUM, 使用 k 为 1 到 REDIS_MAX_HASH_SEEDS_NUM 时所需的 m 中最小的一个
+    """
+    if target == 'redis':
+        bit_size = min(cal_bit_size(data_size, error_rate, _k) for _k in range(1, REDIS_MAX_HASH_SEEDS_NUM + 1))
+    else:
+        bit_size = cal_optimal_bit_size(data_size, error_rate)
+    return bit_size, math.ceil(bit_size / BITS_PER_MB)
+
+
+def check_bf_config(bf_config, target):
+    """
+    检查生成的 bf_config 能否用于实例化过滤器, 与过滤器的 __init__ 使用相同的检查, 不分配内存, 也不访问 redis
+    """
+    if target == 'redis':
+        BloomFilterRedis.__new__(BloomFilterRedis)._init_config(bf_config)
+        return
+    _bf_config = dict(bf_config)
+    _bf_config['memory_size'] = 1
+    _bf_config['data_size_per_filter'] = 1
+    # 不分配 memory_size 大小的内存, 先检查 bf_config 中的其它参数, 再按实际的 memory_size 检查误判率
+    BloomFilterMemory(_bf_config)
+    filter_error_rate = cal_error_rate(
+        bf_config['data_size_per_filter'], bf_config['memory_size'] * BITS_PER_MB, bf_config['hash_seeds_num'])
+    if filter_error_rate > bf_config['error_rate_threshold']:
+        raise ValueError('calculated error_rate: <{:.3e}> is larger than error_rate_threshold: <{:.3e}>'.format(
+            filter_error_rate, bf_config['error_rate_threshold']))
+
+
+def plan(data_size, error_rate, target='memory', hash_strategy='seeds', scalable=False, tightening_ratio=0.9):
+    """
+    根据期望保存的数据量和误判率, 计算最优的 memory_size 和 hash_seeds_num, 返回规划结果
+    - memory_size 以 MB 为单位, 为整数, 计算得到的 m 向上取整到 MB 后, 再按实际的 m 重新计算最优的 k
+    - redis 型中 hash_seeds_num 不能超过 REDIS_MAX_HASH_SEEDS_NUM, 使用满足误判率的最小的 k
+    - redis 型中单个 key 最大为 REDIS_MAX_MEMORY_SIZE, 超出时把数据平均分到多个 filter key 中,
+      判断时需要判断所有的 filter, 整体误判率约为每个 filter 的误判率之和, 所以每个 filter 的误判率阈值为 error_rate / key_num
+    - 可扩展布隆过滤器中, 第一个 filter 的误判率阈值为 error_rate * (1 - tightening_ratio), 按此阈值计算第一个 filter 的大小
+    :param data_size: 期望保存的数据量 n
+    :param error_rate: 整体误判率阈值 p
+    :param target: memory 或 redis, 生成 BloomFilterMemory 或 BloomFilterRedis 使用的 bf_config
+    :param hash_strategy: seeds 或 double
+    :param scalable: 是否使用可扩展布隆过滤器
+    :param tightening_ratio: 可扩展布隆过滤器中 filter 误判率阈值的收紧比例
+    :return: dict, 包含 bf_config 和计算过程中的参数
+    """
+    if not (isinstance(data_size, int) and data_size > 0):
+        raise ValueError("data_size must be integer and greater than 0")
+    if not (0 < error_rate < 1):
+        raise ValueError("error_rate must be between 0 and 1")
+    if target not in ('memory', 'redis'):
+        raise ValueError("target must be memory or redis")
+
+    filter_error_rate = error_rate * (1 - tightening_ratio) if scalable else error_rate
+
+    key_num = 1
+    while True:
+        data_size_per_filter = math.ceil(data_size / key_num)
+        optimal_bit_size, memory_size = _cal_memory_size(data_size_per_filter, filter_error_rate / key_num, target)
+        # 可扩展模式下只有一个初始的 filter key, 不能拆分
+        if target == 'memory' or scalable or memory_size <= REDIS_MAX_MEMORY_SIZE:
+            break
+        key_num += 1
+
+    if target == 'redis' and memory_size > REDIS_MAX_MEMORY_SIZE:
+        raise ValueError(
+            'memory_size of the first filter: <{}MB> is larger than {}MB, '
+            'please decrease data_size or use linear mode'.format(memory_size, REDIS_MAX_MEMORY_SIZE))
+
+    filter_bit_size = memory_size * BITS_PER_MB
+    if target == 'redis':
+        hash_seeds_num = cal_min_hash_seeds_num(
+            data_size_per_filter, filter_bit_size, filter_error_rate / key_num, REDIS_MAX_HASH_SEEDS_NUM)
+        if hash_seeds_num is None:
+            raise ValueError(
+                'can not reach error_rate: <{:.3e}> with hash_seeds_num <= {} and memory_size: <{}MB>'.format(
+                    filter_error_rate / key_num, REDIS_MAX_HASH_SEEDS_NUM, memory_size))
+    else:
+        hash_seeds_num = cal_optimal_hash_seeds_num(data_size_per_filter, filter_bit_size)
+
+    bf_config = {
+        'data_size_per_key' if target == 'redis' else 'data_size_per_filter': data_size_per_filter,
+        'memory_size': memory_size,
+        'hash_seeds_num': hash_seeds_num,
+        'error_rate_threshold': error_rate / key_num,
+        'hash_strategy': hash_strategy,
+    }
+    if scalable:
+        # 可扩展模式下, bf_config 中记录的是整体的误判率阈值, 每个 filter 的阈值由过滤器按 tightening_ratio 计算
+        bf_config.update(scalable=True, tightening_ratio=tightening_ratio)
+    check_bf_config(bf_config, target)
+
+    filter_error_rate = cal_error_rate(data_size_per_filter, filter_bit_size, hash_seeds_num)
+    return dict(
+        bf_config=bf_config,
+        key_num=key_num,
+        optimal_bit_size=optimal_bit_size,
+        bit_size=filter_bit_size,
+        bits_per_item=filter_bit_size / data_size_per_filter,
+        filter_error_rate=filter_error_rate,
+        total_memory_size=memory_size * key_num,
+        total_error_rate=1 - (1 - filter_error_rate) ** key_num,
+    )
+
+
+def _get_benchmark_config(bf_config, max_data_size):
+    """
+    生成测量误判率使用的 bf_config
+    误判率只与 m / n 和 k 有关, 数据量大于 max_data_size 时, 按相同的比例缩小 memory_size 和数据量, 测量结果不变
+    """
+    bf_config = dict(bf_config)
+    data_size = bf_config.pop('data_size_per_key', None) or bf_config.pop('data_size_per_filter')
+    memory_size = bf_config['memory_size']
+    if data_size > max_data_size:
+        bench_memory_size = max(1, round(memory_size * max_data_size / data_size))
+        data_size = math.ceil(data_size * bench_memory_size / memory_size)
+        bf_config['memory_size'] = bench_memory_size
+    bf_config['data_size_per_filter'] = data_size
+    return bf_config
+
+
+def benchmark(bf_config, max_data_size=10 ** 6, check_size=10 ** 6):
+    """
+    使用合成的 url 测量实际误判率和吞吐量
+    - 向 BloomFilterMemory 中添加 data_size 个 url, 再使用 check_size 个不重复的 url 进行判断, 被判断为存在的比例即为实际误判率
+    - redis 型与内存型的 hash 索引值和 bit 位布局相同, 实际误判率也相同; redis 型的吞吐量见 redis_bloom_filter.main_benchmark_batch
+    - 误判率很小时, 需要增加 check_size 才能统计出来
+    """
+    bf_config = _get_benchmark_config(bf_config, max_data_size)
+    data_size = bf_config['data_size_per_filter']
+    bf = BloomFilterMemory(bf_config)
+
+    start = time.time()
+    bf.add_many('https://www.dreamingtech.net/s?kw=python{}'.format(i) for i in range(data_size))
+    add_cost = time.time() - start
+
+    start = time.time()
+    mask = bf.exists_many('https://www.dreamingtech.net/p/python{}'.format(i) for i in range(check_size))
+    exists_cost = time.time() - start
+
+    single_size = min(check_size, 10 ** 5)
+    start = time.time()
+    for i in range(single_size):
+        bf.exists('https://www.dreamingtech.net/p/python{}'.format(i))
+    single_cost = time.time() - start
+
+    return dict(
+        data_size=data_size,
+        check_size=check_size,
+        memory_size=bf_config['memory_size'],
+        filter_num=len(bf._filter_list),
+        theoretical_error_rate=bf.error_rate,
+        actual_error_rate=mask.sum() / check_size,
+        add_many_per_second=data_size / add_cost,
+        exists_many_per_second=check_size / exists_cost,
+        exists_per_second=single_size / single_cost,
+    )
+
+
+def main_check_plans():
+    """
+    检查常用的数据量和误判率生成的 bf_config 都能用于实例化过滤器, 且 redis 型满足 hash_seeds_num < 10, memory_size < 512
+    """
+    for data_size, error_rate in ((140000000, 1e-6), (1000000, 1e-4), (10000000, 1e-7), (10 ** 9, 1e-6)):
+        for target in ('memory', 'redis'):
+            result = plan(data_size, error_rate, target=target)
+            bf_config = result['bf_config']
+            if target == 'redis':
+                assert bf_config['hash_seeds_num'] <= REDIS_MAX_HASH_SEEDS_NUM
+                assert bf_config['memory_size'] <= REDIS_MAX_MEMORY_SIZE
+            assert result['total_error_rate'] <= error_rate * 1.0001
+            print('n: {:.1e}, p: {:.0e}, target: {:<6} -> key_num: {}, memory_size: {}MB, hash_seeds_num: {}'.format(
+                data_size, error_rate, target, result['key_num'], bf_config['memory_size'], bf_config['hash_seeds_num']))
+
+
+def get_parser():
+    """
+    由于要捕捉 cmd 传递的参数, 所以必须要使用 函数,  不能使用类
+    :return:
+    """
+    parser = argparse.ArgumentParser(description="plan bf_config for BloomFilterMemory / BloomFilterRedis")
+
+    # 1. ---------- data_size -----------
+    parser.add_argument("--data-size", "-n", type=float, required=True,
+                        help="expected data size, e.g. 1.4e8")
+
+    # 2. ---------- error_rate -----------
+    parser.add_argument("--error-rate", "-p", type=float, required=True,
+                        help="expected total error rate, e.g. 1e-6")
+
+    # 3. ---------- target -----------
+    parser.add_argument("--target", "-t", type=str, default='memory', choices=['memory', 'redis'],
+                        help="generate bf_config for BloomFilterMemory or BloomFilterRedis")
+
+    # 4. ---------- hash_strategy -----------
+    parser.add_argument("--hash-strategy", type=str, default='seeds', choices=['seeds', 'double'],
+                        help="hash strategy of bloom filter")
+
+    # 5. ---------- scalable -----------
+    parser.add_argument("--scalable", action='store_true',
+                        help="use scalable bloom filter")
+    parser.add_argument("--tightening-ratio", type=float, default=0.9,
+                        help="tightening ratio of scalable bloom filter")
+
+    # 6. ---------- benchmark -----------
+    parser.add_argument("--benchmark", "-b", action='store_true',
+                        help="measure actual error rate and throughput with synthetic urls")
+    parser.add_argument("--max-data-size", type=float, default=10 ** 6,
+                        help="scale down data size and memory size to this data size when benchmarking")
+    parser.add_argument("--check-size", type=float, default=10 ** 6,
+                        help="number of absent urls to check when benchmarking")
+
+    return parser
+
+
+def parse_params(parser: argparse.ArgumentParser):
+    """
+    解析 argparse 中传递过来的参数
+    """
+    args = parser.parse_args()
+
+    params = dict(
+        data_size=int(args.data_size),
+        error_rate=args.error_rate,
+        target=args.target,
+        hash_strategy=args.hash_strategy,
+        scalable=args.scalable,
+        tightening_ratio=args.tightening_ratio,
+        benchmark=args.benchmark,
+        max_data_size=int(args.max_data_size),
+        check_size=int(args.check_size),
+    )
+
+    return params
+
+
+def main():
+    params = parse_params(get_parser())
+
+    result = plan(
+        data_size=params['data_size'],
+        error_rate=params['error_rate'],
+        target=params['target'],
+        hash_strategy=params['hash_strategy'],
+        scalable=params['scalable'],
+        tightening_ratio=params['tightening_ratio'],
+    )
+    print('optimal bit size: <{}> bits, planned bit size: <{}> bits ({:.2f} bits per item)'.format(
+        result['optimal_bit_size'], result['bit_size'], result['bits_per_item']))
+    print('filter num: <{}>, total memory size: <{}MB>, theoretical error_rate per filter: <{:.3e}>, total: <{:.3e}>'.format(
+        result['key_num'], result['total_memory_size'], result['filter_error_rate'], result['total_error_rate']))
+    print('bf_config = {}'.format(json.dumps(result['bf_config'], indent=4)))
+
+    if params['benchmark']:
+        stats = benchmark(result['bf_config'], max_data_size=params['max_data_size'], check_size=params['check_size'])
+        print('benchmark with data_size: <{}>, memory_size: <{}MB>, check_size: <{}>, filter num: <{}>'.format(
+            stats['data_size'], stats['memory_size'], stats['check_size'], stats['filter_num']))
+        print('theoretical error_rate: {:.3e}, actual error_rate: {:.3e}'.format(
+            stats['theoretical_error_rate'], stats['actual_error_rate']))
+        print('add_many: {:.0f} items/s, exists_many: {:.0f} items/s, exists: {:.0f} items/s'.format(
+            stats['add_many_per_second'], stats['exists_many_per_second'], stats['exists_per_second']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,641 @@
+# -*- coding: utf-8 -*-
+# 支持删除的布谷鸟过滤器 (cuckoo filter)
+# cuckoo filter, supports deletion
+
+import json
+import logging
+import math
+import random
+
+import bitarray
+import mmh3
+import numpy as np
+from bitarray.util import ba2int, int2ba
+
+from data_utils import safe_data
+from redis_bloom_filter import BloomFilterRedis, RedisConn
+
+logger = logging.getLogger(__name__)
+
+
+class CuckooFilter(object):
+    """
+    布谷鸟过滤器的基类, 负责计算参数, 指纹和桶的索引值
+    - 每个数据只保存一个 fingerprint_bits 位的指纹, 指纹可能在两个桶中的一个, 每个桶有 BUCKET_SIZE 个位置
+    - 指纹的位数根据误判率阈值计算: error_rate = 2 * BUCKET_SIZE / 2 ** fingerprint_bits
+    - 所有的指纹连续保存在一个 big endian 的 bit 序列中, 第 slot 个位置的指纹为第 slot * fingerprint_bits 位开始的 fingerprint_bits 位,
+      与 redis 中 BITFIELD GET u{fingerprint_bits} #{slot} 的布局相同, 内存型和 redis 型的数据格式一致
+    - 指纹为 0 表示空位置, 计算得到的指纹为 0 时使用 1 代替
+    - 与布隆过滤器相比, 可以使用 delete 删除已经添加的数据, 误判率为 1e-5 时每个数据只使用约 21 位, 布隆过滤器最少需要约 24 位
+    """
+
+    # 每个桶中的位置数量, 与 lua 脚本中的值保持一致
+    BUCKET_SIZE = 4
+    # 计算桶的数量时使用的装载率, 超过这个装载率之后, 插入时需要踢出的次数会迅速增加
+    LOAD_FACTOR = 0.95
+    # 插入时最多踢出的次数, 超过之后就认为当前的 filter 已经满了, 增加一个新的 filter
+    MAX_KICKS = 500
+    # 计算备用桶索引值时使用的乘数, fingerprint * ALT_MULTIPLIER 小于 2 ** 53, 在 lua 中也可以精确计算
+    ALT_MULTIPLIER = 40503
+
+    def __init__(self, data_size, error_rate_threshold):
+        """
+        :param data_size: 期望向每个 filter 中保存的数据量
+        :param error_rate_threshold: 误判率的最大值
+        """
+        if not (isinstance(data_size, int) and data_size > 0):
+            raise ValueError("data_size must be integer and greater than 0")
+        if not (0 < error_rate_threshold < 1):
+            raise ValueError("error_rate_threshold must be between 0 and 1")
+
+        self.error_rate_threshold = error_rate_threshold
+        # 指纹的位数, 最多使用 mmh3.hash64 得到的 h2 的低 32 位
+        self.fingerprint_bits = max(math.ceil(math.log2(2 * self.BUCKET_SIZE / error_rate_threshold)), 1)
+        if self.fingerprint_bits > 32:
+            raise Exception('error_rate_threshold: <{}> is too small for cuckoo filter'.format(error_rate_threshold))
+        self._fingerprint_mask = (1 << self.fingerprint_bits) - 1
+        # 每个 filter 中桶的数量 和 能够保存的最大数据量
+        self.bucket_num = math.ceil(data_size / (self.BUCKET_SIZE * self.LOAD_FACTOR))
+        self.max_data_size = int(self.bucket_num * self.BUCKET_SIZE * self.LOAD_FACTOR)
+        # 每个 filter 使用的 bit 位的长度
+        self.bit_size = self.bucket_num * self.BUCKET_SIZE * self.fingerprint_bits
+        # 计算误判率
+        self.error_rate = 2 * self.BUCKET_SIZE / 2 ** self.fingerprint_bits
+
+    @staticmethod
+    def _safe_data(data):
+        """
+        把传入的 data 转换为 bytes, 见 data_utils.safe_data
+        """
+        return safe_data(data)
+
+    def _get_alt_index(self, index, fingerprint):
+        """
+        计算指纹的另一个桶的索引值, (h(fp) - i1) % m = i2, (h(fp) - i2) % m = i1, 桶的数量不需要是 2 的幂
+        """
+        return (fingerprint * self.ALT_MULTIPLIER - index) % self.bucket_num
+
+    def _get_index_and_fingerprint(self, data):
+        """
+        计算数据的两个桶的索引值和指纹, 只需要计算一次 mmh3.hash64
+        """
+        h1, h2 = mmh3.hash64(self._safe_data(data), signed=False)
+        fingerprint = (h2 & self._fingerprint_mask) or 1
+        i1 = h1 % self.bucket_num
+        return i1, self._get_alt_index(i1, fingerprint), fingerprint
+
+    def _get_index_and_fingerprint_many(self, data_list):
+        """
+        批量计算数据的两个桶的索引值和指纹, 返回三个 shape 为 (n,) 的 int64 数组
+        """
+        data_list = [self._safe_data(_data) for _data in data_list]
+        _hashes = np.fromiter(
+            (_h for _data in data_list for _h in mmh3.hash64(_data, signed=False)),
+            dtype=np.uint64,
+            count=len(data_list) * 2,
+        ).reshape(len(data_list), 2)
+        fingerprints = (_hashes[:, 1] & np.uint64(self._fingerprint_mask)).astype(np.int64)
+        fingerprints[fingerprints == 0] = 1
+        i1 = (_hashes[:, 0] % np.uint64(self.bucket_num)).astype(np.int64)
+        i2 = (fingerprints * self.ALT_MULTIPLIER - i1) % self.bucket_num
+        return i1, i2, fingerprints
+
+    def __len__(self):
+        """"
+        返回现有数据容量
+        """
+        return self.data_saved
+
+    def __contains__(self, data):
+        """
+        用于实现 in 判断
+        """
+        return self.exists(data)
+
+
+class CuckooFilterMemory(CuckooFilter):
+    """
+    基于内存的布谷鸟过滤器
+    指纹保存在 bitarray 中, 批量判断时直接在 bitarray 的 buffer 上进行 numpy 的向量化操作
+    """
+
+    # 从 8 个字节中取出一个指纹时, 每个字节左移的位数
+    _BYTE_SHIFTS = np.arange(56, -1, -8, dtype=np.uint64)
+
+    def __init__(self, bf_config):
+        """
+        - bf_config 中包含的内容, 与 BloomFilterMemory 相同
+          - data_size_per_filter: 期望向每个 filter 中保存的数据量
+          - error_rate_threshold: 误判率的最大值
+          - memory_size, hash_seeds_num: 不使用, 指纹的位数和使用的内存量根据 data_size_per_filter 和 error_rate_threshold 计算
+        :param bf_config: 过滤器的配置信息
+        """
+        super().__init__(bf_config.get("data_size_per_filter"), bf_config.get("error_rate_threshold"))
+        self._bitarray = None
+        self._filter_list = []
+        self.data_saved = 0
+        self._init_bitarray()
+
+    def _init_bitarray(self):
+        """
+        初始化 bitarray, 末尾多分配 64 位, 批量读取最后一个指纹时每次读取 8 个字节也不会越界
+        """
+        self._bitarray = bitarray.bitarray(self.bit_size + 64, endian='big')
+        self._bitarray.setall(0)
+        self._filter_list.append(self._bitarray)
+
+    def _check_and_add_new_filter(self):
+        """
+        保存的数据量达到所有 filter 能够保存的最大数据量时, 增加一个新的 filter
+        """
+        if self.data_saved >= self.max_data_size * len(self._filter_list):
+            logger.warning('max data_size reached, add one more bitarray. data_size: {}'.format(self.data_saved))
+            self._init_bitarray()
+
+    def _set_slot(self, _filter, slot, fingerprint):
+        """
+        设置第 slot 个位置的指纹, 返回这个位置原来的指纹
+        """
+        _start = slot * self.fingerprint_bits
+        _old = ba2int(_filter[_start:_start + self.fingerprint_bits])
+        _filter[_start:_start + self.fingerprint_bits] = int2ba(fingerprint, length=self.fingerprint_bits, endian='big')
+        return _old
+
+    def _find_in_bucket(self, _filter, index, fingerprint):
+        """
+        在第 index 个桶中查找指纹, 返回找到的位置, 找不到时返回 None
+        一次读取整个桶, 再移位取出每个位置的指纹
+        """
+        _bucket_bits = self.BUCKET_SIZE * self.fingerprint_bits
+        _bucket = ba2int(_filter[index * _bucket_bits:(index + 1) * _bucket_bits])
+        for _j in range(self.BUCKET_SIZE):
+            if (_bucket >> ((self.BUCKET_SIZE - 1 - _j) * self.fingerprint_bits)) & self._fingerprint_mask == fingerprint:
+                return index * self.BUCKET_SIZE + _j
+        return None
+
+    def _insert(self, _filter, i1, i2, fingerprint):
+        """
+        把指纹插入到 _filter 中, 两个桶都满了时随机踢出一个指纹, 把被踢出的指纹放到它的另一个桶中, 最多踢出 MAX_KICKS 次
+        :return: 插入成功时返回 None, 失败时返回最后一个被踢出的指纹和它所在的桶
+        """
+        for _index in (i1, i2):
+            _slot = self._find_in_bucket(_filter, _index, 0)
+            if _slot is not None:
+                self._set_slot(_filter, _slot, fingerprint)
+                return None
+
+        _index = random.choice((i1, i2))
+        for _ in range(self.MAX_KICKS):
+            _slot = _index * self.BUCKET_SIZE + random.randrange(self.BUCKET_SIZE)
+            fingerprint = self._set_slot(_filter, _slot, fingerprint)
+            _index = self._get_alt_index(_index, fingerprint)
+            _slot = self._find_in_bucket(_filter, _index, 0)
+            if _slot is not None:
+                self._set_slot(_filter, _slot, fingerprint)
+                return None
+        return _index, fingerprint
+
+    def add(self, data):
+        """
+        向过滤器中添加数据, 同一个数据可以添加多次, 添加多少次就需要删除多少次
+        最新的 filter 插入失败时, 增加一个新的 filter 保存最后一个被踢出的指纹
+        """
+        self._check_and_add_new_filter()
+        i1, i2, fingerprint = self._get_index_and_fingerprint(data)
+        _victim = self._insert(self._bitarray, i1, i2, fingerprint)
+        if _victim is not None:
+            logger.warning('cuckoo filter is full, add one more bitarray. data_size: {}'.format(self.data_saved))
+            self._init_bitarray()
+            _index, fingerprint = _victim
+            self._insert(self._bitarray, _index, self._get_alt_index(_index, fingerprint), fingerprint)
+        self.data_saved += 1
+
+    def add_many(self, data_list):
+        """
+        向过滤器中批量添加数据, 插入时的踢出操作只能逐个进行
+        """
+        for _data in data_list:
+            self.add(_data)
+
+    def add_if_absent(self, data):
+        """
+        判断数据是否存在, 如果不存在就添加
+        :return: 数据在添加之前是否已经存在
+        """
+        if self.exists(data):
+            return True
+        self.add(data)
+        return False
+
+    def exists(self, data):
+        """
+        检测数据是否存在于某一个 filter 中
+        """
+        i1, i2, fingerprint = self._get_index_and_fingerprint(data)
+        for _filter in reversed(self._filter_list):
+            if self._find_in_bucket(_filter, i1, fingerprint) is not None:
+                return True
+            if self._find_in_bucket(_filter, i2, fingerprint) is not None:
+                return True
+        return False
+
+    def _get_slots_many(self, _filter, slots):
+        """
+        批量读取 slots 中所有位置的指纹, 每个指纹从它开始的字节起读取 8 个字节, 再移位取出
+        """
+        _buffer = np.frombuffer(_filter, dtype=np.uint8)
+        _bits = slots * self.fingerprint_bits
+        _words = _buffer[(_bits >> 3)[..., None] + np.arange(8)].astype(np.uint64)
+        _words = np.bitwise_or.reduce(_words << self._BYTE_SHIFTS, axis=-1)
+        _shifts = (64 - self.fingerprint_bits - (_bits & 7)).astype(np.uint64)
+        return ((_words >> _shifts) & np.uint64(self._fingerprint_mask)).astype(np.int64)
+
+    def exists_many(self, data_list):
+        """
+        批量检测数据是否存在于过滤器中
+        :return: numpy 的 bool 数组, True 表示数据已经存在
+        """
+        data_list = list(data_list)
+        if not data_list:
+            return np.zeros(0, dtype=bool)
+        i1, i2, fingerprints = self._get_index_and_fingerprint_many(data_list)
+        _j = np.arange(self.BUCKET_SIZE)
+        # 每一行为一个数据的两个桶中所有位置的索引值, shape 为 (n, 2 * BUCKET_SIZE)
+        slots = np.concatenate([i1[:, None] * self.BUCKET_SIZE + _j, i2[:, None] * self.BUCKET_SIZE + _j], axis=1)
+        _mask = np.zeros(len(data_list), dtype=bool)
+        for _filter in reversed(self._filter_list):
+            _mask |= (self._get_slots_many(_filter, slots) == fingerprints[:, None]).any(axis=1)
+        return _mask
+
+    def delete(self, data):
+        """
+        从过滤器中删除数据, 只能删除已经添加过的数据, 否则可能会删除掉其它数据的相同指纹
+        :return: 是否找到并删除了数据
+        """
+        i1, i2, fingerprint = self._get_index_and_fingerprint(data)
+        for _filter in reversed(self._filter_list):
+            for _index in (i1, i2):
+                _slot = self._find_in_bucket(_filter, _index, fingerprint)
+                if _slot is not None:
+                    self._set_slot(_filter, _slot, 0)
+                    self.data_saved -= 1
+                    return True
+        return False
+
+
+class CuckooFilterRedis(CuckooFilter):
+    """
+    基于 redis 的布谷鸟过滤器
+    - 每个 filter 是一个 string 类型的 key, 使用 BITFIELD u{fingerprint_bits} #{slot} 读写指纹
+    - 添加 (包括踢出) 和删除都在 lua 脚本中原子执行, 多个节点之间不会出现竞争
+    - 所有的 filter key, 已保存的数据量和指纹的参数都保存在元数据 hash key 中, 其中的 filter key 列表只增不减,
+      本节点的 _filter_list 过时时, 添加, 删除和判断都会先更新 _filter_list 再重试, 与 BloomFilterRedis 相同
+    """
+
+    # 判断并添加 的 lua 脚本, 在 redis 服务端原子执行
+    # KEYS: 所有的 filter key, 最后一个是 redis_meta_key, 数据添加到最后一个 filter key 中
+    # ARGV: fingerprint_bits, bucket_num, i1, i2, fingerprint, max_kicks, check_exists
+    # 返回 {1, 已保存的数据量}: 添加成功, {2, 已保存的数据量}: check_exists 为 1 且数据已经存在,
+    #      {0, 最后一个被踢出的指纹, 它所在的桶}: 最后一个 filter 已经满了
+    #      {-1, redis_meta_key 中的 filters}: 本节点的 _filter_list 已经过时, 不判断也不添加, 由调用者更新之后重试
+    LUA_ADD = """
+    local meta_key = KEYS[#KEYS]
+    local n = #KEYS - 1
+    local filters = redis.call('HGET', meta_key, 'filters')
+    if filters and #cjson.decode(filters) > n then
+        return {-1, filters}
+    end
+    local field = 'u' .. ARGV[1]
+    local bucket_num = tonumber(ARGV[2])
+    local i1 = tonumber(ARGV[3])
+    local i2 = tonumber(ARGV[4])
+    local fp = tonumber(ARGV[5])
+    local max_kicks = tonumber(ARGV[6])
+
+    local function find(key, i, value)
+        local bucket = redis.call('BITFIELD', key,
+            'GET', field, '#' .. (i * 4), 'GET', field, '#' .. (i * 4 + 1),
+            'GET', field, '#' .. (i * 4 + 2), 'GET', field, '#' .. (i * 4 + 3))
+        for j = 1, 4 do
+            if bucket[j] == value then
+                return i * 4 + j - 1
+            end
+        end
+        return nil
+    end
+
+    if ARGV[7] == '1' then
+        for k = n, 1, -1 do
+            if find(KEYS[k], i1, fp) or find(KEYS[k], i2, fp) then
+                return {2, tonumber(redis.call('HGET', meta_key, 'count') or 0)}
+            end
+        end
+    end
+
+    local key = KEYS[n]
+    local slot = find(key, i1, 0) or find(key, i2, 0)
+    local i = i1
+    if not slot then
+        if math.random(0, 1) == 1 then
+            i = i2
+        end
+        for _ = 1, max_kicks do
+            fp = redis.call('BITFIELD', key, 'SET', field, '#' .. (i * 4 + math.random(0, 3)), fp)[1]
+            i = (fp * 40503 - i) % bucket_num
+            slot = find(key, i, 0)
+            if slot then
+                break
+            end
+        end
+    end
+    if not slot then
+        return {0, fp, i}
+    end
+    redis.call('BITFIELD', key, 'SET', field, '#' .. slot, fp)
+    return {1, redis.call('HINCRBY', meta_key, 'count', 1)}
+    """
+
+    # 删除 的 lua 脚本, 从最新的 filter 开始查找, 找到后把指纹置为 0
+    # KEYS: 所有的 filter key, 最后一个是 redis_meta_key
+    # ARGV: fingerprint_bits, i1, i2, fingerprint
+    # 返回 {是否删除了数据, 已保存的数据量}, 本节点的 _filter_list 已经过时时返回 {-1, redis_meta_key 中的 filters}
+    LUA_DELETE = """
+    local meta_key = KEYS[#KEYS]
+    local filters = redis.call('HGET', meta_key, 'filters')
+    if filters and #cjson.decode(filters) > #KEYS - 1 then
+        return {-1, filters}
+    end
+    local field = 'u' .. ARGV[1]
+    local fp = tonumber(ARGV[4])
+    for k = #KEYS - 1, 1, -1 do
+        for _, i in ipairs({tonumber(ARGV[2]), tonumber(ARGV[3])}) do
+            local bucket = redis.call('BITFIELD', KEYS[k],
+                'GET', field, '#' .. (i * 4), 'GET', field, '#' .. (i * 4 + 1),
+                'GET', field, '#' .. (i * 4 + 2), 'GET', field, '#' .. (i * 4 + 3))
+            for j = 1, 4 do
+                if bucket[j] == fp then
+                    redis.call('BITFIELD', KEYS[k], 'SET', field, '#' .. (i * 4 + j - 1), 0)
+                    return {1, redis.call('HINCRBY', meta_key, 'count', -1)}
+                end
+            end
+        end
+    end
+    return {0, tonumber(redis.call('HGET', meta_key, 'count') or 0)}
+    """
+
+    # 增加 filter 时更新 redis_meta_key 中的 filters, 只增不减, 与 BloomFilterRedis 相同
+    LUA_EXTEND_FILTERS = BloomFilterRedis.LUA_EXTEND_FILTERS
+
+    # redis 中一个 string 类型的 key 最大为 512MB
+    MAX_BIT_NUM = 512 * 1024 * 1024 * 8
+
+    def __init__(self, redis_db_config, redis_key_config, bf_config):
+        """
+        - bf_config 中包含的内容, 与 BloomFilterRedis 相同
+          - data_size_per_key: 期望向每个 key 中保存的数据量
+          - error_rate_threshold: 误判率的最大值
+          - memory_size, hash_seeds_num: 不使用, 指纹的位数和使用的内存量根据 data_size_per_key 和 error_rate_threshold 计算
+        :param redis_db_config: redis 数据库的配置信息
+        :param redis_key_config: redis 中保存过滤器内容的 key, 包含 bloom_filter_key 和 redis_meta_key
+        :param bf_config: 过滤器的配置信息
+        """
+        super().__init__(bf_config.get("data_size_per_key"), bf_config.get("error_rate_threshold"))
+        if self.bit_size > self.MAX_BIT_NUM:
+            raise Exception('data_size_per_key is too large, one redis key can not exceed 512MB')
+
+        self.redis_cli = RedisConn(redis_db_config).get_redis_cli()
+        self.redis_filter_key_base = redis_key_config.get('bloom_filter_key', 'cuckoo_filter')
+        self.redis_meta_key = redis_key_config.get('redis_meta_key', '{}_meta'.format(self.redis_filter_key_base))
+
+        self._filter_list = None
+        self.data_saved = None
+        self._get_init_params()
+
+        self._add_script = self.redis_cli.register_script(self.LUA_ADD)
+        self._delete_script = self.redis_cli.register_script(self.LUA_DELETE)
+
+    def _get_init_params(self):
+        """
+        从元数据 hash key 中读取所有的 filter key 和 已经保存的数据量, 不存在时初始化元数据
+        指纹的位数和桶的数量决定了数据在 filter 中的位置, 同一组 filter key 只能使用相同的参数
+        元数据不存在时, 每个字段使用 HSETNX 写入, 不会覆盖其它节点同时写入或已经更新过的字段, 之后重新读取元数据
+        """
+        meta = self.redis_cli.hgetall(self.redis_meta_key)
+        if not meta:
+            pipe = self.redis_cli.pipeline(transaction=False)
+            for _field, _value in dict(
+                    filters=json.dumps(['{}_1'.format(self.redis_filter_key_base)]),
+                    count=0,
+                    fingerprint_bits=self.fingerprint_bits,
+                    bucket_num=self.bucket_num,
+            ).items():
+                pipe.hsetnx(self.redis_meta_key, _field, _value)
+            pipe.hgetall(self.redis_meta_key)
+            meta = pipe.execute()[-1]
+
+        for _key in ('fingerprint_bits', 'bucket_num'):
+            _saved = int(meta[_key.encode('utf-8')])
+            if _saved != getattr(self, _key):
+                raise Exception('{} <{}> does not match {} <{}> saved in redis key: {}'.format(
+                    _key, getattr(self, _key), _key, _saved, self.redis_meta_key))
+        self._filter_list = json.loads(meta[b'filters'].decode('utf-8'))
+        self.data_saved = int(meta.get(b'count', 0))
+
+    def _sync_filter_list(self, filters):
+        """
+        redis_meta_key 中的 filters 比本节点的 _filter_list 更长时 (其它节点增加了 filter), 更新 _filter_list
+        :param filters: redis_meta_key 中的 filters, json str
+        :return: 是否更新了 _filter_list
+        """
+        if filters is None:
+            return False
+        filter_list = json.loads(filters.decode('utf-8') if isinstance(filters, bytes) else filters)
+        if len(filter_list) <= len(self._filter_list):
+            return False
+        self._filter_list = filter_list
+        return True
+
+    def _add_new_filter(self):
+        """
+        增加一个新的 filter key, 使用 LUA_EXTEND_FILTERS 保存到元数据中, 并使用返回的 filters 更新 _filter_list
+        """
+        _redis_filter_new = "{}_{}".format(self.redis_filter_key_base, len(self._filter_list) + 1)
+        self._filter_list.append(_redis_filter_new)
+        self._sync_filter_list(self.redis_cli.eval(
+            self.LUA_EXTEND_FILTERS, 1, self.redis_meta_key, json.dumps(self._filter_list)))
+
+    def _check_and_add_new_filter(self):
+        """
+        保存的数据量达到所有 filter 能够保存的最大数据量时, 增加新的 filter, 直到最后一个 filter 还有剩余的容量
+        """
+        while self.data_saved >= self.max_data_size * len(self._filter_list):
+            logger.warning('max data_size reached, add one more filter. data_size: {}'.format(self.data_saved))
+            self._add_new_filter()
+
+    def _add(self, data, check_exists):
+        """
+        执行添加的 lua 脚本, 最后一个 filter 插入失败时, 增加一个新的 filter 保存最后一个被踢出的指纹
+        :return: 数据在添加之前是否已经存在, 只有 check_exists 为 True 时才会判断
+        """
+        self._check_and_add_new_filter()
+        i1, i2, fingerprint = self._get_index_and_fingerprint(data)
+        _args = [self.fingerprint_bits, self.bucket_num, i1, i2, fingerprint, self.MAX_KICKS, int(check_exists)]
+        while True:
+            result = self._add_script(keys=self._filter_list + [self.redis_meta_key], args=_args)
+            if result[0] == -1:
+                # 其它节点增加了 filter, 更新 _filter_list 之后重试
+                self._sync_filter_list(result[1])
+                continue
+            if result[0] != 0:
+                break
+            logger.warning('cuckoo filter is full, add one more filter. data_size: {}'.format(self.data_saved))
+            self._add_new_filter()
+            # 最后一个被踢出的指纹保存到新的 filter 中, 不需要再判断是否存在
+            _, fingerprint, _index = result
+            _args = [self.fingerprint_bits, self.bucket_num, _index, self._get_alt_index(_index, fingerprint),
+                     fingerprint, self.MAX_KICKS, 0]
+        self.data_saved = result[1]
+        return result[0] == 2
+
+    def add(self, data):
+        """
+        向过滤器中添加数据, 同一个数据可以添加多次, 添加多少次就需要删除多少次
+        """
+        self._add(data, check_exists=False)
+
+    def add_if_absent(self, data):
+        """
+        在 redis 服务端原子的 判断数据是否存在, 如果不存在就添加
+        :return: 数据在添加之前是否已经存在
+        """
+        return self._add(data, check_exists=True)
+
+    def _get_bucket_args(self, i1, i2):
+        """
+        BITFIELD 读取两个桶中所有位置的参数
+        """
+        field = 'u{}'.format(self.fingerprint_bits)
+        _args = []
+        for _index in (i1, i2):
+            for _slot in range(_index * self.BUCKET_SIZE, (_index + 1) * self.BUCKET_SIZE):
+                _args.extend(['GET', field, '#{}'.format(_slot)])
+        return _args
+
+    def exists(self, data):
+        """
+        检测数据是否存在于某一个 filter 中, 所有 filter 的 BITFIELD 使用一个 pipeline 发送, 只需要一次往返
+        """
+        return bool(self.exists_many([data])[0])
+
+    def exists_many(self, data_list):
+        """
+        批量检测数据是否存在于过滤器中, 每个 filter 使用一条 BITFIELD 命令读取这一批数据的两个桶,
+        最后读取 redis_meta_key 中的 filters, 其它节点增加了 filter 时, 更新 _filter_list 之后重新判断
+        :return: 与 data_list 等长的 bool 列表, True 表示数据已经存在
+        """
+        index_list = [self._get_index_and_fingerprint(_data) for _data in data_list]
+        if not index_list:
+            return []
+
+        _args = []
+        for i1, i2, _ in index_list:
+            _args.extend(self._get_bucket_args(i1, i2))
+        while True:
+            pipe = self.redis_cli.pipeline(transaction=False)
+            for _filter in self._filter_list:
+                pipe.execute_command('BITFIELD', _filter, *_args)
+            pipe.hget(self.redis_meta_key, 'filters')
+            results = pipe.execute()
+            if not self._sync_filter_list(results[-1]):
+                break
+        slots_list = results[:-1]
+
+        _n = 2 * self.BUCKET_SIZE
+        return [
+            any(fingerprint in _slots[_i * _n:(_i + 1) * _n] for _slots in slots_list)
+            for _i, (_, _, fingerprint) in enumerate(index_list)
+        ]
+
+    def delete(self, data):
+        """
+        在 redis 服务端原子的 从过滤器中删除数据, 只能删除已经添加过的数据, 否则可能会删除掉其它数据的相同指纹
+        :return: 是否找到并删除了数据
+        """
+        i1, i2, fingerprint = self._get_index_and_fingerprint(data)
+        while True:
+            is_deleted, result = self._delete_script(
+                keys=self._filter_list + [self.redis_meta_key],
+                args=[self.fingerprint_bits, i1, i2, fingerprint],
+            )
+            if is_deleted != -1:
+                self.data_saved = result
+                return bool(is_deleted)
+            # 其它节点增加了 filter, 更新 _filter_list 之后重试
+            self._sync_filter_list(result)
+
+
+def main_memory_usage():
+    """
+    对比误判率为 1e-5 时, 布谷鸟过滤器和布隆过滤器使用的内存量和实际误判率, 并测试删除
+    """
+    from memory_bloom_filter import BloomFilterMemory
+    data_size = 10 ** 6
+    check_size = 10 ** 6
+    urls = ['https://www.dreamingtech.net/s?kw=python{}'.format(i) for i in range(data_size)]
+    others = ['https://www.dreamingtech.net/p/python{}'.format(i) for i in range(check_size)]
+
+    cf = CuckooFilterMemory(dict(data_size_per_filter=data_size, error_rate_threshold=1e-5))
+    cf.add_many(urls)
+    print('cuckoo filter: fingerprint_bits: {}, bits per item: {:.1f}, theoretical error_rate: {:.7f}, '
+          'actual error_rate: {:.7f}'.format(cf.fingerprint_bits, cf.bit_size / data_size, cf.error_rate,
+                                             cf.exists_many(others).sum() / check_size))
+
+    # 布隆过滤器的内存量只能以 MB 为单位, 3MB 和 17 个 hash 种子是误判率不超过 1e-5 的最小配置
+    bf = BloomFilterMemory(dict(
+        data_size_per_filter=data_size, memory_size=3, hash_seeds_num=17, error_rate_threshold=1e-5,
+        hash_strategy='double'))
+    bf.add_many(urls)
+    print('bloom filter: hash_seeds_num: {}, bits per item: {:.1f}, theoretical error_rate: {:.7f}, '
+          'actual error_rate: {:.7f}'.format(bf.hash_seeds_num, bf.bit_size / data_size, bf.error_rate,
+                                             bf.exists_many(others).sum() / check_size))
+
+    print('delete first 10 urls: {}'.format(all(cf.delete(url) for url in urls[:10])))
+    print('deleted urls exist: {}, other urls exist: {}, data_size: {}'.format(
+        any(url in cf for url in urls[:10]), all(url in cf for url in urls[10:1000]), len(cf)))
+
+
+def main_redis():
+    """
+    测试 redis 版布谷鸟过滤器, 需要本地运行 redis-server
+    注意: 测试前后会删除 cf_url 相关的 key
+    """
+    redis_db_config = dict(
+        host='127.0.0.1',
+        port=6379,
+        db=0,
+        password=None,
+    )
+    redis_key_config = dict(
+        bloom_filter_key='cf_url',
+        redis_meta_key='cf_url_meta',
+    )
+    bf_config = dict(
+        data_size_per_key=10 ** 2,
+        error_rate_threshold=1e-5,
+    )
+    cf = CuckooFilterRedis(redis_db_config, redis_key_config, bf_config)
+    cf.redis_cli.delete(*cf._filter_list, cf.redis_meta_key)
+    cf = CuckooFilterRedis(redis_db_config, redis_key_config, bf_config)
+
+    for i in range(300):
+        cf.add_if_absent(i)
+    print('data_size: <{}>, filter num: <{}>'.format(len(cf), len(cf._filter_list)))
+    print('all data exists: {}'.format(all(cf.exists_many(range(300)))))
+    # 下载失败需要重新抓取的 url, 从过滤器中删除
+    print('delete 0: {}, is 0 in cuckoo filter: {}'.format(cf.delete(0), 0 in cf))
+    cf.redis_cli.delete(*cf._filter_list, cf.redis_meta_key)
+
+
+if __name__ == '__main__':
+    # main_redis()
+    main_memory_usage()
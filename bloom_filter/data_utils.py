@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+# 计算 hash 之前对数据的处理: 转换为 bytes, 规范化 url
+# data preprocessing before hashing
+
+from urllib.parse import urlsplit, urlunsplit
+
+
+def canonicalize_url(url):
+    """
+    规范化 url, 使等价的 url 得到相同的 hash 值
+    - scheme 和 netloc 转换为小写, path 为空时使用 /
+    - 去掉 fragment (# 之后的部分), 不会发送到服务器
+    - 查询参数按 key=value 排序, 去掉空的参数, 不对参数进行 unquote/quote, 以免改变参数的含义
+    同时支持 str 和 bytes
+    """
+    scheme, netloc, path, query, _fragment = urlsplit(url)
+    _sep, _root = (b'&', b'/') if isinstance(url, bytes) else ('&', '/')
+    query = _sep.join(sorted(_param for _param in query.split(_sep) if _param))
+    return urlunsplit((scheme, netloc.lower(), path or _root, query, _fragment[:0]))
+
+
+def safe_data(data, canonicalize=False):
+    """
+    把传入的 data 转换为计算 hash 使用的 bytes, 每个数据只转换一次, 而不是每个 hash 种子转换一次
+    - str: 使用 utf-8 encode, 与 mmh3 直接对 str 计算 hash 的结果相同, 已经保存的数据依然可用
+    - bytes: 直接使用, 不需要 str() 和 encode, 如 request.url.encode() 或请求指纹的摘要
+    - bytearray, memoryview: mmh3 只接受只读的 bytes, 复制为 bytes
+    - 其它类型: 使用 str() 转换后 encode
+    :param canonicalize: 是否使用 canonicalize_url 规范化 str 类型的 url, bytes 类型的数据认为已经规范化过, 直接使用
+    """
+    if isinstance(data, str):
+        return (canonicalize_url(data) if canonicalize else data).encode('utf-8')
+    if isinstance(data, bytes):
+        return data
+    if isinstance(data, (bytearray, memoryview)):
+        return bytes(data)
+    try:
+        data = str(data)
+    except:
+        raise Exception('data type must be str, bytes or can be converted to str')
+    return (canonicalize_url(data) if canonicalize else data).encode('utf-8')
@@ -2,15 +2,33 @@
 # 基于内存的布隆过滤器
 # memory based bloom filter
 
+import json
+import logging
 import math
+import mmap as mmap_module
+import os
 import bitarray
 import mmh3
+import numpy as np
+
+from bloom_filter_metrics import BloomFilterMetrics, get_filter_metrics, record_metrics
+from data_utils import safe_data
+
+logger = logging.getLogger(__name__)
 
 
 class BloomFilterMemory(object):
     """基于内存的布隆过滤器"""
 
-    def __init__(self, bf_config):
+    # 快照文件的文件头, 用于校验文件格式
+    SNAPSHOT_MAGIC = b'BFMEM001'
+    # 分块布局中每个块的 bit 位长度, 一个块为 64 字节, 即一个 cache line
+    BLOCK_BITS = 512
+    # 块内偏移量的位数, 以及一个 64 位的 hash 值能够拆分出的偏移量的数量
+    OFFSET_BITS = 9
+    OFFSETS_PER_HASH = 7
+
+    def __init__(self, bf_config, filter_list=None, readonly=False):
         """
         初始化布隆过滤器
         - bf_config 中包含的内容
@@ -18,8 +36,28 @@ class BloomFilterMemory(object):
           - memory_size: 每个 filter/bitarray 使用的内存量
           - hash_seeds_num: hash 种子的数量
           - error_rate_threshold: 误判率的最大值
+          - hash_strategy: hash 索引值的计算方式, 可选, 默认为 seeds
+            - seeds: 对每个 hash 种子计算一次 mmh3.hash
+            - double: 只计算一次 mmh3.hash64, 使用 double hashing (h1 + i * h2) % m 得到所有的索引值
+          - scalable: 是否使用可扩展布隆过滤器 (scalable bloom filter), 可选, 默认为 False
+            - False: 每个 filter 的大小和误判率阈值都相同, filter 的数量随数据量线性增长, 整体误判率也随之线性增长
+            - True: 第 i 个 filter (从 0 开始) 的大小为 memory_size * growth_ratio ** i,
+              误判率阈值为 error_rate_threshold * (1 - tightening_ratio) * tightening_ratio ** i,
+              所有 filter 的误判率之和不超过 error_rate_threshold, filter 的数量随数据量对数增长
+          - growth_ratio: 可扩展布隆过滤器中 filter 大小的增长倍数, 可选, 默认为 2
+          - tightening_ratio: 可扩展布隆过滤器中 filter 误判率阈值的收紧比例, 可选, 默认为 0.9
+          - layout: bit 位的布局, 可选, 默认为 standard
+            - standard: k 个索引值分布在整个 bitarray 中, 每次判断需要 k 次随机的内存访问
+            - blocked: 分块布隆过滤器 (blocked bloom filter), 一个数据的 k 个 bit 位都在同一个 64 字节的块中,
+              每次判断只需要访问一个 cache line, 相同的 m 和 k 时误判率略高, 只支持 hash_strategy 为 double
+          - canonicalize_url: 计算 hash 之前是否规范化 str 类型的 url (排序查询参数, 去掉 fragment), 可选, 默认为 False
+          - metrics: 是否记录每种操作的调用次数, 命中数量, 探测的 bit 位数量和延迟直方图, 可选, 默认为 False, 见 bloom_filter_metrics
         :param bf_config: bloom filter 配置信息
+        :param filter_list: 已有的 bitarray 列表, 从快照文件中加载时使用, 为 None 时新建一个 bitarray
+        :param readonly: 是否为只读的过滤器, 只读时不能添加数据
         """
+        # 保存配置信息, 用于保存快照
+        self.bf_config = dict(bf_config)
         # 每一个 bitarray/bitmap 中要存放的数据量
         self.data_size_per_filter = bf_config.get("data_size_per_filter")
         # bloom 过滤器 使用的内存量
@@ -28,11 +66,33 @@ class BloomFilterMemory(object):
         self.hash_seeds_num = bf_config.get("hash_seeds_num")
         # 误判率阈值, 保证给定的 data_size, hash_num, bit_size 计算得到的 error_rate 小于给定的 error_rate_threshold
         self.error_rate_threshold = bf_config.get("error_rate_threshold")
+        # hash 索引值的计算方式
+        self.hash_strategy = bf_config.get("hash_strategy", "seeds")
+        # 可扩展布隆过滤器的配置
+        self.scalable = bf_config.get("scalable", False)
+        self.growth_ratio = bf_config.get("growth_ratio", 2)
+        self.tightening_ratio = bf_config.get("tightening_ratio", 0.9)
+        # bit 位的布局
+        self.layout = bf_config.get("layout", "standard")
+        # 是否规范化 url
+        self.canonicalize_url = bf_config.get("canonicalize_url", False)
+        # 监控指标, 没有开启时为 None
+        self.metrics = BloomFilterMetrics() if bf_config.get("metrics", False) else None
 
         if not (isinstance(self.data_size_per_filter, int) and self.data_size_per_filter > 0):
             raise ValueError("data_size must be integer and greater than 0")
         if not (0 < self.error_rate_threshold < 1):
             raise ValueError("error_rate_threshold must be between 0 and 1")
+        if self.hash_strategy not in ("seeds", "double"):
+            raise ValueError("hash_strategy must be seeds or double")
+        if not (isinstance(self.growth_ratio, int) and self.growth_ratio >= 1):
+            raise ValueError("growth_ratio must be integer and not less than 1")
+        if not (0 < self.tightening_ratio < 1):
+            raise ValueError("tightening_ratio must be between 0 and 1")
+        if self.layout not in ("standard", "blocked"):
+            raise ValueError("layout must be standard or blocked")
+        if self.layout == "blocked" and self.hash_strategy != "double":
+            raise ValueError("blocked layout only supports double hash_strategy")
         if not (isinstance(memory_size, int) and memory_size > 0):
             raise Exception('memory_size must be integer and larger than 0')
 
@@ -44,19 +104,35 @@ class BloomFilterMemory(object):
         # 检查给定的参数计算得到的误判率 error_rate 能否小于误判率阈值 error_rate_threshold
         self._check_error_rate()
 
+        # 计算一个 memory_size 能够保存的 data_size, 可扩展布隆过滤器中为第一个 filter 能够保存的 data_size
+        self.max_data_size = self._cal_max_data_size(*self._get_filter_params(0))
+        # 前 i 个 filter 能够保存的最大数据量之和, 与 _filter_list 一一对应
+        self._capacity_list = []
+
         # bitarray, 用来保存布隆过滤器的 hash 索引值
         self._bitarray = None
         # 因为 bitarray 的数量可能会增加, 故要定义列表保存所有的 bitarray
         self._filter_list = []
-        # 初始化 bitarray, 必须要手动初始化 bitarray, 否则在 add 中添加数据时, 因为 _filter_list 为 0,
-        # self.data_saved >= self.data_size_per_filter * len(self._filter_list) 是恒成立的
-        self._init_bitarray()
-
-        # 计算一个 memory_size 能够保存的 data_size
-        self.max_data_size = self._cal_max_data_size()
+        self.readonly = readonly
+        if filter_list:
+            # 使用从快照文件中加载的 bitarray, 新的数据保存到最后一个 bitarray 中
+            for _filter in filter_list:
+                self._add_filter_capacity()
+                self._filter_list.append(_filter)
+            self._bitarray = self._filter_list[-1]
+        else:
+            # 初始化 bitarray, 必须要手动初始化 bitarray, 否则在 add 中添加数据时, 因为 _filter_list 为 0,
+            # self.data_saved >= self._capacity_list[-1] 是恒成立的
+            self._init_bitarray()
 
         # 获取多个 hash 种子, 保存到一个列表中
         self._hash_func_list = self.get_hash_seeds()
+        # 分块布局中, 第 i 个块内偏移量来自第几个 64 位的 hash 值, 以及需要右移的位数
+        self._block_shifts = [
+            (_i // self.OFFSETS_PER_HASH, _i % self.OFFSETS_PER_HASH * self.OFFSET_BITS)
+            for _i in range(self.hash_seeds_num)
+        ]
+        self._block_word_num = self._block_shifts[-1][0] + 1
 
         # 已存入 hash map 中的数据量
         self.data_saved = 0
@@ -75,11 +151,32 @@ class BloomFilterMemory(object):
         n = self.data_size_per_filter
         k = self.hash_seeds_num
         m = self.bit_size
+        if self.layout == "blocked":
+            return self._cal_blocked_error_rate(n, m)
         # pow(*args, **kwargs)
         # Equivalent to x**y (with two arguments) or x**y % z (with three arguments)
         p = pow(1 - math.exp(-k / (m / n)), k)
         return p
 
+    def _cal_blocked_error_rate(self, data_size, bit_size):
+        """
+        计算分块布局的误判率
+        每个块中的数据量 j 服从均值为 n * B / m 的泊松分布, 一个块中有 j 个数据时, 相当于 B 个 bit 位的标准布隆过滤器,
+        误判率为 pow(1 - pow(1 - 1 / B, j * k), k), 整体误判率为所有 j 的误判率按泊松分布的加权和
+        数据在块之间分布不均匀, 所以相同的 m 和 k 时, 分块布局的误判率高于 standard 布局
+        """
+        k = self.hash_seeds_num
+        b = self.BLOCK_BITS
+        lam = data_size * b / bit_size
+        # 只计算均值附近的项, 其余项的概率可以忽略不计
+        _start = max(0, int(lam - 10 * math.sqrt(lam) - 10))
+        _end = int(lam + 10 * math.sqrt(lam) + 10)
+        p = 0
+        for j in range(_start, _end + 1):
+            _poisson = math.exp(j * math.log(lam) - lam - math.lgamma(j + 1)) if lam > 0 else float(j == 0)
+            p += _poisson * pow(1 - pow(1 - 1 / b, j * k), k)
+        return p
+
     def _check_error_rate(self):
         """
         检测给定数量的 hash 种子能否实现指定的 误判率
@@ -90,7 +187,7 @@ class BloomFilterMemory(object):
                 'please add hash_num or increase memory_size.'.format(self.error_rate, self.error_rate_threshold)
             )
 
-    def _cal_max_data_size(self):
+    def _cal_max_data_size(self, bit_size, error_rate_threshold):
         """
         计算在给定的 p, m, k 时, 一个 filter 能够保存的最大数据量 n
         既然已经有了 data_size_per_filter, 为什么还要再计算 max_data_size 呢?
@@ -104,21 +201,68 @@ class BloomFilterMemory(object):
         n = ceil(m / (-k / log(1 - exp(log(p) / k))))
         """
         k = self.hash_seeds_num
-        m = self.bit_size
-        p = self.error_rate_threshold
+        m = bit_size
+        p = error_rate_threshold
         n = math.ceil(m / (-k / math.log(1-math.exp(math.log(p) / k))))
+        if self.layout == "blocked":
+            # 分块布局的误判率没有解析解, 误判率随 n 单调递增, 在 [0, n] 中二分查找满足误判率阈值的最大数据量
+            _low, _high = 0, n
+            while _low < _high:
+                _mid = (_low + _high + 1) // 2
+                if self._cal_blocked_error_rate(_mid, m) <= p:
+                    _low = _mid
+                else:
+                    _high = _mid - 1
+            n = _low
         return n
 
+    def _get_filter_params(self, index):
+        """
+        获取第 index 个 filter (从 0 开始) 的 bit 位长度 和 误判率阈值
+        可扩展布隆过滤器中, filter 的大小按 growth_ratio 增长, 误判率阈值按 tightening_ratio 收紧,
+        所有 filter 的误判率阈值之和为 error_rate_threshold * (1 - r) * (1 + r + r^2 + ...) <= error_rate_threshold
+        """
+        if not self.scalable:
+            return self.bit_size, self.error_rate_threshold
+        bit_size = self.bit_size * self.growth_ratio ** index
+        error_rate_threshold = self.error_rate_threshold * (1 - self.tightening_ratio) * self.tightening_ratio ** index
+        return bit_size, error_rate_threshold
+
+    def _add_filter_capacity(self):
+        """
+        计算新增的 filter 能够保存的最大数据量, 累加到 _capacity_list 中, 并返回新增的 filter 的 bit 位长度
+        """
+        bit_size, error_rate_threshold = self._get_filter_params(len(self._capacity_list))
+        capacity = self._cal_max_data_size(bit_size, error_rate_threshold)
+        self._capacity_list.append((self._capacity_list[-1] if self._capacity_list else 0) + capacity)
+        return bit_size
+
     def _init_bitarray(self):
         """初始化 bit array"""
         # bitarray([initial], [endian=string])
         # 如果传入的参数为 int, 就返回 bit_size 长度的 bitarray, 但是其中的值是随机的
-        self._bitarray = bitarray.bitarray(self.bit_size)
-        # 把 bitarray 中的所有值都设置为 0
-        self._bitarray.setall(0)
+        # 显式指定 endian='big', 批量操作时按照 big endian 的规则把 bit 索引转换为 字节索引 和 位掩码
+        bit_size = self._add_filter_capacity()
+        if self.layout == "blocked":
+            # 分块布局中每个块必须与 cache line 对齐, 否则一个块会跨越两个 cache line
+            # 多分配 64 字节, 从 64 字节对齐的地址开始使用, np.zeros 分配的内存中的值都为 0
+            _buffer = np.zeros(bit_size // 8 + 64, dtype=np.uint8)
+            _offset = -_buffer.ctypes.data % 64
+            self._bitarray = bitarray.bitarray(buffer=_buffer[_offset:_offset + bit_size // 8], endian='big')
+        else:
+            self._bitarray = bitarray.bitarray(bit_size, endian='big')
+            # 把 bitarray 中的所有值都设置为 0
+            self._bitarray.setall(0)
         # 把生成的 bitarray 添加到 列表中
         self._filter_list.append(self._bitarray)
 
+    def _check_writable(self):
+        """
+        检查过滤器是否可写, 以只读方式加载的快照不能添加数据
+        """
+        if self.readonly:
+            raise Exception('bloom filter is loaded as readonly, can not add data')
+
     def _check_and_add_new_filter(self):
         """
         检查 布隆过滤器 中已经保存的 数据量 data_saved 是否大于 每个 bitarray 中要保存的数据量 data_size_per_filter,
@@ -126,21 +270,18 @@ class BloomFilterMemory(object):
         在 add 数据时, 向 _filter_list 中最后一个元素 即最新添加的 bitarray 中添加数据
         在 判断时, 要对 _filter_list 中所有的 bitarray 进行判断
         """
-        if self.data_saved >= self.max_data_size * len(self._filter_list):
-            print('max data_size reached, add one more bitarray. data_size: {}'.format(self.data_saved))
+        if self.data_saved >= self._capacity_list[-1]:
+            logger.warning('max data_size reached, add one more bitarray. data_size: {}'.format(self.data_saved))
             self._init_bitarray()
+            if self.metrics is not None:
+                self.metrics.inc_filters_added()
 
     def _safe_data(self, data):
         """
-        把传入的 data 转换为 str 类型
-        mmh3.hash 只能对 str, bytes-like obj 进行 hash 计算
+        把传入的 data 转换为 bytes, 见 data_utils.safe_data
+        mmh3.hash 只能对 str, bytes 进行 hash 计算
         """
-        if not isinstance(data, str):
-            try:
-                data = str(data)
-            except:
-                raise Exception('data type must be str or can be converted to str')
-        return data
+        return safe_data(data, self.canonicalize_url)
 
     def get_hash_seeds(self):
         """
@@ -150,40 +291,252 @@ class BloomFilterMemory(object):
         _seeds = [_i for _i in range(1, self.hash_seeds_num + 1)]
         return _seeds
 
-    def get_hash_indexes(self, data):
+    def _get_hashes(self, data):
         """
-        计算一个给定的数据 data 使用所有的 hash_funcs 得到的在 bitarray 中的索引值 / offset 值
+        计算一个给定的数据 data 的 hash 值, 与 filter 的大小无关, 同一个数据在所有 filter 中只需要计算一次
+        - seeds: 每个 hash 种子对应的 mmh3.hash
+        - double: mmh3.hash64 得到的 h1, h2
         """
-        # 把 str 数据转换为 bytes
+        # 把数据转换为 bytes, 只转换一次, 而不是每个 hash 种子 encode 一次
         data = self._safe_data(data)
-        _hash_indexes = [mmh3.hash(data, self._hash_func_list[_i]) % self.bit_size for _i in range(self.hash_seeds_num)]
-        return _hash_indexes
+        if self.hash_strategy == "double":
+            # Kirsch-Mitzenmacher double hashing, 只计算一次 128 位的 hash, 拆分为 h1, h2
+            return mmh3.hash64(data, signed=False)
+        return [mmh3.hash(data, self._hash_func_list[_i]) for _i in range(self.hash_seeds_num)]
+
+    @staticmethod
+    def _mix64(x):
+        """
+        splitmix64 的混淆函数, 由一个 64 位的 hash 值生成另一个 64 位的 hash 值, 同时支持 int 和 numpy 的 uint64 数组
+        """
+        if isinstance(x, int):
+            x = ((x ^ (x >> 30)) * 0xbf58476d1ce4e5b9) & 0xffffffffffffffff
+            x = ((x ^ (x >> 27)) * 0x94d049bb133111eb) & 0xffffffffffffffff
+            return x ^ (x >> 31)
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+        return x ^ (x >> np.uint64(31))
+
+    def _get_block_and_offsets(self, hashes, bit_size):
+        """
+        分块布局中, 使用 h1 选择块, 把 h2 按 9 位一段拆分为块内的偏移量, 得到块的起始 bit 位和 k 个块内偏移量
+        一个 64 位的 hash 值可以拆分出 7 个偏移量, k 大于 7 时使用 _mix64 生成下一个 hash 值
+        块内不使用 double hashing, 在只有 512 个 bit 位的块内, (a + i * b) 生成的偏移量之间相关性太强, 实际误判率会高出数倍
+        """
+        _block_start = hashes[0] % (bit_size // self.BLOCK_BITS) * self.BLOCK_BITS
+        _words = [hashes[1]]
+        while len(_words) < self._block_word_num:
+            _words.append(self._mix64(_words[-1]))
+        _mask = self.BLOCK_BITS - 1
+        return _block_start, [(_words[_w] >> _shift) & _mask for _w, _shift in self._block_shifts]
+
+    def _get_block_and_offsets_many(self, hashes, bit_size):
+        """
+        批量计算分块布局中的块的起始 bit 位和块内偏移量, 与 _get_block_and_offsets 的结果一致
+        返回 shape 为 (n, 1) 的块的起始 bit 位和 shape 为 (n, hash_seeds_num) 的块内偏移量
+        """
+        _block_start = (hashes[:, :1] % np.uint64(bit_size // self.BLOCK_BITS)).astype(np.int64) * self.BLOCK_BITS
+        _words = [hashes[:, 1]]
+        while len(_words) < self._block_word_num:
+            _words.append(self._mix64(_words[-1]))
+        _offsets = np.empty((len(hashes), self.hash_seeds_num), dtype=np.int64)
+        for _i, (_w, _shift) in enumerate(self._block_shifts):
+            _offsets[:, _i] = (_words[_w] >> np.uint64(_shift)) & np.uint64(self.BLOCK_BITS - 1)
+        return _block_start, _offsets
+
+    def _hashes_to_indexes(self, hashes, bit_size):
+        """
+        把 _get_hashes 得到的 hash 值转换为长度为 bit_size 的 bitarray 中的索引值
+        """
+        if self.layout == "blocked":
+            _block_start, _offsets = self._get_block_and_offsets(hashes, bit_size)
+            return [_block_start + _offset for _offset in _offsets]
+        if self.hash_strategy == "double":
+            # 先对 h1, h2 取模, 与 numpy 批量计算时的结果保持一致
+            h1, h2 = hashes[0] % bit_size, hashes[1] % bit_size
+            return [(h1 + _i * h2) % bit_size for _i in range(self.hash_seeds_num)]
+        return [_hash % bit_size for _hash in hashes]
+
+    def get_hash_indexes(self, data, bit_size=None):
+        """
+        计算一个给定的数据 data 使用所有的 hash_funcs 得到的在 bitarray 中的索引值 / offset 值
+        :param bit_size: bitarray 的 bit 位长度, 默认为第一个 filter 的长度
+        """
+        return self._hashes_to_indexes(self._get_hashes(data), bit_size or self.bit_size)
+
+    def _get_hashes_many(self, data_list):
+        """
+        批量计算 data_list 中所有数据的 hash 值
+        返回 numpy 数组, 每一行对应一个数据, seeds 的 shape 为 (n, hash_seeds_num), double 的 shape 为 (n, 2)
+        """
+        # 每个数据只转换并 encode 一次, 而不是每个 hash 种子 encode 一次
+        data_list = [self._safe_data(_data) for _data in data_list]
+        if self.hash_strategy == "double":
+            return np.fromiter(
+                (_h for _data in data_list for _h in mmh3.hash64(_data, signed=False)),
+                dtype=np.uint64,
+                count=len(data_list) * 2,
+            ).reshape(len(data_list), 2)
+        return np.fromiter(
+            (mmh3.hash(_data, _seed) for _data in data_list for _seed in self._hash_func_list),
+            dtype=np.int64,
+            count=len(data_list) * self.hash_seeds_num,
+        ).reshape(len(data_list), self.hash_seeds_num)
+
+    def _hashes_to_indexes_many(self, hashes, bit_size):
+        """
+        把 _get_hashes_many 得到的 hash 值批量转换为长度为 bit_size 的 bitarray 中的索引值
+        返回 shape 为 (n, hash_seeds_num) 的 numpy 数组
+        """
+        if self.layout == "blocked":
+            _block_start, _offsets = self._get_block_and_offsets_many(hashes, bit_size)
+            return _block_start + _offsets
+        if self.hash_strategy == "double":
+            _hashes = (hashes % np.uint64(bit_size)).astype(np.int64)
+            _i = np.arange(self.hash_seeds_num, dtype=np.int64)
+            return (_hashes[:, :1] + _i * _hashes[:, 1:]) % bit_size
+        # mmh3.hash 的结果是有符号的, np.mod 对正数取模时结果均为非负数, 与 python 的 % 一致
+        return np.mod(hashes, bit_size)
+
+    def get_hash_indexes_many(self, data_list, bit_size=None):
+        """
+        批量计算 data_list 中所有数据的 hash 索引值
+        返回 shape 为 (len(data_list), hash_seeds_num) 的 numpy 数组, 每一行对应一个数据的所有索引值
+        :param bit_size: bitarray 的 bit 位长度, 默认为第一个 filter 的长度
+        """
+        return self._hashes_to_indexes_many(self._get_hashes_many(data_list), bit_size or self.bit_size)
+
+    @staticmethod
+    def _get_bytes_and_masks(hash_indexes):
+        """
+        把 bit 索引转换为 bitarray 底层 buffer 中的 字节索引 和 位掩码 (big endian)
+        """
+        _bytes = hash_indexes >> 3
+        _masks = np.left_shift(1, 7 - (hash_indexes & 7)).astype(np.uint8)
+        return _bytes, _masks
 
+    def _is_exists_in_certain_filter_many(self, hashes, _filter):
+        """
+        批量检查 hashes 中每一行对应的数据是否存在于某个特定的 bitarray 中
+        直接在 bitarray 的 buffer 上进行 numpy 的向量化操作, 对每个 bitarray 只遍历一次
+        """
+        _buffer = np.frombuffer(_filter, dtype=np.uint8)
+        _bytes, _masks = self._get_bytes_and_masks(self._hashes_to_indexes_many(hashes, len(_filter)))
+        # 某一行中所有的索引值对应的 bit 位都为 1 时, 才认为这一行对应的数据已经存在
+        return ((_buffer[_bytes] & _masks) != 0).all(axis=1)
+
+    def _exists_many(self, hashes):
+        """
+        对 _filter_list 中所有的 bitarray 进行遍历, 批量检测 hashes 对应的数据是否存在
+        从最新的 bitarray 开始判断, 可扩展布隆过滤器中最新的 bitarray 最大, 保存的数据也最多
+        """
+        _mask = np.zeros(len(hashes), dtype=bool)
+        for _filter in reversed(self._filter_list):
+            # 已经在之前的 filter 中存在的数据, 不需要再进行判断
+            _not_found = ~_mask
+            if not _not_found.any():
+                break
+            _mask[_not_found] = self._is_exists_in_certain_filter_many(hashes[_not_found], _filter)
+        return _mask
+
+    def _add_many(self, hashes):
+        """
+        把 hashes 批量添加到布隆过滤器中
+        在添加之前按照当前 filter 剩余的容量对数据进行分块, 以保证每个 filter 中保存的数据量不超过其最大数据量
+        """
+        self._check_writable()
+        _start = 0
+        while _start < len(hashes):
+            self._check_and_add_new_filter()
+            # 当前 filter 中还能保存的数据量
+            _capacity = self._capacity_list[-1] - self.data_saved
+            _chunk = hashes[_start:_start + _capacity]
+
+            _buffer = np.frombuffer(self._bitarray, dtype=np.uint8)
+            _bytes, _masks = self._get_bytes_and_masks(
+                self._hashes_to_indexes_many(_chunk, len(self._bitarray)).ravel())
+            # np.bitwise_or.at 能够正确处理同一个字节被多次设置的情况
+            np.bitwise_or.at(_buffer, _bytes, _masks)
+
+            self.data_saved += len(_chunk)
+            _start += len(_chunk)
+
+    @record_metrics('add_many')
+    def add_many(self, data_list):
+        """
+        向布隆过滤器中批量添加数据
+        :param data_list: 要添加的数据, 可以是任意可迭代对象
+        """
+        data_list = list(data_list)
+        if not data_list:
+            return
+        self._add_many(self._get_hashes_many(data_list))
+
+    @record_metrics('exists_many')
+    def exists_many(self, data_list):
+        """
+        批量检测数据是否存在于布隆过滤器中
+        :param data_list: 要检测的数据, 可以是任意可迭代对象
+        :return: 与 data_list 等长的 bool 类型的 numpy 数组, True 表示数据已经存在
+        """
+        data_list = list(data_list)
+        if not data_list:
+            return np.zeros(0, dtype=bool)
+        return self._exists_many(self._get_hashes_many(data_list))
+
+    @record_metrics('add_if_absent_many')
+    def add_if_absent_many(self, data_list):
+        """
+        批量检测数据是否存在, 并把不存在的数据添加到布隆过滤器中
+        同一批数据中重复出现的数据, 只有第一次出现时被认为是不存在的
+        :param data_list: 要检测并添加的数据, 可以是任意可迭代对象
+        :return: 与 data_list 等长的 bool 类型的 numpy 数组, True 表示数据在添加之前已经存在
+        """
+        data_list = list(data_list)
+        if not data_list:
+            return np.zeros(0, dtype=bool)
+        hashes = self._get_hashes_many(data_list)
+        _mask = self._exists_many(hashes)
+
+        # 对本批次中不存在的数据, 按照 hash 值进行去重, 只保留第一次出现的数据
+        _absent = np.flatnonzero(~_mask)
+        _, _first = np.unique(hashes[_absent], axis=0, return_index=True)
+        _first_absent = np.zeros(len(_absent), dtype=bool)
+        _first_absent[_first] = True
+        # 本批次中重复出现的数据, 标记为已经存在
+        _mask[_absent[~_first_absent]] = True
+
+        self._add_many(hashes[_absent[_first_absent]])
+        return _mask
+
+    @record_metrics('add')
     def add(self, data):
         """
         向布隆过滤器中添加数据
         :param data: 要添加的数据
         """
+        self._check_writable()
+
         # 在每次向 bloom_filter 中添加数据时, 都先判断一下 已经保存的数据量,
         # 如果 已保存数据量 达到 每个 filter 所能保存的最大值, 就增加一个新的 filter
         self._check_and_add_new_filter()
 
         # get_hash_indexes 获取所有 hash 种子对应的 hash 索引值 / offset 值
-        for _hash_index in self.get_hash_indexes(data):
+        for _hash_index in self.get_hash_indexes(data, len(self._bitarray)):
             self._bitarray[_hash_index] = 1
 
         # 保存的数据量加 1
         self.data_saved += 1
 
-    def _is_exists_in_certain_filter(self, data, _filter):
+    def _is_exists_in_certain_filter(self, hashes, _filter):
         """
-        检查给定的值 data 是否存在于某个特定的 bitarray 中
+        检查给定的 hash 值对应的数据是否存在于某个特定的 bitarray 中
         对每一个 hash 种子计算 给定的 data 的 index 值, 或称索引值, 偏移量,
         只要有一个 hash 种子计算得到的 index 不在 bitarray 中, 就说明这个 data 绝对不存在
         如果所有 hash 种子计算得到的 index 在 bitarray 中都存在, 在一定的误判率下, 就认为这个 data 存在
         """
-        # 获取所有种子计算得到的 索引值
-        hash_indexes = self.get_hash_indexes(data)
+        # 获取所有种子计算得到的 索引值, 不同大小的 bitarray 中索引值不同
+        hash_indexes = self._hashes_to_indexes(hashes, len(_filter))
         # 对所有的索引值进行过滤
         for _hash_index in hash_indexes:
             # 只要有一个 _hash_index 对应的 bit 位上的索引值不 为 0, 就肯定不存在, 就返回 False
@@ -192,19 +545,141 @@ class BloomFilterMemory(object):
         # 当所有的索引值对应的 bit 位上的值都为 1 时, 就认为 data 值已经存在
         return True
 
+    @record_metrics('exists')
     def exists(self, data):
         """
         对 _filter_list 中所有的 bitarray 进行遍历,
         检测数据是否在某一个 bitarray 中存在
+        hash 值只需要计算一次, 从最新的 bitarray 开始判断
         """
-        for _filter in self._filter_list:
-            _is_exists = self._is_exists_in_certain_filter(data, _filter)
+        hashes = self._get_hashes(data)
+        for _filter in reversed(self._filter_list):
+            _is_exists = self._is_exists_in_certain_filter(hashes, _filter)
             # 只要 数据在某一个 _filter/bitarray 中存在, 就返回 True
             if _is_exists:
                 return True
         # 如果所有的 bitarray 都检测过, 并且都不存在, 才返回 False
         return False
 
+    def get_fill_ratios(self):
+        """
+        每个 bitarray 中值为 1 的 bit 位的比例, 填充率为 50% 时已经达到最优的 k 对应的容量
+        """
+        return [_filter.count() / len(_filter) for _filter in self._filter_list]
+
+    def get_metrics(self, fill_ratio=True):
+        """
+        获取过滤器的监控指标, 见 bloom_filter_metrics.get_filter_metrics
+        :param fill_ratio: 是否计算填充率和估算的误判率, 需要遍历所有的 bitarray
+        """
+        return get_filter_metrics(self, self.get_fill_ratios() if fill_ratio else None)
+
+    def _get_geometry(self):
+        """
+        决定 hash 索引值和每个 filter 大小的配置, 只有这些配置都相同的过滤器才能合并
+        """
+        return dict(
+            bit_size=self.bit_size,
+            hash_seeds_num=self.hash_seeds_num,
+            hash_strategy=self.hash_strategy,
+            layout=self.layout,
+            scalable=bool(self.scalable),
+            growth_ratio=self.growth_ratio if self.scalable else None,
+            canonicalize_url=bool(self.canonicalize_url),
+        )
+
+    def merge(self, other):
+        """
+        把另一个相同配置的布隆过滤器合并到本过滤器中, 合并后的过滤器包含两者的所有数据
+        - 第 i 个 bitarray 与 other 的第 i 个 bitarray 按位或 (|=), other 中多出的 bitarray 复制为新的 bitarray
+        - data_saved 为两者之和, 两者中相同的数据会被计算两次, 是实际数据量的上限
+        - 用于合并多个节点保存的快照, 或者把旧的过滤器合并到新的过滤器中
+        :param other: 要合并的 BloomFilterMemory, 不会被修改
+        :return: self
+        """
+        self._check_writable()
+        if self._get_geometry() != other._get_geometry():
+            raise ValueError('can not merge bloom filters with different geometry: {} and {}'.format(
+                self._get_geometry(), other._get_geometry()))
+
+        for _i, _filter in enumerate(other._filter_list):
+            if _i >= len(self._filter_list):
+                self._init_bitarray()
+            self._filter_list[_i] |= _filter
+        self._bitarray = self._filter_list[-1]
+        self.data_saved += other.data_saved
+        return self
+
+    def __ior__(self, other):
+        """
+        bf |= other, 与 merge 相同
+        """
+        return self.merge(other)
+
+    def save(self, path):
+        """
+        把布隆过滤器保存为快照文件, 包括 配置信息, data_saved 和 所有的 bitarray
+        文件格式: SNAPSHOT_MAGIC + 8 字节的文件头长度 + json 格式的文件头 + 所有 bitarray 的原始字节
+        先写入临时文件再替换, 以免覆盖正在被其它进程 mmap 的文件
+        :param path: 快照文件路径
+        """
+        header = json.dumps(dict(
+            bf_config=self.bf_config,
+            data_saved=self.data_saved,
+            filter_num=len(self._filter_list),
+            # 可扩展布隆过滤器中每个 filter 的大小不同
+            filter_bytes_list=[len(_filter) // 8 for _filter in self._filter_list],
+        )).encode('utf-8')
+
+        tmp_path = '{}.tmp'.format(path)
+        with open(tmp_path, 'wb') as f:
+            f.write(self.SNAPSHOT_MAGIC)
+            f.write(len(header).to_bytes(8, 'little'))
+            f.write(header)
+            for _filter in self._filter_list:
+                _filter.tofile(f)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, mmap=True, readonly=False):
+        """
+        从快照文件中加载布隆过滤器
+        mmap 为 True 时, 使用 mmap 把文件映射到内存中, bitarray 直接使用映射的内存, 不需要读取和复制整个文件,
+        同一台机器上的多个进程加载同一个快照文件时, 共享操作系统的 page cache
+        - readonly 为 True 时, 以只读方式映射, 不能添加数据
+        - readonly 为 False 时, 以 copy-on-write 方式映射, 添加的数据只在本进程中可见, 不会写回到文件中
+        :param path: 快照文件路径
+        :param mmap: 是否使用 mmap 加载
+        :param readonly: 是否以只读方式加载
+        """
+        with open(path, 'rb') as f:
+            if f.read(len(cls.SNAPSHOT_MAGIC)) != cls.SNAPSHOT_MAGIC:
+                raise Exception('invalid bloom filter snapshot file: {}'.format(path))
+            header_len = int.from_bytes(f.read(8), 'little')
+            header = json.loads(f.read(header_len).decode('utf-8'))
+            offset = f.tell()
+            # 旧版本的快照文件中所有 filter 的大小相同, 只记录了 filter_bytes
+            filter_bytes_list = header.get('filter_bytes_list') or [header.get('filter_bytes')] * header['filter_num']
+
+            filter_list = []
+            if mmap:
+                access = mmap_module.ACCESS_READ if readonly else mmap_module.ACCESS_COPY
+                # 关闭文件后 mmap 依然有效, bitarray 持有 memoryview 的引用, 从而保证 mmap 不会被释放
+                _buffer = memoryview(mmap_module.mmap(f.fileno(), 0, access=access))
+                _start = offset
+                for filter_bytes in filter_bytes_list:
+                    filter_list.append(bitarray.bitarray(buffer=_buffer[_start:_start + filter_bytes], endian='big'))
+                    _start += filter_bytes
+            else:
+                for filter_bytes in filter_bytes_list:
+                    _filter = bitarray.bitarray(endian='big')
+                    _filter.fromfile(f, filter_bytes)
+                    filter_list.append(_filter)
+
+        bf = cls(header['bf_config'], filter_list=filter_list, readonly=readonly)
+        bf.data_saved = header['data_saved']
+        return bf
+
     def __len__(self):
         """"
         返回现有数据容量
@@ -285,6 +760,182 @@ def main_scrapy_single_node():
     print('is where in bloom_filter: ', 'where' in bf)
 
 
+def main_benchmark_batch():
+    """
+    对比逐条 add/exists 和 批量 add_many/exists_many 的吞吐量
+    """
+    import time
+    data_size = 10 ** 6
+    bf_config = dict(
+        data_size_per_filter=10 ** 7,
+        memory_size=100,
+        hash_seeds_num=5,
+        error_rate_threshold=1e-6
+    )
+    urls = ['https://www.dreamingtech.net/s?kw=python{}'.format(i) for i in range(data_size)]
+
+    bf = BloomFilterMemory(bf_config)
+    start = time.time()
+    for url in urls:
+        bf.add(url)
+    add_cost = time.time() - start
+    start = time.time()
+    for url in urls:
+        bf.exists(url)
+    exists_cost = time.time() - start
+    print('per-item add: {:.2f}s, {:.0f} items/s'.format(add_cost, data_size / add_cost))
+    print('per-item exists: {:.2f}s, {:.0f} items/s'.format(exists_cost, data_size / exists_cost))
+
+    bf = BloomFilterMemory(bf_config)
+    start = time.time()
+    bf.add_many(urls)
+    add_cost = time.time() - start
+    start = time.time()
+    mask = bf.exists_many(urls)
+    exists_cost = time.time() - start
+    print('batch add_many: {:.2f}s, {:.0f} items/s'.format(add_cost, data_size / add_cost))
+    print('batch exists_many: {:.2f}s, {:.0f} items/s'.format(exists_cost, data_size / exists_cost))
+    print('all items exist after add_many: {}'.format(bool(mask.all())))
+
+
+def main_check_error_rate(tolerance=1.1):
+    """
+    验证 seeds 和 double 两种 hash 方式的实际误判率
+    向过滤器中添加 data_size 个数据, 再使用另外 check_size 个不重复的数据进行判断, 被判断为存在的比例即为实际误判率
+    两种方式的实际误判率都应该与理论误判率 error_rate 接近, 超过 error_rate_threshold * tolerance 时抛出异常
+    :param tolerance: 实际误判率允许超过 error_rate_threshold 的倍数, 用于容忍统计误差
+    """
+    import time
+    data_size = 10 ** 6
+    check_size = 10 ** 6
+    for hash_strategy in ('seeds', 'double'):
+        # 使用较小的内存, 使误判率足够大, 能够在 10^6 个数据中统计出来, error_rate_threshold 略大于理论误判率 0.01825
+        bf_config = dict(
+            data_size_per_filter=data_size,
+            memory_size=1,
+            hash_seeds_num=5,
+            error_rate_threshold=0.02,
+            hash_strategy=hash_strategy,
+        )
+        bf = BloomFilterMemory(bf_config)
+        start = time.time()
+        bf.add_many('https://www.dreamingtech.net/s?kw=python{}'.format(i) for i in range(data_size))
+        mask = bf.exists_many('https://www.dreamingtech.net/p/python{}'.format(i) for i in range(check_size))
+        cost = time.time() - start
+        actual_error_rate = mask.sum() / check_size
+        print('hash_strategy: {:>6}, theoretical error_rate: {:.5f}, actual error_rate: {:.5f}, cost: {:.2f}s'.format(
+            hash_strategy, bf.error_rate, actual_error_rate, cost))
+        if actual_error_rate > bf_config['error_rate_threshold'] * tolerance:
+            raise Exception('actual error_rate: <{:.5f}> of hash_strategy: <{}> is larger than {} * {}'.format(
+                actual_error_rate, hash_strategy, bf_config['error_rate_threshold'], tolerance))
+
+
+def main_snapshot():
+    """
+    测试保存和加载快照文件
+    """
+    import time
+    bf_config = dict(
+        data_size_per_filter=10 ** 7,
+        memory_size=100,
+        hash_seeds_num=5,
+        error_rate_threshold=1e-6
+    )
+    bf = BloomFilterMemory(bf_config)
+    bf.add_many('https://www.dreamingtech.net/s?kw=python{}'.format(i) for i in range(10 ** 5))
+
+    path = 'bf_memory.snapshot'
+    start = time.time()
+    bf.save(path)
+    print('save snapshot cost: {:.2f}s'.format(time.time() - start))
+
+    for mmap in (True, False):
+        start = time.time()
+        bf_loaded = BloomFilterMemory.load(path, mmap=mmap)
+        print('load snapshot with mmap={} cost: {:.4f}s, data_size: <{}>'.format(
+            mmap, time.time() - start, bf_loaded.data_saved))
+        print('is python0 in bloom_filter: ', 'https://www.dreamingtech.net/s?kw=python0' in bf_loaded)
+        print('is xixi in bloom_filter: ', 'xixi' in bf_loaded)
+
+
+def main_scalable():
+    """
+    对比线性增长和可扩展布隆过滤器 (scalable bloom filter)
+    可扩展模式下 filter 的数量随数据量对数增长, 每个 filter 的误判率阈值逐渐收紧, 整体实际误判率不超过 error_rate_threshold
+    """
+    import time
+    data_size = 10 ** 6
+    check_size = 10 ** 6
+    for scalable in (False, True):
+        # data_size_per_filter 远小于实际数据量, 模拟预估数据量不准确的情况
+        bf_config = dict(
+            data_size_per_filter=10 ** 4,
+            memory_size=1,
+            hash_seeds_num=5,
+            error_rate_threshold=1e-4,
+            hash_strategy='double',
+            scalable=scalable,
+        )
+        bf = BloomFilterMemory(bf_config)
+        start = time.time()
+        bf.add_many('https://www.dreamingtech.net/s?kw=python{}'.format(i) for i in range(data_size))
+        add_cost = time.time() - start
+        start = time.time()
+        mask = bf.exists_many('https://www.dreamingtech.net/p/python{}'.format(i) for i in range(check_size))
+        exists_cost = time.time() - start
+        print('scalable: {:>5}, filter num: {:>3}, memory used: {:>4}MB, actual error_rate: {:.5f}, '
+              'add cost: {:.2f}s, exists cost: {:.2f}s'.format(
+                  str(scalable), len(bf._filter_list), sum(len(_f) for _f in bf._filter_list) // 8 // 1024 // 1024,
+                  mask.sum() / check_size, add_cost, exists_cost))
+
+
+def main_benchmark_blocked():
+    """
+    对比 standard 和 blocked 两种布局在 10^7 个数据时的判断延迟
+    bitarray 为 100MB, 远大于 cpu 缓存, standard 布局每次判断有 k 次随机的 cache/TLB miss, blocked 布局只有一次
+    - exists_many 在 numpy 中批量读取, 内存访问是主要的耗时, blocked 布局的延迟更低
+    - 逐条的 exists 中 python 解释器的开销远大于内存访问, 两种布局的差别不明显
+    """
+    import time
+    data_size = 10 ** 7
+    check_size = 10 ** 6
+    single_size = 10 ** 5
+    for layout in ('standard', 'blocked'):
+        bf_config = dict(
+            data_size_per_filter=data_size,
+            memory_size=100,
+            hash_seeds_num=5,
+            error_rate_threshold=1e-5,
+            hash_strategy='double',
+            layout=layout,
+        )
+        bf = BloomFilterMemory(bf_config)
+        bf.add_many('https://www.dreamingtech.net/s?kw=python{}'.format(i) for i in range(data_size))
+
+        # 只统计判断的耗时, 不包括 hash 值的计算
+        check_list = ['https://www.dreamingtech.net/p/python{}'.format(i) for i in range(check_size)]
+        hashes_many = bf._get_hashes_many(check_list)
+        start = time.time()
+        mask = bf._exists_many(hashes_many)
+        batch_cost = time.time() - start
+
+        hashes_list = [bf._get_hashes(_data) for _data in check_list[:single_size]]
+        start = time.time()
+        for hashes in hashes_list:
+            bf._is_exists_in_certain_filter(hashes, bf._bitarray)
+        single_cost = time.time() - start
+
+        print('layout: {:>8}, theoretical error_rate: {:.2e}, actual error_rate: {:.2e}, '
+              'exists latency: {:.3f}us, exists_many latency: {:.3f}us'.format(
+                  layout, bf.error_rate, mask.sum() / check_size,
+                  single_cost / single_size * 10 ** 6, batch_cost / check_size * 10 ** 6))
+
+
 if __name__ == '__main__':
+    # main_benchmark_blocked()
+    # main_scalable()
+    # main_snapshot()
+    # main_check_error_rate()
     # main_multi_filter()
+    # main_benchmark_batch()
     main_scrapy_single_node()
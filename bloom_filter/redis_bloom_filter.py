@@ -2,42 +2,154 @@
 # 基于 redis 的布隆过滤器
 # redis based bloom filter
 
+import json
+import logging
 import math
 import redis
+import redis.cluster
 import mmh3
 
+from bloom_filter_metrics import BloomFilterMetrics, get_filter_metrics, record_metrics
+from data_utils import safe_data
 
-def singleton(cls, *args, **kwargs):
-    """ 单例模式 """
+logger = logging.getLogger(__name__)
+
+
+# 连接池的默认参数, 可以在 redis_db_config 中覆盖
+# health_check_interval: 连接空闲超过这个秒数后, 再次使用之前先发送 PING 检查连接是否可用
+# socket_keepalive: 开启 TCP keepalive, 以免长时间空闲的连接被防火墙或 NAT 断开
+REDIS_POOL_DEFAULTS = dict(
+    max_connections=None,
+    health_check_interval=30,
+    socket_keepalive=True,
+)
+
+# 可以在 redis_db_config 中设置的连接池参数
+REDIS_POOL_PARAMS = (
+    'max_connections', 'health_check_interval', 'socket_keepalive', 'socket_keepalive_options',
+    'socket_timeout', 'socket_connect_timeout', 'retry_on_timeout', 'username',
+)
+
+
+def get_pool_kwargs(redis_config):
+    """
+    把 redis_db_config 转换为 ConnectionPool 的参数
+    - 支持 host, port, db, password, 也支持 url (如 redis://:password@127.0.0.1:6379/0), url 中的参数优先
+    - 连接池参数见 REDIS_POOL_PARAMS, 没有设置时使用 REDIS_POOL_DEFAULTS
+    """
+    pool_kwargs = dict(
+        host=redis_config.get('host', '127.0.0.1'),
+        port=redis_config.get('port', 6379),
+        db=redis_config.get('db', 0),
+        password=redis_config.get('password'),
+    )
+    if redis_config.get('url'):
+        pool_kwargs.update(redis.connection.parse_url(redis_config['url']))
+    pool_kwargs.update(REDIS_POOL_DEFAULTS)
+    pool_kwargs.update({_k: redis_config[_k] for _k in REDIS_POOL_PARAMS if _k in redis_config})
+    pool_kwargs['port'], pool_kwargs['db'] = int(pool_kwargs['port']), int(pool_kwargs['db'])
+    return pool_kwargs
+
+
+def singleton_by_config(cls):
+    """
+    单例模式, 每组连接参数各有一个实例
+    旧版本只按类保存单例, 第一次传入的 redis_config 会被所有的过滤器使用, 指向其它 redis 或 db 的过滤器也会使用同一个连接池;
+    现在按 get_pool_kwargs 得到的连接参数保存单例, url 过滤器和 title 过滤器可以使用不同的 redis 或 db, 各自使用独立的连接池
+    """
     instances = {}
 
-    def _singleton(*args, **kwargs):
-        if cls not in instances:
-            instances[cls] = cls(*args, **kwargs)
-        return instances[cls]
+    def _singleton(redis_config, *args, **kwargs):
+        _key = tuple(sorted((_k, repr(_v)) for _k, _v in get_pool_kwargs(redis_config).items()))
+        _key += (('cluster', bool(redis_config.get('cluster'))), )
+        if _key not in instances:
+            instances[_key] = cls(redis_config, *args, **kwargs)
+        return instances[_key]
     return _singleton
 
 
-@singleton
+@singleton_by_config
 class RedisConn(object):
-    """ redis 客户端连接 """
+    """
+    redis 客户端连接, 相同连接参数的 RedisConn 共用一个连接池
+    redis_config 中 cluster 为 True 时, 连接 redis cluster, host 和 port 为集群中任意一个节点, 不支持 db
+    """
 
     def __init__(self, redis_config):
 
-        self.pool_redis = redis.ConnectionPool(
-            host=redis_config.get('host', '127.0.0.1'),
-            port=redis_config.get('port', 6379),
-            db=redis_config.get('db', 0),
-            password=redis_config.get('password'),
-        )
+        self.pool_redis = None
+        self.redis_cluster = None
+        pool_kwargs = get_pool_kwargs(redis_config)
+        if redis_config.get('cluster'):
+            # RedisCluster 为每个节点维护一个连接池, 不支持 db
+            pool_kwargs.pop('db', None)
+            self.redis_cluster = redis.cluster.RedisCluster(
+                **{_k: _v for _k, _v in pool_kwargs.items() if _v is not None})
+        else:
+            self.pool_redis = redis.ConnectionPool(**pool_kwargs)
 
     def get_redis_cli(self):
         """ 获取redis 客户端连接 """
+        if self.redis_cluster is not None:
+            return self.redis_cluster
         return redis.StrictRedis(connection_pool=self.pool_redis)
 
 
 class BloomFilterRedis(object):
     """ redis 版布隆过滤器 """
+
+    # 判断并添加 的 lua 脚本, 在 redis 服务端原子执行, 一次往返完成 判断 和 添加
+    # KEYS: 所有的 filter key, 最后一个是 redis_meta_key
+    # ARGV: 数据在每个 filter 中的 hash 索引值, 按 KEYS 的顺序依次排列, 每个 filter 有 k 个索引值
+    #       可扩展布隆过滤器中每个 filter 的大小不同, 同一个数据在不同 filter 中的索引值也不同
+    # 返回 {是否已经存在, 已保存的数据量}; redis_meta_key 中的 filter key 比 KEYS 多时 (本节点的 _filter_list 已经过时),
+    # 不判断也不添加, 返回 {-1, redis_meta_key 中的 filters}, 由调用者更新 _filter_list 之后重试
+    LUA_ADD_IF_ABSENT = """
+    local meta_key = KEYS[#KEYS]
+    local n = #KEYS - 1
+    local k = #ARGV / n
+    local filters = redis.call('HGET', meta_key, 'filters')
+    if filters and #cjson.decode(filters) > n then
+        return {-1, filters}
+    end
+    -- 从最新的 filter 开始判断, 可扩展布隆过滤器中最新的 filter 最大, 保存的数据也最多
+    for i = n, 1, -1 do
+        local found = 1
+        for j = 1, k do
+            if redis.call('GETBIT', KEYS[i], ARGV[(i - 1) * k + j]) == 0 then
+                found = 0
+                break
+            end
+        end
+        if found == 1 then
+            return {1, tonumber(redis.call('HGET', meta_key, 'count') or 0)}
+        end
+    end
+    for j = 1, k do
+        redis.call('SETBIT', KEYS[n], ARGV[(n - 1) * k + j], 1)
+    end
+    return {0, redis.call('HINCRBY', meta_key, 'count', 1)}
+    """
+
+    # 增加 filter 时更新 redis_meta_key 中的 filters, 只增不减: 只有传入的 filter 列表比已保存的更长时才写入
+    # filter key 的名称是确定的 ({base}_1, {base}_2 ...), 更长的列表总是包含较短的列表
+    # KEYS: redis_meta_key
+    # ARGV: 本节点的 filter 列表的 json str
+    # 返回写入之后 redis_meta_key 中的 filters
+    LUA_EXTEND_FILTERS = """
+    local filters = redis.call('HGET', KEYS[1], 'filters')
+    if filters and #cjson.decode(filters) >= #cjson.decode(ARGV[1]) then
+        return filters
+    end
+    redis.call('HSET', KEYS[1], 'filters', ARGV[1])
+    return ARGV[1]
+    """
+
+    # redis 中一个 string 类型的 key 最大为 512MB, 可扩展布隆过滤器中 filter 的 bit 位长度不能超过这个值
+    MAX_BIT_NUM = 512 * 1024 * 1024 * 8
+    # 从另一个 redis 实例中合并 filter key 时, 每次 GETRANGE / SETRANGE 复制的字节数
+    MERGE_CHUNK_SIZE = 4 * 1024 * 1024
+
     def __init__(self, redis_db_config, redis_key_config, bf_config):
         """
         初始化布隆过滤器
@@ -46,11 +158,65 @@ class BloomFilterRedis(object):
           - memory_size: redis 中每个 key 使用的内存量
           - hash_seeds_num: hash 种子的数量
           - error_rate_threshold: 误判率的最大值
+          - hash_strategy: hash 索引值的计算方式, 可选, 默认为 seeds, 以保证已经保存在 redis 中的 bitmap 依然可用
+            - seeds: 对每个 hash 种子计算一次 mmh3.hash
+            - double: 只计算一次 mmh3.hash64, 使用 double hashing (h1 + i * h2) % m 得到所有的索引值
+          - scalable: 是否使用可扩展布隆过滤器 (scalable bloom filter), 可选, 默认为 False
+            - True: 第 i 个 filter key (从 0 开始) 的大小为 memory_size * growth_ratio ** i (最大为 512MB),
+              误判率阈值为 error_rate_threshold * (1 - tightening_ratio) * tightening_ratio ** i
+          - growth_ratio: 可扩展布隆过滤器中 filter 大小的增长倍数, 可选, 默认为 2
+          - tightening_ratio: 可扩展布隆过滤器中 filter 误判率阈值的收紧比例, 可选, 默认为 0.9
+          - canonicalize_url: 计算 hash 之前是否规范化 str 类型的 url (排序查询参数, 去掉 fragment), 可选, 默认为 False
+          - metrics: 是否在本节点记录每种操作的调用次数, 命中数量, 探测的 bit 位数量和延迟直方图, 可选, 默认为 False, 见 bloom_filter_metrics
+          - hash_strategy, scalable, growth_ratio, tightening_ratio, canonicalize_url 会保存到 redis_meta_key 中,
+            使用同一组 filter key 的所有节点必须使用相同的配置
 
         :param redis_db_config: redis 数据库的配置信息
         :param redis_key_config: redis 中保存 bloom filter 内容的 key
         :param bf_config: bloom filter 配置信息
         """
+        self._init_config(bf_config)
+
+        # 实例化 redis 客户端
+        self.redis_cli = self._get_redis_cli(redis_db_config)
+
+        # redis 中布隆过滤器的 key, 因为可能会使用多个 内存块, 故可能有多个 redis_key
+        # 把 redis_config 中定义的 bloom_filter 作为基础, 在后面添加数字作为 bloom_filter_key
+        # 如 bloom_filter_01, bloom_filter_02
+        self.redis_filter_key_base = redis_key_config.get('bloom_filter_key', 'bloom_filter')
+        # redis 中记录 bloom_filter 元数据的 hash key, 保存所有的 filter key (filters) 和 已保存的数据量 (count)
+        # 启动时只需要一次 HGETALL, 不再使用会阻塞 redis 的 KEYS 命令
+        self.redis_meta_key = redis_key_config.get('redis_meta_key', '{}_meta'.format(self.redis_filter_key_base))
+        # 旧版本中记录 bloom_filter 中保存数据量的 key, 只在元数据 hash key 不存在时, 用于迁移旧数据
+        self.redis_count_key = redis_key_config.get('redis_count_key', 'bloom_filter_count')
+        # 判断和添加在 lua 脚本中原子执行 (add_if_absent), 多个节点之间不会出现同时判断, 同时添加的情况,
+        # 故不再需要 redis_lock_key 分布式锁, redis_key_config 中即使传入了 redis_lock_key 也不再使用
+
+        # 计算一个 memory_size 能够保存的 data_size, 可扩展布隆过滤器中为第一个 filter 能够保存的 data_size
+        self.max_data_size = self._cal_max_data_size(*self._get_filter_params(0))
+        # 前 i 个 filter 能够保存的最大数据量之和, 与 _filter_list 一一对应
+        self._capacity_list = []
+
+        self._filter_list = None
+        self.data_saved = None
+        # 获取 _filter_list 和 data_saved 参数
+        self._get_init_params()
+
+        # 获取多个 hash 种子
+        self._hash_seeds_list = self.get_hash_seeds()
+
+        self._register_scripts()
+
+    def _register_scripts(self):
+        """
+        注册 判断并添加 的 lua 脚本, redis-py 会自动处理 EVALSHA 和 NOSCRIPT 的情况
+        """
+        self._add_if_absent_script = self.redis_cli.register_script(self.LUA_ADD_IF_ABSENT)
+
+    def _init_config(self, bf_config):
+        """
+        读取并检查 bf_config, 不访问 redis, bloom_filter_planner 使用它检查生成的 bf_config
+        """
         # 要保存到 redis 每个 key 中的数据量的大小/要使用每个 redis_key 进行过滤的数据量的大小
         self.data_size_per_key = bf_config.get("data_size_per_key")
         # bloom 过滤器 使用的内存量
@@ -59,11 +225,27 @@ class BloomFilterRedis(object):
         self.hash_seeds_num = bf_config.get("hash_seeds_num")
         # 误判率阈值, 保证给定的 data_size, hash_num, bit_size 计算得到的 error_rate 小于给定的 error_rate_threshold
         self.error_rate_threshold = bf_config.get("error_rate_threshold")
+        # hash 索引值的计算方式
+        self.hash_strategy = bf_config.get("hash_strategy", "seeds")
+        # 可扩展布隆过滤器的配置
+        self.scalable = bf_config.get("scalable", False)
+        self.growth_ratio = bf_config.get("growth_ratio", 2)
+        self.tightening_ratio = bf_config.get("tightening_ratio", 0.9)
+        # 是否规范化 url
+        self.canonicalize_url = bf_config.get("canonicalize_url", False)
+        # 监控指标, 没有开启时为 None
+        self.metrics = BloomFilterMetrics() if bf_config.get("metrics", False) else None
 
         if not (isinstance(self.data_size_per_key, int) and self.data_size_per_key > 0):
             raise ValueError("data_size_per_key must be greater than 0")
         if not (0 < self.error_rate_threshold < 1):
             raise ValueError("error_rate_threshold must be between 0 and 1")
+        if self.hash_strategy not in ("seeds", "double"):
+            raise ValueError("hash_strategy must be seeds or double")
+        if not (isinstance(self.growth_ratio, int) and self.growth_ratio >= 1):
+            raise ValueError("growth_ratio must be integer and not less than 1")
+        if not (0 < self.tightening_ratio < 1):
+            raise ValueError("tightening_ratio must be between 0 and 1")
         if not (isinstance(memory_size, int) and 0 < memory_size < 512):
             raise Exception('memory_size for redis must be integer and between (0 512MB)')
         if not (isinstance(self.hash_seeds_num, int) and 0 < self.hash_seeds_num < 10):
@@ -76,28 +258,12 @@ class BloomFilterRedis(object):
         # 检查给定的参数计算得到的误判率 error_rate 能否小于误判率阈值 error_rate_threshold
         self._check_error_rate()
 
-        # 实例化 redis 客户端
-        self.redis_cli = RedisConn(redis_db_config).get_redis_cli()
-
-        # redis 中布隆过滤器的 key, 因为可能会使用多个 内存块, 故可能有多个 redis_key
-        # 把 redis_config 中定义的 bloom_filter 作为基础, 在后面添加数字作为 bloom_filter_key
-        # 如 bloom_filter_01, bloom_filter_02
-        self.redis_filter_key_base = redis_key_config.get('bloom_filter_key', 'bloom_filter')
-        # redis 中记录 bloom_filter 中保存数据量的 key
-        self.redis_count_key = redis_key_config.get('redis_count_key', 'bloom_filter_count')
-        # redis 分布式锁, 以免出现同时判断, 同时添加的情况
-        self.redis_lock_key = redis_key_config.get('redis_lock_key', 'bloom_filter_lock')
-
-        self._filter_list = None
-        self.data_saved = None
-        # 获取 _filter_list 和 data_saved 参数
-        self._get_init_params()
-
-        # 计算一个 memory_size 能够保存的 data_size
-        self.max_data_size = self._cal_max_data_size()
-
-        # 获取多个 hash 种子
-        self._hash_seeds_list = self.get_hash_seeds()
+    @staticmethod
+    def _get_redis_cli(redis_db_config):
+        """
+        获取 redis 客户端, 所有的 BloomFilterRedis 共用 RedisConn 的连接池
+        """
+        return RedisConn(redis_db_config).get_redis_cli()
 
     def _cal_error_rate(self):
         """
@@ -132,30 +298,114 @@ class BloomFilterRedis(object):
 
     def _get_init_params(self):
         """
-        从 redis 中读取出所有的 redis_key, 保存到列表中, 如果不存在, 就设置为 ['bf_url_1'] 或 ['bf_title_1']
-        从 redis 中读取出已经保存的 数据量, 如果不存在, 就设置为 0
+        从 redis 的元数据 hash key 中读取出所有的 filter key 和 已经保存的数据量, 只需要一次 HGETALL
+        如果元数据不存在, 就从旧版本的 key 中迁移, 如果旧版本的 key 也不存在, 就设置为 ['{base}_1'] 和 0
+        """
+        meta = self.redis_cli.hgetall(self.redis_meta_key)
+        if not meta:
+            self._set_init_params(*self._get_legacy_init_params())
+            pipe = self.redis_cli.pipeline(transaction=False)
+            self._queue_init_meta(pipe)
+            meta = pipe.execute()[-1]
+        self._set_init_params(*self._parse_meta(meta))
+
+    def _parse_meta(self, meta):
+        """
+        从 HGETALL 得到的元数据中解析出所有的 filter key 和 已经保存的数据量
+        """
+        self._check_meta_config(meta)
+        return json.loads(meta[b'filters'].decode('utf-8')), int(meta.get(b'count', 0))
+
+    def _set_init_params(self, filter_list, data_saved):
+        """
+        设置 _filter_list 和 data_saved, 并计算每个 filter 能够保存的最大数据量
+        """
+        self._filter_list, self.data_saved = filter_list, data_saved
+        self._capacity_list = []
+        for _ in self._filter_list:
+            self._add_filter_capacity()
+
+    def _sync_filter_list(self, filters):
+        """
+        redis_meta_key 中的 filters 比本节点的 _filter_list 更长时 (其它节点增加了 filter), 更新 _filter_list
+        :param filters: redis_meta_key 中的 filters, json str
+        :return: 是否更新了 _filter_list
+        """
+        if filters is None:
+            return False
+        filter_list = json.loads(filters.decode('utf-8') if isinstance(filters, bytes) else filters)
+        if len(filter_list) <= len(self._filter_list):
+            return False
+        self._filter_list = filter_list
+        while len(self._capacity_list) < len(self._filter_list):
+            self._add_filter_capacity()
+        return True
+
+    def _get_extend_filters_args(self):
+        """
+        执行 LUA_EXTEND_FILTERS 的 EVAL 参数, 增加 filter 的次数很少, 直接使用 EVAL, 同步和异步的客户端及 pipeline 共用
         """
-        # 以列表的形式保存所有的 redis_filter_key, 如 [bf_url_1, bf_url_2], 用来进行去重判断
-        # 如果是 url 去重, redis_key 的形式为 [bf_url_1, bf_url_2]
-        if self.redis_filter_key_base.startswith('bf_url'):
-            # 从 redis 中读取出所有 匹配 bf_url_0 - bf_url_9 的 key
-            # 如果没有获取到, 表示之前没有运行过此布隆过滤器, 就把 _filter_list 就设置为 ['bf_url_1']
-            self._filter_list = [_i.decode() for _i in self.redis_cli.keys(pattern='bf_url_[0-9]')] if \
-                self.redis_cli.keys(pattern='bf_url_[0-9]') else ['bf_url_1']
-        # 如果是 title 去重, redis_key 的形式为 [bf_title_1, bf_title_2]
-        elif self.redis_filter_key_base.startswith('bf_title'):
-            self._filter_list = [_i.decode() for _i in self.redis_cli.keys(pattern='bf_title_[0-9]')] if \
-                self.redis_cli.keys(pattern='bf_title_[0-9]') else ['bf_title_1']
+        return self.LUA_EXTEND_FILTERS, 1, self.redis_meta_key, json.dumps(self._filter_list)
 
-        # 从 redis 中读取到的 keys 可能是乱序排列的, 要对其进行升序排列
-        self._filter_list.sort()
+    def _get_meta_mapping(self):
+        """
+        新建元数据 hash key 时写入的内容
+        """
+        return dict(filters=json.dumps(self._filter_list), count=self.data_saved, **self._get_meta_config())
 
-        # 初始化时从 redis 中读取出已经保存的数据量, 如果未读取到数据, 就设置为 0
-        # 从 redis 中获取 _data_saved, 每次向 redis add 后都把 redis 中的这个键的值加 1
-        self.data_saved = int(self.redis_cli.get(self.redis_count_key).decode('utf-8')) if \
-            self.redis_cli.get(self.redis_count_key) else 0
+    def _queue_init_meta(self, pipe):
+        """
+        把新建元数据 hash key 的命令添加到 pipeline 中, 同步和异步的客户端共用
+        每个字段使用 HSETNX 写入, 其它节点同时初始化或已经使用 HINCRBY / LUA_EXTEND_FILTERS 更新过的字段不会被覆盖,
+        最后使用 HGETALL 重新读取元数据, 以 redis 中保存的内容为准
+        """
+        for _field, _value in self._get_meta_mapping().items():
+            pipe.hsetnx(self.redis_meta_key, _field, _value)
+        pipe.hgetall(self.redis_meta_key)
 
-    def _cal_max_data_size(self):
+    def _get_meta_config(self):
+        """
+        需要保存到 redis_meta_key 中的配置, 这些配置决定了 hash 索引值和每个 filter 的大小
+        """
+        meta_config = dict(
+            hash_strategy=self.hash_strategy,
+            scalable=int(bool(self.scalable)),
+            canonicalize_url=int(bool(self.canonicalize_url)),
+        )
+        if self.scalable:
+            meta_config.update(growth_ratio=self.growth_ratio, tightening_ratio=self.tightening_ratio)
+        return meta_config
+
+    def _check_meta_config(self, meta):
+        """
+        不同的 hash 方式 或 filter 大小计算得到的索引值不同, 同一组 filter key 只能使用一种配置
+        旧版本中没有记录这些配置, 使用的是 seeds, 不是可扩展布隆过滤器, 也不规范化 url
+        """
+        saved_config = dict(hash_strategy='seeds', scalable='0', canonicalize_url='0')
+        saved_config.update({_k.decode('utf-8'): _v.decode('utf-8') for _k, _v in meta.items()})
+        for _key, _value in self._get_meta_config().items():
+            if str(_value) != saved_config.get(_key):
+                raise Exception(
+                    '{} <{}> does not match {} <{}> saved in redis key: {}'.format(
+                        _key, _value, _key, saved_config.get(_key), self.redis_meta_key)
+                )
+
+    def _get_legacy_init_params(self):
+        """
+        旧版本中 filter key 形如 bf_url_1, bf_url_2, 数据量保存在 redis_count_key 中
+        使用 EXISTS 从 {base}_1 开始依次检测 filter key 是否存在, 以避免使用 KEYS 命令, 且按数字顺序排列
+        """
+        _filter_list = []
+        while self.redis_cli.exists('{}_{}'.format(self.redis_filter_key_base, len(_filter_list) + 1)):
+            _filter_list.append('{}_{}'.format(self.redis_filter_key_base, len(_filter_list) + 1))
+        if not _filter_list:
+            _filter_list = ['{}_1'.format(self.redis_filter_key_base)]
+
+        _data_saved = self.redis_cli.get(self.redis_count_key)
+        _data_saved = int(_data_saved.decode('utf-8')) if _data_saved else 0
+        return _filter_list, _data_saved
+
+    def _cal_max_data_size(self, bit_num, error_rate_threshold):
         """
         计算在给定的 p, m, k 时, 一个 filter 能够保存的最大数据量 n
         既然已经有了 data_size_per_filter, 为什么还要再计算 max_data_size 呢?
@@ -169,21 +419,41 @@ class BloomFilterRedis(object):
         n = ceil(m / (-k / log(1 - exp(log(p) / k))))
         """
         k = self.hash_seeds_num
-        m = self.bit_num
-        p = self.error_rate_threshold
+        m = bit_num
+        p = error_rate_threshold
         n = math.ceil(m / (-k / math.log(1-math.exp(math.log(p) / k))))
         return n
 
+    def _get_filter_params(self, index):
+        """
+        获取第 index 个 filter key (从 0 开始) 的 bit 位长度 和 误判率阈值
+        可扩展布隆过滤器中, filter 的大小按 growth_ratio 增长, 最大为 MAX_BIT_NUM, 误判率阈值按 tightening_ratio 收紧
+        """
+        if not self.scalable:
+            return self.bit_num, self.error_rate_threshold
+        bit_num = min(self.bit_num * self.growth_ratio ** index, self.MAX_BIT_NUM)
+        error_rate_threshold = self.error_rate_threshold * (1 - self.tightening_ratio) * self.tightening_ratio ** index
+        return bit_num, error_rate_threshold
+
+    def _add_filter_capacity(self):
+        """
+        计算新增的 filter 能够保存的最大数据量, 累加到 _capacity_list 中
+        """
+        bit_num, error_rate_threshold = self._get_filter_params(len(self._capacity_list))
+        capacity = self._cal_max_data_size(bit_num, error_rate_threshold)
+        self._capacity_list.append((self._capacity_list[-1] if self._capacity_list else 0) + capacity)
+
+    def _get_filter_bit_num(self, index):
+        """
+        获取第 index 个 filter key (从 0 开始) 的 bit 位长度
+        """
+        return self._get_filter_params(index)[0]
+
     def _safe_data(self, data):
         """
-        把传入的 data 转换为 str 类型
+        把传入的 data 转换为 bytes, 见 data_utils.safe_data
         """
-        if not isinstance(data, str):
-            try:
-                data = str(data)
-            except:
-                raise Exception('data type must be str or can be converted to str')
-        return data
+        return safe_data(data, self.canonicalize_url)
 
     def get_hash_seeds(self):
         """
@@ -193,26 +463,165 @@ class BloomFilterRedis(object):
         _seeds = [_i for _i in range(1, self.hash_seeds_num + 1)]
         return _seeds
 
-    def get_hash_indexes(self, data):
+    def _get_hashes(self, data):
         """
-        计算一个给定的数据 data 使用所有的 hash_seeds_list 得到的在 bitarray 中的索引值
+        计算一个给定的数据 data 的 hash 值, 与 filter 的大小无关, 同一个数据在所有 filter 中只需要计算一次
         """
-        # 把 str 数据转换为 bytes
+        # 把数据转换为 bytes, 只转换一次, 而不是每个 hash 种子 encode 一次
         data = self._safe_data(data)
-        _hash_indexes = [mmh3.hash(data, self._hash_seeds_list[_i]) % self.bit_num for _i in range(self.hash_seeds_num)]
-        return _hash_indexes
+        if self.hash_strategy == "double":
+            # Kirsch-Mitzenmacher double hashing, 只计算一次 128 位的 hash, 拆分为 h1, h2
+            # 与内存型布隆过滤器的计算方式保持一致
+            return mmh3.hash64(data, signed=False)
+        return [mmh3.hash(data, self._hash_seeds_list[_i]) for _i in range(self.hash_seeds_num)]
+
+    def _hashes_to_indexes(self, hashes, bit_num):
+        """
+        把 _get_hashes 得到的 hash 值转换为 bit 位长度为 bit_num 的 filter 中的索引值
+        """
+        if self.hash_strategy == "double":
+            h1, h2 = hashes[0] % bit_num, hashes[1] % bit_num
+            return [(h1 + _i * h2) % bit_num for _i in range(self.hash_seeds_num)]
+        return [_hash % bit_num for _hash in hashes]
 
-    def _check_and_add_new_filter(self):
+    def get_hash_indexes(self, data, bit_num=None):
+        """
+        计算一个给定的数据 data 使用所有的 hash_seeds_list 得到的在 bitarray 中的索引值
+        :param bit_num: filter 的 bit 位长度, 默认为第一个 filter 的长度
+        """
+        return self._hashes_to_indexes(self._get_hashes(data), bit_num or self.bit_num)
+
+    def get_hash_indexes_many(self, data_list, bit_num=None):
+        """
+        批量计算 data_list 中所有数据的 hash 索引值, 返回列表, 每个元素是一个数据的所有索引值
+        """
+        return [self.get_hash_indexes(_data, bit_num) for _data in data_list]
+
+    def _add_new_filter_if_full(self):
         """
         检查 redis 中保存的 所有数据量 是否大于 总的 data_size, 如果大于, 就增加一个新的过滤器,
         即增加一个 redis_filter_key, 并在 _filter_list 中添加新增的 redis_filter_key
         add 数据时, 只需要向列表中最后一个元素代表的 redis_key 中添加就可以了
+        只修改本地的 _filter_list, 返回是否增加了新的 filter, 由调用者使用 LUA_EXTEND_FILTERS 写入 redis_meta_key 中
+        """
+        if self.data_saved < self._capacity_list[-1]:
+            return False
+        logger.warning('max data_size reached, add one more filter. data_size: {}'.format(self.data_saved))
+        if self.metrics is not None:
+            self.metrics.inc_filters_added()
+        _redis_filter_new = "{}_{}".format(self.redis_filter_key_base, len(self._filter_list) + 1)
+        self._filter_list.append(_redis_filter_new)
+        self._add_filter_capacity()
+        return True
+
+    def _check_and_add_new_filter(self, pipe=None):
+        """
+        增加新的 filter 时, 使用 LUA_EXTEND_FILTERS 把 _filter_list 写入 redis_meta_key 中,
+        redis_meta_key 中的 filters 只增不减, 过时的节点不会覆盖其它节点增加的 filter
+        :param pipe: 传入 pipeline 时, 只把 EVAL 命令添加到 pipeline 中, 与其它命令一起发送,
+            其它节点增加的 filter 在下一次 exists 时更新; 否则立即执行, 并使用返回的 filters 更新 _filter_list
+        """
+        if not self._add_new_filter_if_full():
+            return
+        if pipe is not None:
+            pipe.eval(*self._get_extend_filters_args())
+        else:
+            self._sync_filter_list(self.redis_cli.eval(*self._get_extend_filters_args()))
+
+    def _queue_add(self, pipe, hashes):
         """
-        if self.data_saved >= self.max_data_size * len(self._filter_list):
-            print('max data_size reached, add one more filter. data_size: {}'.format(self.data_saved))
-            _redis_filter_new = "{}_{}".format(self.redis_filter_key_base, len(self._filter_list) + 1)
-            self._filter_list.append(_redis_filter_new)
+        把添加一个数据的 setbit 和 hincrby 命令添加到 pipeline 中, 同步和异步的客户端共用
+        """
+        self._check_and_add_new_filter(pipe)
+        _bit_num = self._get_filter_bit_num(len(self._filter_list) - 1)
+        for _hash_index in self._hashes_to_indexes(hashes, _bit_num):
+            pipe.setbit(self._filter_list[-1], _hash_index, 1)
+        # 把 redis 中保存的数据量 加1, 并使用 hincrby 的返回值更新 data_saved, 以同步其它节点添加的数据量
+        pipe.hincrby(self.redis_meta_key, 'count', 1)
+
+    def _get_add_if_absent_params(self, hashes):
+        """
+        获取 LUA_ADD_IF_ABSENT 的 keys 和 args, 同步和异步的客户端共用
+        """
+        _args = []
+        for _i in range(len(self._filter_list)):
+            _args.extend(self._hashes_to_indexes(hashes, self._get_filter_bit_num(_i)))
+        return self._filter_list + [self.redis_meta_key], _args
+
+    def _queue_add_many(self, pipe, hashes_list):
+        """
+        把批量添加数据的 BITFIELD SET 和 hincrby 命令添加到 pipeline 中, 同步和异步的客户端共用
+        添加之前按照当前 filter 剩余的容量对数据进行分块, 以保证每个 filter 中保存的数据量不超过其最大数据量
+        """
+        _data_saved = self.data_saved
+        _start = 0
+        while _start < len(hashes_list):
+            # 与 _check_and_add_new_filter 相同, 使用添加本块之前的数据量来判断是否需要增加新的 filter
+            # 本节点的 _filter_list 过时时, 其它节点保存的数据可能已经超过了下一个 filter 的容量, 需要一直增加到有剩余容量为止
+            # filter key 的名称是确定的, 本地增加的 filter 与其它节点增加的相同, LUA_EXTEND_FILTERS 只增不减
+            self.data_saved = _data_saved
+            _added = False
+            while self._add_new_filter_if_full():
+                _added = True
+            if _added:
+                pipe.eval(*self._get_extend_filters_args())
+            # 当前 filter 中还能保存的数据量, 上面的循环保证大于 0
+            _capacity = max(self._capacity_list[-1] - _data_saved, 0)
+            _chunk = hashes_list[_start:_start + _capacity]
+            _bit_num = self._get_filter_bit_num(len(self._filter_list) - 1)
+
+            _args = []
+            for _hashes in _chunk:
+                for _hash_index in self._hashes_to_indexes(_hashes, _bit_num):
+                    _args.extend(['SET', 'u1', _hash_index, 1])
+            pipe.execute_command('BITFIELD', self._filter_list[-1], *_args)
+
+            _data_saved += len(_chunk)
+            _start += len(_chunk)
+
+        pipe.hincrby(self.redis_meta_key, 'count', len(hashes_list))
+
+    def _queue_exists_many(self, pipe, hashes_list):
+        """
+        把批量判断数据的 BITFIELD GET 命令添加到 pipeline 中, 每个 filter 一条命令, 同步和异步的客户端共用
+        最后读取 redis_meta_key 中的 filters, 以发现其它节点增加的 filter
+        """
+        for _i, _filter in enumerate(self._filter_list):
+            # 可扩展布隆过滤器中每个 filter 的大小不同, 需要分别计算索引值
+            _bit_num = self._get_filter_bit_num(_i)
+            _args = []
+            for _hashes in hashes_list:
+                for _hash_index in self._hashes_to_indexes(_hashes, _bit_num):
+                    _args.extend(['GET', 'u1', _hash_index])
+            pipe.execute_command('BITFIELD', _filter, *_args)
+        pipe.hget(self.redis_meta_key, 'filters')
+
+    def _parse_exists_many(self, bits_list, data_num):
+        """
+        解析 _queue_exists_many 中所有 BITFIELD GET 命令的结果
+        只要数据在某一个 _filter 中所有的 bit 位都为 1, 就认为数据已经存在
+        """
+        k = self.hash_seeds_num
+        return [
+            any(all(_bits[_i * k:(_i + 1) * k]) for _bits in bits_list)
+            for _i in range(data_num)
+        ]
 
+    def _get_absent_data(self, data_list, mask):
+        """
+        add_if_absent_many 中, 把本批次中重复出现的数据在 mask 中标记为已经存在, 返回需要添加的数据
+        """
+        _absent = set()
+        for _i, _data in enumerate(data_list):
+            if mask[_i]:
+                continue
+            if _data in _absent:
+                mask[_i] = True
+            else:
+                _absent.add(_data)
+        return [_data for _i, _data in enumerate(data_list) if not mask[_i]]
+
+    @record_metrics('add')
     def add(self, data):
         """
         redis 版布隆过滤器不需要初始化 bitmap/bitarray, 只需要用 setbit 把 redis 的 key 中某个 index 处的值置为 1 即可
@@ -222,15 +631,84 @@ class BloomFilterRedis(object):
 
         # 在每次向 bloom_filter 中添加数据时, 都先判断一下 已经保存的数据量,
         # 如果 已保存数据量 达到 每个 filter 所能保存的最大值, 就增加一个新的 filter
+        # 所有的 setbit 和 incr 使用一个 pipeline 发送, 只需要一次往返
+        pipe = self.redis_cli.pipeline(transaction=False)
+        self._queue_add(pipe, self._get_hashes(data))
+        self.data_saved = pipe.execute()[-1]
+
+    @record_metrics('add_if_absent')
+    def add_if_absent(self, data):
+        """
+        在 redis 服务端原子的 判断数据是否存在, 如果不存在就添加
+        判断和添加在同一个 lua 脚本中执行, 只需要一次往返, 多个节点之间也不会出现竞争
+        :param data: 要判断并添加的数据
+        :return: 数据在添加之前是否已经存在
+        """
         self._check_and_add_new_filter()
 
-        # get_hash_indexes 获取所有 hash 种子对应的 hash 索引值 / offset 值
-        for _hash_index in self.get_hash_indexes(data):
-            self.redis_cli.setbit(self._filter_list[-1], _hash_index, 1)
+        hashes = self._get_hashes(data)
+        while True:
+            _keys, _args = self._get_add_if_absent_params(hashes)
+            is_exists, result = self._add_if_absent_script(keys=_keys, args=_args)
+            if is_exists != -1:
+                self.data_saved = result
+                return bool(is_exists)
+            # 其它节点增加了 filter, 更新 _filter_list 之后重试
+            self._sync_filter_list(result)
+
+    @record_metrics('add_many')
+    def add_many(self, data_list):
+        """
+        向布隆过滤器中批量添加数据
+        每个 filter 使用一条 BITFIELD SET 命令设置这一批数据的所有 bit 位, 所有命令和 INCRBY 使用一个 pipeline 发送,
+        一批数据只需要一次往返
+        添加之前按照当前 filter 剩余的容量对数据进行分块, 以保证每个 filter 中保存的数据量不超过其最大数据量
+        :param data_list: 要添加的数据, 可以是任意可迭代对象
+        """
+        hashes_list = [self._get_hashes(_data) for _data in data_list]
+        if not hashes_list:
+            return
 
-        # 把 data_saved 的值 加1, 同时, 把 redis 中保存 数据量的键的值 加1
-        self.data_saved += 1
-        self.redis_cli.incr(self.redis_count_key)
+        pipe = self.redis_cli.pipeline(transaction=False)
+        self._queue_add_many(pipe, hashes_list)
+        self.data_saved = pipe.execute()[-1]
+
+    @record_metrics('exists_many')
+    def exists_many(self, data_list):
+        """
+        批量检测数据是否存在于布隆过滤器中
+        每个 filter 使用一条 BITFIELD GET 命令读取这一批数据的所有 bit 位, 所有命令使用一个 pipeline 发送,
+        一批数据只需要一次往返
+        :param data_list: 要检测的数据, 可以是任意可迭代对象
+        :return: 与 data_list 等长的 bool 列表, True 表示数据已经存在
+        """
+        hashes_list = [self._get_hashes(_data) for _data in data_list]
+        if not hashes_list:
+            return []
+
+        while True:
+            pipe = self.redis_cli.pipeline(transaction=False)
+            self._queue_exists_many(pipe, hashes_list)
+            results = pipe.execute()
+            # 其它节点增加了 filter 时, 更新 _filter_list 之后重新判断
+            if not self._sync_filter_list(results[-1]):
+                return self._parse_exists_many(results[:-1], len(hashes_list))
+
+    @record_metrics('add_if_absent_many')
+    def add_if_absent_many(self, data_list):
+        """
+        批量检测数据是否存在, 并把不存在的数据添加到布隆过滤器中
+        同一批数据中重复出现的数据, 只有第一次出现时被认为是不存在的
+        注意: 判断和添加分为 exists_many 和 add_many 两次往返, 不是原子操作,
+        需要多个节点之间严格不重复时, 使用 add_if_absent
+        :param data_list: 要检测并添加的数据, 可以是任意可迭代对象
+        :return: 与 data_list 等长的 bool 列表, True 表示数据在添加之前已经存在
+        """
+        data_list = [self._safe_data(_data) for _data in data_list]
+        mask = self.exists_many(data_list)
+        # 本批次中重复出现的数据, 标记为已经存在
+        self.add_many(self._get_absent_data(data_list, mask))
+        return mask
 
     def _is_exists_in_certain_filter(self, data, _filter):
         """
@@ -239,8 +717,8 @@ class BloomFilterRedis(object):
         只要有一个 hash 种子计算得到的 index 不在 _filter 中, 就说明这个 data 绝对不存在
         如果所有 hash 种子计算得到的 index 在 _filter 中都存在, 在一定的误判率下, 就认为这个 data 存在
         """
-        # 获取所有 hash 种子计算得到的 索引值
-        hash_indexes = self.get_hash_indexes(data)
+        # 获取所有 hash 种子计算得到的 索引值, 不同大小的 filter 中索引值不同
+        hash_indexes = self.get_hash_indexes(data, self._get_filter_bit_num(self._filter_list.index(_filter)))
         # 对所有的索引值进行过滤
         for _hash_index in hash_indexes:
             # 只要有一个 _hash_index 为 0, 就肯定不存在, 就返回 False
@@ -249,19 +727,141 @@ class BloomFilterRedis(object):
         # 如果所有的循环都完整的执行下来没有退出, 就认为值已经存在了
         return True
 
+    @record_metrics('exists')
     def exists(self, data):
         """
         对 _filter_list 中所有的 _filter 进行遍历,
         检测数据是否在某一个 _filter 中存在
         """
-        for _filter in self._filter_list:
-            _is_exists = self._is_exists_in_certain_filter(data, _filter)
+        # hash 值只需要计算一次, 所有 _filter 的 getbit 使用一个 pipeline 发送, 只需要一次往返
+        hashes = self._get_hashes(data)
+        while True:
+            pipe = self.redis_cli.pipeline(transaction=False)
+            self._queue_exists(pipe, hashes)
+            results = pipe.execute()
+            # 其它节点增加了 filter 时, 更新 _filter_list 之后重新判断
+            if not self._sync_filter_list(results[-1]):
+                return self._parse_exists(results[:-1])
+
+    def _queue_exists(self, pipe, hashes):
+        """
+        把判断一个数据的所有 getbit 命令添加到 pipeline 中, 同步和异步的客户端共用
+        最后读取 redis_meta_key 中的 filters, 以发现其它节点增加的 filter
+        """
+        for _i, _filter in enumerate(self._filter_list):
+            for _hash_index in self._hashes_to_indexes(hashes, self._get_filter_bit_num(_i)):
+                pipe.getbit(_filter, _hash_index)
+        pipe.hget(self.redis_meta_key, 'filters')
+
+    def _parse_exists(self, bits):
+        """
+        解析 _queue_exists 中所有 getbit 命令的结果
+        """
+        for _i in range(len(self._filter_list)):
             # 只要有一个 数据在某一个 _filter 中存在, 就返回 True
-            if _is_exists:
+            if all(bits[_i * self.hash_seeds_num:(_i + 1) * self.hash_seeds_num]):
                 return True
         # 如果 _filter_list 中所有的 _filter 都检测过, 并且都不存在, 才返回 False
         return False
 
+    def _get_geometry(self):
+        """
+        决定 hash 索引值和每个 filter key 大小的配置, 只有这些配置都相同的过滤器才能合并
+        """
+        return dict(
+            bit_num=self.bit_num,
+            hash_seeds_num=self.hash_seeds_num,
+            **{_k: str(_v) for _k, _v in self._get_meta_config().items()}
+        )
+
+    def _is_same_server(self, other):
+        """
+        other 是否与本过滤器使用同一个 redis 实例的同一个 db, 只有此时才能直接使用 BITOP
+        """
+        _kwargs = getattr(getattr(self.redis_cli, 'connection_pool', None), 'connection_kwargs', None)
+        _other_kwargs = getattr(getattr(other.redis_cli, 'connection_pool', None), 'connection_kwargs', None)
+        if _kwargs is None or _other_kwargs is None:
+            return False
+        return all(_kwargs.get(_k) == _other_kwargs.get(_k) for _k in ('host', 'port', 'path', 'db'))
+
+    def _copy_filter_key(self, other, src_key, dest_key):
+        """
+        把另一个 redis 实例中的 filter key 按 MERGE_CHUNK_SIZE 分块复制到本实例中, 以免一次读取 512MB 的 key
+        """
+        _length = other.redis_cli.strlen(src_key)
+        self.redis_cli.delete(dest_key)
+        for _start in range(0, _length, self.MERGE_CHUNK_SIZE):
+            self.redis_cli.setrange(dest_key, _start, other.redis_cli.getrange(src_key, _start, _start + self.MERGE_CHUNK_SIZE - 1))
+
+    def merge(self, other):
+        """
+        把另一个相同配置的 redis 布隆过滤器合并到本过滤器中, 合并后的过滤器包含两者的所有数据
+        - 第 i 个 filter key 与 other 的第 i 个 filter key 使用 BITOP OR 合并, other 中多出的 filter key 合并到新增的 filter key 中
+        - other 在另一个 redis 实例中时, 先分块复制到本实例的临时 key 中, 再使用 BITOP OR
+        - 元数据中的 count 加上 other 的数据量, 两者中相同的数据会被计算两次, 是实际数据量的上限
+        - BITOP 和 bit 位的按位或都是幂等的, 合并时其它节点可以继续添加数据, 合并中断后可以重新执行
+        - redis cluster 中 BITOP 的所有 key 必须在同一个 hash slot 中, 需要使用相同的 hash tag
+        :param other: 要合并的 BloomFilterRedis, 不会被修改
+        :return: self
+        """
+        if self._get_geometry() != other._get_geometry():
+            raise ValueError('can not merge bloom filters with different geometry: {} and {}'.format(
+                self._get_geometry(), other._get_geometry()))
+        # 重新读取两者的元数据, 以包含其它节点新增的 filter key
+        self._get_init_params()
+        other._get_init_params()
+        is_same_server = self._is_same_server(other)
+
+        for _i, _src_key in enumerate(other._filter_list):
+            if _i >= len(self._filter_list):
+                self._filter_list.append("{}_{}".format(self.redis_filter_key_base, len(self._filter_list) + 1))
+                self._add_filter_capacity()
+            _dest_key = self._filter_list[_i]
+            if is_same_server:
+                self.redis_cli.bitop('OR', _dest_key, _dest_key, _src_key)
+                continue
+            _tmp_key = '{}_merge_tmp'.format(_dest_key)
+            self._copy_filter_key(other, _src_key, _tmp_key)
+            self.redis_cli.bitop('OR', _dest_key, _dest_key, _tmp_key)
+            self.redis_cli.delete(_tmp_key)
+
+        pipe = self.redis_cli.pipeline(transaction=False)
+        pipe.eval(*self._get_extend_filters_args())
+        pipe.hincrby(self.redis_meta_key, 'count', other.data_saved)
+        filters, self.data_saved = pipe.execute()
+        self._sync_filter_list(filters)
+        return self
+
+    def _queue_fill_ratios(self, pipe):
+        """
+        把统计每个 filter key 中值为 1 的 bit 位数量的 BITCOUNT 命令添加到 pipeline 中, 同步和异步的客户端共用
+        """
+        for _filter in self._filter_list:
+            pipe.bitcount(_filter)
+
+    def _parse_fill_ratios(self, counts):
+        """
+        把 BITCOUNT 的结果转换为每个 filter 的填充率
+        """
+        return [_count / self._get_filter_bit_num(_i) for _i, _count in enumerate(counts)]
+
+    def get_fill_ratios(self):
+        """
+        每个 filter key 中值为 1 的 bit 位的比例
+        注意: BITCOUNT 的时间复杂度为 O(N), 500MB 的 key 需要数十毫秒, 期间会阻塞 redis, 不要频繁调用
+        """
+        pipe = self.redis_cli.pipeline(transaction=False)
+        self._queue_fill_ratios(pipe)
+        return self._parse_fill_ratios(pipe.execute())
+
+    def get_metrics(self, fill_ratio=True):
+        """
+        获取过滤器的监控指标, 见 bloom_filter_metrics.get_filter_metrics
+        调用次数, 命中数量和延迟只包含本节点的操作, data_saved 和填充率包含所有节点添加的数据
+        :param fill_ratio: 是否使用 BITCOUNT 计算填充率和估算的误判率
+        """
+        return get_filter_metrics(self, self.get_fill_ratios() if fill_ratio else None)
+
     def __len__(self):
         """"
         返回现有数据容量
@@ -291,8 +891,8 @@ def main_multi_filter():
     # url 去重的 redis key 配置信息
     redis_key_config_url = dict(
         bloom_filter_key='bf_url',
+        redis_meta_key='bf_url_meta',
         redis_count_key='bf_count_url',
-        redis_lock_key='bf_lock_url',
     )
 
     # 以下面的参数, 每个 filter 中可以保存 42 个数据
@@ -332,8 +932,8 @@ def main_multi_filter():
     # title 去重的 redis key 配置信息
     redis_key_config_title = dict(
         bloom_filter_key='bf_title',
+        redis_meta_key='bf_title_meta',
         redis_count_key='bf_count_title',
-        redis_lock_key='bf_lock_title',
     )
 
     # 以下面的参数, 每个 filter 中可以保存 42 个数据
@@ -381,8 +981,8 @@ def main_scrapy_single_node():
     # url 去重的 redis key 配置信息
     redis_key_config_url = dict(
         bloom_filter_key='bf_url',
+        redis_meta_key='bf_url_meta',
         redis_count_key='bf_count_url',
-        redis_lock_key='bf_lock_url',
     )
 
     # 布隆过滤器 参数 配置信息
@@ -422,8 +1022,8 @@ def main_scrapy_single_node():
     # title 去重的 redis key 配置信息
     redis_key_config_title = dict(
         bloom_filter_key='bf_title',
+        redis_meta_key='bf_title_meta',
         redis_count_key='bf_count_title',
-        redis_lock_key='bf_lock_title',
     )
 
     # 布隆过滤器 参数 配置信息
@@ -455,7 +1055,57 @@ def main_scrapy_single_node():
     print('is where in bloom_filter: ', 'where' in bf_title)
 
 
+def main_benchmark_batch():
+    """
+    对比不同 batch_size 时 exists_many/add_many 的吞吐量, 需要本地运行 redis-server
+    使用单独的 db 15, 不影响 db 0 中其它过滤器的 key 和 bloom_filter_count, db 15 中已经有其它 key 时不运行
+    注意: 测试前后会删除 bf_bench 相关的 key
+    """
+    import time
+    redis_db_config = dict(
+        host='127.0.0.1',
+        port=6379,
+        db=15,
+        password=None,
+    )
+    redis_key_config = dict(
+        bloom_filter_key='bf_bench',
+        redis_meta_key='bf_bench_meta',
+        redis_count_key='bf_bench_count',
+    )
+    other_keys = [_key for _key in RedisConn(redis_db_config).get_redis_cli().keys('*') if not _key.startswith(b'bf_bench')]
+    if other_keys:
+        raise Exception('db {} is not empty, please use another db for benchmark. keys: {}'.format(
+            redis_db_config['db'], sorted(other_keys)[:10]))
+    bf_config = dict(
+        data_size_per_key=14 * 10 ** 7,
+        memory_size=500,
+        hash_seeds_num=8,
+        error_rate_threshold=1e-5,
+    )
+    data_size = 10 ** 5
+
+    for batch_size in (1, 100, 10 ** 4):
+        bf = BloomFilterRedis(redis_db_config, redis_key_config, bf_config)
+        bf.redis_cli.delete(*bf._filter_list, bf.redis_meta_key)
+        urls = ['https://www.dreamingtech.net/s?kw=python{}'.format(i) for i in range(data_size)]
+
+        start = time.time()
+        for i in range(0, data_size, batch_size):
+            bf.add_many(urls[i:i + batch_size])
+        add_cost = time.time() - start
+        start = time.time()
+        for i in range(0, data_size, batch_size):
+            bf.exists_many(urls[i:i + batch_size])
+        exists_cost = time.time() - start
+
+        print('batch_size: {:>5}, add_many: {:.0f} items/s, exists_many: {:.0f} items/s'.format(
+            batch_size, data_size / add_cost, data_size / exists_cost))
+        bf.redis_cli.delete(*bf._filter_list, bf.redis_meta_key)
+
+
 if __name__ == '__main__':
+    # main_benchmark_batch()
     main_multi_filter()
     # main_scrapy_single_node()
 
@@ -0,0 +1,372 @@
+# -*- coding: utf-8 -*-
+# 按时间窗口轮换的布隆过滤器, 只判断最近一段时间内是否出现过
+# time windowed (rotating) bloom filter
+
+import collections
+import time
+
+from memory_bloom_filter import BloomFilterMemory
+from redis_bloom_filter import BloomFilterRedis
+
+
+class BloomFilterRotating(object):
+    """
+    按时间窗口轮换的布隆过滤器的基类
+    - 把时间窗口 window_seconds 平均分为 bucket_num 个时间桶, 每个时间桶使用一个独立的布隆过滤器,
+      时间桶的编号为 int(当前时间 / 每个时间桶的秒数)
+    - 数据只添加到当前时间桶中, 判断时对最近 bucket_num 个时间桶进行判断,
+      超过时间窗口的时间桶会被删除, 其中的数据可以被重新抓取
+    - 时间窗口的精度为一个时间桶, 一个数据在添加之后的 window_seconds - window_seconds / bucket_num 到 window_seconds 秒内过期
+    - 子类需要实现 _new_bucket 和 _drop_bucket, 可以重写 _exists_many_in_buckets, _add_if_absent_to_bucket 和 _on_added
+    """
+
+    def __init__(self, window_seconds, bucket_num=6):
+        """
+        :param window_seconds: 时间窗口的秒数, 只判断数据在最近 window_seconds 秒内是否出现过
+        :param bucket_num: 时间桶的数量, 数量越多, 过期时间越精确, 但判断时需要判断的过滤器也越多
+        """
+        if not (isinstance(bucket_num, int) and bucket_num > 0):
+            raise ValueError("bucket_num must be integer and greater than 0")
+        if not window_seconds > 0:
+            raise ValueError("window_seconds must be greater than 0")
+        self.window_seconds = window_seconds
+        self.bucket_num = bucket_num
+        self.bucket_seconds = window_seconds / bucket_num
+        # 时间桶编号 -> 布隆过滤器, 按时间桶编号升序排列
+        self._bucket_dict = collections.OrderedDict()
+
+    def _get_bucket_id(self):
+        """
+        获取当前时间所在的时间桶编号
+        """
+        return int(time.time() // self.bucket_seconds)
+
+    def _new_bucket(self, bucket_id):
+        """
+        创建或连接第 bucket_id 个时间桶对应的布隆过滤器
+        """
+        raise NotImplementedError
+
+    def _drop_bucket(self, bucket_id, bucket):
+        """
+        删除过期的时间桶
+        """
+        raise NotImplementedError
+
+    def _on_added(self, bucket_id, bucket):
+        """
+        向第 bucket_id 个时间桶中添加数据之后调用
+        """
+
+    def _rotate(self):
+        """
+        删除超过时间窗口的时间桶, 并返回当前时间桶的编号
+        """
+        bucket_id = self._get_bucket_id()
+        for _bucket_id in list(self._bucket_dict):
+            if _bucket_id > bucket_id - self.bucket_num:
+                break
+            self._drop_bucket(_bucket_id, self._bucket_dict.pop(_bucket_id))
+        return bucket_id
+
+    def _get_bucket(self, bucket_id):
+        """
+        获取第 bucket_id 个时间桶对应的布隆过滤器, 不存在时创建
+        """
+        if bucket_id not in self._bucket_dict:
+            self._bucket_dict[bucket_id] = self._new_bucket(bucket_id)
+            # 保证 _bucket_dict 按时间桶编号升序排列, 以便 _rotate 从最旧的时间桶开始删除
+            for _bucket_id in sorted(self._bucket_dict):
+                self._bucket_dict.move_to_end(_bucket_id)
+        return self._bucket_dict[bucket_id]
+
+    def _get_buckets(self):
+        """
+        获取时间窗口内所有已经创建的时间桶对应的布隆过滤器, 从最新的时间桶开始
+        """
+        self._rotate()
+        return list(reversed(self._bucket_dict.values()))
+
+    def _get_previous_buckets(self, bucket_id):
+        """
+        获取时间窗口内除第 bucket_id 个 (当前) 时间桶以外的所有时间桶对应的布隆过滤器, 从最新的时间桶开始
+        """
+        bucket = self._bucket_dict.get(bucket_id)
+        return [_bucket for _bucket in self._get_buckets() if _bucket is not bucket]
+
+    def _exists_many_in_buckets(self, buckets, data_list):
+        """
+        批量判断数据是否在 buckets 中的某一个时间桶中出现过, 已经找到的数据不再对之后的时间桶进行判断
+        :return: 与 data_list 等长的 bool 列表
+        """
+        mask = [False] * len(data_list)
+        for _bucket in buckets:
+            _not_found = [_i for _i in range(len(data_list)) if not mask[_i]]
+            if not _not_found:
+                break
+            for _i, _is_exists in zip(_not_found, _bucket.exists_many([data_list[_i] for _i in _not_found])):
+                mask[_i] = bool(_is_exists)
+        return mask
+
+    def _add_if_absent_to_bucket(self, bucket, data):
+        """
+        判断数据是否在当前时间桶中, 如果不在就添加
+        """
+        return bucket.add_if_absent_many([data])[0]
+
+    def add(self, data):
+        """
+        把数据添加到当前时间桶中
+        """
+        bucket_id = self._rotate()
+        bucket = self._get_bucket(bucket_id)
+        bucket.add(data)
+        self._on_added(bucket_id, bucket)
+
+    def add_many(self, data_list):
+        """
+        把数据批量添加到当前时间桶中
+        """
+        bucket_id = self._rotate()
+        bucket = self._get_bucket(bucket_id)
+        bucket.add_many(data_list)
+        self._on_added(bucket_id, bucket)
+
+    def add_if_absent(self, data):
+        """
+        判断数据在时间窗口内是否出现过, 如果没有出现过就添加到当前时间桶中
+        :return: 数据在添加之前是否已经存在
+        """
+        bucket_id = self._rotate()
+        bucket = self._get_bucket(bucket_id)
+        # 先对之前的时间桶进行判断, 已经存在的数据不再添加到当前时间桶中, 以免数据的过期时间被不断延长
+        if self._exists_many_in_buckets(self._get_previous_buckets(bucket_id), [data])[0]:
+            return True
+        is_exists = self._add_if_absent_to_bucket(bucket, data)
+        self._on_added(bucket_id, bucket)
+        return bool(is_exists)
+
+    def add_if_absent_many(self, data_list):
+        """
+        批量判断数据在时间窗口内是否出现过, 并把没有出现过的数据添加到当前时间桶中
+        :return: 与 data_list 等长的 bool 列表, True 表示数据在添加之前已经存在
+        """
+        data_list = list(data_list)
+        bucket_id = self._rotate()
+        bucket = self._get_bucket(bucket_id)
+        # 先对之前的时间桶进行判断, 已经存在的数据不再添加到当前时间桶中, 以免数据的过期时间被不断延长
+        mask = self._exists_many_in_buckets(self._get_previous_buckets(bucket_id), data_list)
+        # 当前时间桶使用 add_if_absent_many 判断并添加, 同时处理本批次中重复出现的数据
+        _not_found = [_i for _i in range(len(data_list)) if not mask[_i]]
+        if _not_found:
+            for _i, _is_exists in zip(_not_found, bucket.add_if_absent_many([data_list[_i] for _i in _not_found])):
+                mask[_i] = bool(_is_exists)
+            self._on_added(bucket_id, bucket)
+        return mask
+
+    def exists(self, data):
+        """
+        判断数据在时间窗口内是否出现过
+        """
+        return self._exists_many_in_buckets(self._get_buckets(), [data])[0]
+
+    def exists_many(self, data_list):
+        """
+        批量判断数据在时间窗口内是否出现过
+        :return: 与 data_list 等长的 bool 列表
+        """
+        return self._exists_many_in_buckets(self._get_buckets(), list(data_list))
+
+    def __len__(self):
+        """
+        返回时间窗口内所有时间桶中保存的数据量之和, 同一个数据在多个时间桶中出现时会被重复计算
+        """
+        return sum(len(_bucket) for _bucket in self._get_buckets())
+
+    def __contains__(self, data):
+        """
+        用于实现 in 判断
+        """
+        return self.exists(data)
+
+
+class BloomFilterRotatingMemory(BloomFilterRotating):
+    """
+    按时间窗口轮换的内存型布隆过滤器
+    每个时间桶都是一个 BloomFilterMemory, 最多同时占用 bucket_num 倍的内存, 过期的时间桶直接释放
+    """
+
+    def __init__(self, bf_config, window_seconds, bucket_num=6):
+        """
+        :param bf_config: 每个时间桶使用的 bloom filter 配置信息, 与 BloomFilterMemory 相同,
+            data_size_per_filter 为每个时间桶中期望保存的数据量
+        :param window_seconds: 时间窗口的秒数
+        :param bucket_num: 时间桶的数量
+        """
+        super().__init__(window_seconds, bucket_num)
+        self.bf_config = dict(bf_config)
+        # 创建当前时间桶, 同时检查配置信息, 以免在添加数据时才报错
+        self._get_bucket(self._rotate())
+
+    def _new_bucket(self, bucket_id):
+        return BloomFilterMemory(self.bf_config)
+
+    def _drop_bucket(self, bucket_id, bucket):
+        pass
+
+
+class BloomFilterRotatingRedis(BloomFilterRotating):
+    """
+    按时间窗口轮换的 redis 型布隆过滤器
+    - 每个时间桶都是一个 BloomFilterRedis, bloom_filter_key 为 {bloom_filter_key}_{时间桶编号},
+      filter key 为 {bloom_filter_key}_{时间桶编号}_1 ..., 元数据 hash key 为 {bloom_filter_key}_{时间桶编号}_meta
+    - 时间桶编号由时间计算得到, 所有节点使用的时间桶相同, 节点之间的时间差应远小于一个时间桶的秒数
+    - 时间桶中所有的 key 都使用 EXPIREAT 设置为在时间窗口结束时过期, 由 redis 自动删除, 不需要任何节点进行清理
+    - 每个时间桶的 BloomFilterRedis 只在第一次使用时创建一次, 之后保存在 _bucket_dict 中, 直到离开时间窗口
+    - 判断时所有时间桶的 BITFIELD GET 命令使用一个 pipeline 发送, 只需要一次往返
+    """
+
+    def __init__(self, redis_db_config, redis_key_config, bf_config, window_seconds, bucket_num=6):
+        """
+        :param redis_db_config: redis 数据库的配置信息
+        :param redis_key_config: redis 中保存 bloom filter 内容的 key, 只使用其中的 bloom_filter_key
+        :param bf_config: 每个时间桶使用的 bloom filter 配置信息, 与 BloomFilterRedis 相同
+        :param window_seconds: 时间窗口的秒数
+        :param bucket_num: 时间桶的数量
+        """
+        super().__init__(window_seconds, bucket_num)
+        self.redis_db_config = redis_db_config
+        self.redis_filter_key_base = redis_key_config.get('bloom_filter_key', 'bloom_filter')
+        self.bf_config = dict(bf_config)
+        # 每个时间桶中已经设置了过期时间的 key
+        self._expired_keys = {}
+        # 创建当前时间桶, 同时检查配置信息, 以免在添加数据时才报错
+        self._get_bucket(self._rotate())
+
+    def _new_bucket(self, bucket_id):
+        _key_base = '{}_{}'.format(self.redis_filter_key_base, bucket_id)
+        # 每个时间桶使用独立的 redis_count_key, 以免新的时间桶读取到默认的 bloom_filter_count 中其它过滤器的数据量
+        bucket = BloomFilterRedis(
+            self.redis_db_config,
+            dict(bloom_filter_key=_key_base, redis_meta_key='{}_meta'.format(_key_base),
+                 redis_count_key='{}_count'.format(_key_base)),
+            self.bf_config,
+        )
+        self._expired_keys[bucket_id] = set()
+        self._expire_bucket(bucket_id, bucket)
+        return bucket
+
+    def _drop_bucket(self, bucket_id, bucket):
+        # redis 中的 key 已经自动过期, 只需要删除本地的记录
+        self._expired_keys.pop(bucket_id, None)
+
+    def _expire_bucket(self, bucket_id, bucket):
+        """
+        对时间桶中还没有设置过期时间的 key 设置过期时间, 过期时间为时间桶离开时间窗口的时间
+        filter key 在第一次 setbit 之后才存在, 故每次添加数据之后都要检查是否有新的 key
+        """
+        _keys = set(bucket._filter_list + [bucket.redis_meta_key]) - self._expired_keys[bucket_id]
+        if not _keys:
+            return
+        _expire_at = int((bucket_id + self.bucket_num) * self.bucket_seconds) + 1
+        pipe = bucket.redis_cli.pipeline(transaction=False)
+        for _key in _keys:
+            pipe.expireat(_key, _expire_at)
+        # 只有 key 已经存在时, expireat 才会成功, 不存在的 key 在下次添加数据之后再设置
+        for _key, _is_set in zip(_keys, pipe.execute()):
+            if _is_set:
+                self._expired_keys[bucket_id].add(_key)
+
+    def _on_added(self, bucket_id, bucket):
+        self._expire_bucket(bucket_id, bucket)
+
+    def _add_if_absent_to_bucket(self, bucket, data):
+        """
+        当前时间桶使用 lua 脚本原子的判断并添加, 多个节点同时添加同一个新数据时只有一个节点会返回 False
+        """
+        return bucket.add_if_absent(data)
+
+    def _exists_many_in_buckets(self, buckets, data_list):
+        """
+        所有时间桶的 BITFIELD GET 命令使用一个 pipeline 发送, 只需要一次往返
+        所有时间桶的配置相同, hash 值只需要计算一次; 其它节点在某个时间桶中增加了 filter 时, 更新之后重新判断
+        """
+        if not buckets or not data_list:
+            return [False] * len(data_list)
+        hashes_list = [buckets[0]._get_hashes(_data) for _data in data_list]
+        while True:
+            pipe = buckets[0].redis_cli.pipeline(transaction=False)
+            for _bucket in buckets:
+                _bucket._queue_exists_many(pipe, hashes_list)
+            results = pipe.execute()
+
+            masks = []
+            is_synced = False
+            _start = 0
+            for _bucket in buckets:
+                _end = _start + len(_bucket._filter_list)
+                masks.append(_bucket._parse_exists_many(results[_start:_end], len(hashes_list)))
+                is_synced = _bucket._sync_filter_list(results[_end]) or is_synced
+                _start = _end + 1
+            if not is_synced:
+                return [any(_mask[_i] for _mask in masks) for _i in range(len(data_list))]
+
+    def _get_buckets(self):
+        """
+        其它节点可能已经在之前的时间桶中添加了数据, 故判断时需要连接时间窗口内的所有时间桶
+        """
+        bucket_id = self._rotate()
+        return [self._get_bucket(_bucket_id) for _bucket_id in range(bucket_id, bucket_id - self.bucket_num, -1)]
+
+
+def main_rotating_memory():
+    """
+    测试内存型时间窗口布隆过滤器, 时间窗口为 3 秒, 分为 3 个时间桶
+    """
+    bf_config = dict(
+        data_size_per_filter=10 ** 4,
+        memory_size=1,
+        hash_seeds_num=5,
+        error_rate_threshold=1e-6
+    )
+    bf = BloomFilterRotatingMemory(bf_config, window_seconds=3, bucket_num=3)
+
+    bf.add('https://www.dreamingtech.net/')
+    for i in range(5):
+        print('{}s: is url in bloom_filter: {}, bucket num: {}'.format(
+            i, 'https://www.dreamingtech.net/' in bf, len(bf._get_buckets())))
+        time.sleep(1)
+
+
+def main_rotating_redis():
+    """
+    测试 redis 型时间窗口布隆过滤器, 时间窗口为 3 秒, 分为 3 个时间桶
+    时间桶中的 key 会在时间窗口结束后由 redis 自动删除
+    """
+    redis_db_config = dict(
+        host='127.0.0.1',
+        port=6379,
+        db=0,
+        password=None,
+    )
+    redis_key_config = dict(
+        bloom_filter_key='bf_rotating',
+    )
+    bf_config = dict(
+        data_size_per_key=10 ** 4,
+        memory_size=1,
+        hash_seeds_num=5,
+        error_rate_threshold=1e-6,
+    )
+    bf = BloomFilterRotatingRedis(redis_db_config, redis_key_config, bf_config, window_seconds=3, bucket_num=3)
+
+    print('is url added before: {}'.format(bf.add_if_absent('https://www.dreamingtech.net/')))
+    for i in range(5):
+        print('{}s: is url in bloom_filter: {}, keys in redis: {}'.format(
+            i, 'https://www.dreamingtech.net/' in bf, sorted(bf._get_buckets()[0].redis_cli.keys('bf_rotating_*'))))
+        time.sleep(1)
+
+
+if __name__ == '__main__':
+    # main_rotating_redis()
+    main_rotating_memory()
@@ -26,8 +26,8 @@ redis_db_config = dict(
 # url 去重的 redis key 配置信息
 redis_key_config_url = dict(
     bloom_filter_key='bf_url',
+    redis_meta_key='bf_url_meta',
     redis_count_key='bf_count_url',
-    redis_lock_key='bf_lock_url',
 )
 
 # 布隆过滤器 参数 配置信息
@@ -64,11 +64,11 @@ for i in range(50):
         print('url: <{}> added to memory filter, data_size of memory filter: <{}>'.format(url, bf_memory.data_saved))
 
         # 如果 memory filter 中不存在, 再使用 redis filter 进行过滤
-        if bf_redis_url.exists(url):
+        # add_if_absent 在 redis 中原子的完成 判断 和 添加, 多个节点之间不会出现竞争
+        if bf_redis_url.add_if_absent(url):
             print('url: <{}> exists in redis filter'.format(url))
             continue
         else:
-            bf_redis_url.add(url)
             print('url: <{}> added to redis filter, data_size of redis filter: <{}>'.format(url, bf_redis_url.data_saved))
 
     print("添加 url 到 scrapy 中. url: {}".format(url))
@@ -87,11 +87,11 @@ for i in range(100):
         print('url: <{}> added to memory filter, data_size of memory filter: <{}>'.format(url, bf_memory.data_saved))
 
         # 如果 memory filter 中不存在, 再使用 redis filter 进行过滤
-        if bf_redis_url.exists(url):
+        # add_if_absent 在 redis 中原子的完成 判断 和 添加, 多个节点之间不会出现竞争
+        if bf_redis_url.add_if_absent(url):
             print('url: <{}> exists in redis filter'.format(url))
             continue
         else:
-            bf_redis_url.add(url)
             print('url: <{}> added to redis filter, data_size of redis filter: <{}>'.format(url, bf_redis_url.data_saved))
 
     print("添加 url 到 scrapy 中. url: {}".format(url))
@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+# 分片的 redis 布隆过滤器, 按数据的 hash 值把数据分散到多个 redis 实例或 redis cluster 的多个 hash slot 中
+# sharded redis based bloom filter
+
+from concurrent.futures import ThreadPoolExecutor
+
+import mmh3
+
+from redis_bloom_filter import BloomFilterRedis
+
+
+class BloomFilterRedisShard(BloomFilterRedis):
+    """
+    分片布隆过滤器中的一个分片, 与 BloomFilterRedis 相同, 只是在元数据中额外记录分片编号和分片数量,
+    分片数量改变后, 数据对应的分片也会改变, 已经保存的数据就无法再判断了, 所以分片数量与已有的不同时会报错
+    """
+
+    def __init__(self, redis_db_config, redis_key_config, bf_config, shard_index, shard_num):
+        self.shard_index = shard_index
+        self.shard_num = shard_num
+        super().__init__(redis_db_config, redis_key_config, bf_config)
+
+    def _get_meta_config(self):
+        meta_config = super()._get_meta_config()
+        meta_config.update(shard_index=self.shard_index, shard_num=self.shard_num)
+        return meta_config
+
+
+class BloomFilterRedisSharded(object):
+    """
+    分片的 redis 版布隆过滤器
+    - 单个 redis key 最大为 512MB, 单个 redis 实例只能使用一个 cpu 核, 都限制了布隆过滤器的容量和 QPS;
+      分片后每个数据只保存在一个分片中, 容量和 QPS 随分片数量线性增长
+    - 每个分片是一个独立的 BloomFilterRedis, 有自己的 filter key 序列和元数据 hash key, 按 bf_config 自动增加 filter
+    - 数据对应的分片由 mmh3.hash(data, SHARD_HASH_SEED) % shard_num 决定, 与计算 hash 索引值的种子不同, 以免分片和索引值相关
+    - 分片 i 的 bloom_filter_key 为 {bloom_filter_key_i}, filter key 为 {bloom_filter_key_i}_1 ..., 元数据为 {bloom_filter_key_i}_meta,
+      {} 是 redis cluster 的 hash tag, 同一个分片的所有 key 在同一个 hash slot 中, lua 脚本可以在 cluster 中执行,
+      不同的分片分布在不同的 hash slot 中, 由 cluster 分散到不同的节点上
+    - 批量操作按分片对数据进行分组, 使用线程池同时访问所有的分片
+    """
+
+    # 计算分片的 hash 种子, hash_strategy 为 seeds 时使用的种子为 1 ~ hash_seeds_num
+    SHARD_HASH_SEED = 0
+
+    def __init__(self, redis_db_configs, redis_key_config, bf_config, shard_num=None):
+        """
+        :param redis_db_configs: redis 数据库的配置信息
+            - 列表: 每个元素是一个分片的 redis 配置信息, 可以是不同的 redis 实例, 也可以是同一个实例的不同 db
+            - dict: 所有分片使用同一个 redis 配置, 需要传入 shard_num, 一般用于 redis cluster (cluster=True)
+        :param redis_key_config: redis 中保存 bloom filter 内容的 key, 只使用其中的 bloom_filter_key
+        :param bf_config: 每个分片使用的 bloom filter 配置信息, 与 BloomFilterRedis 相同, data_size_per_key 为每个分片中每个 key 的数据量
+        :param shard_num: 分片数量, redis_db_configs 为列表时, 默认为列表的长度
+        """
+        if isinstance(redis_db_configs, dict):
+            if not (isinstance(shard_num, int) and shard_num > 0):
+                raise ValueError("shard_num must be integer and greater than 0 when using one redis_db_config")
+            redis_db_configs = [redis_db_configs] * shard_num
+        if not redis_db_configs:
+            raise ValueError("redis_db_configs must not be empty")
+        if shard_num is not None and shard_num != len(redis_db_configs):
+            raise ValueError("shard_num must be equal to the length of redis_db_configs")
+
+        self.shard_num = len(redis_db_configs)
+        self.redis_filter_key_base = redis_key_config.get('bloom_filter_key', 'bloom_filter')
+
+        self._shard_list = []
+        for _i, _redis_db_config in enumerate(redis_db_configs):
+            _key_base = '{%s_%s}' % (self.redis_filter_key_base, _i)
+            self._shard_list.append(BloomFilterRedisShard(
+                _redis_db_config,
+                dict(
+                    bloom_filter_key=_key_base,
+                    redis_meta_key='{}_meta'.format(_key_base),
+                    # 每个分片使用自己的 count key, 以免从旧版本的 bloom_filter_count 中迁移数据量
+                    redis_count_key='{}_count'.format(_key_base),
+                ),
+                bf_config,
+                shard_index=_i,
+                shard_num=self.shard_num,
+            ))
+
+        # 批量操作时同时访问所有的分片
+        self._executor = ThreadPoolExecutor(max_workers=self.shard_num) if self.shard_num > 1 else None
+
+    def _get_shard_index(self, data):
+        """
+        获取 _safe_data 转换后的数据对应的分片编号
+        """
+        return mmh3.hash(data, self.SHARD_HASH_SEED, signed=False) % self.shard_num
+
+    def _get_shard_and_data(self, data):
+        """
+        把数据转换为 bytes (包括规范化 url), 返回对应的分片和转换后的数据, 分片中不需要再次转换
+        """
+        data = self._shard_list[0]._safe_data(data)
+        return self._shard_list[self._get_shard_index(data)], data
+
+    def get_shard(self, data):
+        """
+        获取数据对应的分片
+        """
+        return self._get_shard_and_data(data)[0]
+
+    def _group_by_shard(self, data_list):
+        """
+        按分片对数据进行分组, 返回 {分片编号: [(数据在 data_list 中的位置, 转换后的数据), ...]}
+        """
+        groups = {}
+        for _i, _data in enumerate(data_list):
+            _data = self._shard_list[0]._safe_data(_data)
+            groups.setdefault(self._get_shard_index(_data), []).append((_i, _data))
+        return groups
+
+    def _map_shards(self, func, data_list):
+        """
+        对每个分片中的数据调用 func(shard, shard_data_list), 多个分片时在线程池中同时执行
+        :return: {分片编号: (数据在 data_list 中的位置列表, func 的返回值)}
+        """
+        groups = self._group_by_shard(data_list)
+
+        def _call(_shard_index):
+            _positions, _shard_data_list = zip(*groups[_shard_index])
+            return _shard_index, (_positions, func(self._shard_list[_shard_index], list(_shard_data_list)))
+
+        if self._executor is None or len(groups) == 1:
+            return dict(_call(_shard_index) for _shard_index in groups)
+        return dict(self._executor.map(_call, groups))
+
+    def _merge_mask(self, results, data_num):
+        """
+        把每个分片返回的 bool 列表按照数据的位置合并为一个列表
+        """
+        mask = [False] * data_num
+        for _positions, _mask in results.values():
+            for _position, _is_exists in zip(_positions, _mask):
+                mask[_position] = _is_exists
+        return mask
+
+    def add(self, data):
+        _shard, data = self._get_shard_and_data(data)
+        _shard.add(data)
+
+    def add_if_absent(self, data):
+        """
+        在数据对应的分片中使用 lua 脚本原子的判断并添加
+        :return: 数据在添加之前是否已经存在
+        """
+        _shard, data = self._get_shard_and_data(data)
+        return _shard.add_if_absent(data)
+
+    def exists(self, data):
+        _shard, data = self._get_shard_and_data(data)
+        return _shard.exists(data)
+
+    def add_many(self, data_list):
+        """
+        向布隆过滤器中批量添加数据, 每个分片一次往返, 所有的分片同时执行
+        """
+        self._map_shards(lambda _shard, _data_list: _shard.add_many(_data_list), list(data_list))
+
+    def exists_many(self, data_list):
+        """
+        批量检测数据是否存在于布隆过滤器中, 每个分片一次往返, 所有的分片同时执行
+        :return: 与 data_list 等长的 bool 列表, True 表示数据已经存在
+        """
+        data_list = list(data_list)
+        results = self._map_shards(lambda _shard, _data_list: _shard.exists_many(_data_list), data_list)
+        return self._merge_mask(results, len(data_list))
+
+    def add_if_absent_many(self, data_list):
+        """
+        批量检测数据是否存在, 并把不存在的数据添加到布隆过滤器中, 与 BloomFilterRedis.add_if_absent_many 相同, 不是原子操作
+        同一个数据总是在同一个分片中, 本批次中重复出现的数据由分片自己处理
+        :return: 与 data_list 等长的 bool 列表, True 表示数据在添加之前已经存在
+        """
+        data_list = list(data_list)
+        results = self._map_shards(lambda _shard, _data_list: _shard.add_if_absent_many(_data_list), data_list)
+        return self._merge_mask(results, len(data_list))
+
+    def get_metrics(self, fill_ratio=True):
+        """
+        获取每个分片的监控指标, 返回 {分片的 bloom_filter_key: 指标}, 可以直接传给 bloom_filter_metrics.format_prometheus
+        """
+        return {_shard.redis_filter_key_base: _shard.get_metrics(fill_ratio) for _shard in self._shard_list}
+
+    def close(self):
+        """
+        关闭线程池
+        """
+        if self._executor is not None:
+            self._executor.shutdown()
+
+    def __len__(self):
+        """
+        所有分片已保存的数据量之和, 每个分片的数据量在本节点最近一次访问该分片时更新
+        """
+        return sum(_shard.data_saved for _shard in self._shard_list)
+
+    def __contains__(self, data):
+        return self.exists(data)
+
+
+def main_sharded():
+    """
+    测试分片布隆过滤器, 两个分片使用本地 redis 的 db 1 和 db 2
+    注意: 测试时需要手动删除 redis 中的所有相关 key
+    """
+    import time
+    redis_db_configs = [
+        dict(host='127.0.0.1', port=6379, db=1, password=None),
+        dict(host='127.0.0.1', port=6379, db=2, password=None),
+    ]
+    redis_key_config = dict(
+        bloom_filter_key='bf_sharded',
+    )
+    bf_config = dict(
+        data_size_per_key=10 ** 6,
+        memory_size=5,
+        hash_seeds_num=7,
+        error_rate_threshold=1e-6,
+        hash_strategy='double',
+    )
+    bf = BloomFilterRedisSharded(redis_db_configs, redis_key_config, bf_config)
+
+    data_size = 10 ** 5
+    batch_size = 1000
+    urls = ['https://www.dreamingtech.net/s?kw=python{}'.format(i) for i in range(data_size)]
+    start = time.time()
+    for _i in range(0, data_size, batch_size):
+        bf.add_if_absent_many(urls[_i:_i + batch_size])
+    cost = time.time() - start
+    print('add_if_absent_many: {:.2f}s, {:.0f} items/s, data_size of each shard: {}'.format(
+        cost, data_size / cost, [_shard.data_saved for _shard in bf._shard_list]))
+    print('all urls exist: {}, is xixi in bloom_filter: {}'.format(all(bf.exists_many(urls[:batch_size])), 'xixi' in bf))
+    bf.close()
+
+
+if __name__ == '__main__':
+    main_sharded()
@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+# 基于共享内存的布隆过滤器, 同一台机器上的多个爬虫进程共用一个过滤器
+# shared memory based bloom filter
+
+import contextlib
+import os
+import sys
+import tempfile
+from multiprocessing import resource_tracker, shared_memory
+
+import bitarray
+import numpy as np
+
+from bloom_filter_metrics import record_metrics
+from memory_bloom_filter import BloomFilterMemory
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+@contextlib.contextmanager
+def _untracked():
+    """
+    共享内存的生命周期由 unlink 显式管理, 不能让 resource_tracker 在某个进程退出时删除其它进程还在使用的共享内存
+    python 3.13 之前的版本不支持 track 参数, 创建和删除共享内存时临时替换掉 resource_tracker 的 register 和 unregister
+    """
+    if sys.version_info >= (3, 13):
+        yield
+        return
+    _register, _unregister = resource_tracker.register, resource_tracker.unregister
+    resource_tracker.register = resource_tracker.unregister = lambda *args, **kwargs: None
+    try:
+        yield
+    finally:
+        resource_tracker.register, resource_tracker.unregister = _register, _unregister
+
+
+class BloomFilterSharedMemory(BloomFilterMemory):
+    """
+    基于共享内存的布隆过滤器
+    - 所有的 bitarray 都保存在 multiprocessing.shared_memory 中, 共享内存的名称为 {name}_1, {name}_2 ...
+    - 已保存的数据量 data_saved 和 filter 的数量保存在名称为 {name}_meta 的共享内存中
+    - 同一台机器上使用相同 name 实例化的过滤器, 无论是否由同一个父进程启动, 都使用同一块内存,
+      一个进程添加的数据, 在其它进程中立即可见
+    - 设置 bit 位是 读取-修改-写入 字节的操作, 为了不丢失其它进程同时设置的 bit 位, 使用 fcntl 的文件字节范围锁实现分段锁,
+      每个字节按 字节索引 % lock_stripes 对应一个锁, 只有设置同一段的进程之间才需要等待
+    - 锁是进程级别的, 只支持 posix 系统, 同一个进程中的多个线程不能同时向过滤器中添加数据
+    """
+
+    def __init__(self, bf_config, name='bloom_filter', lock_stripes=64):
+        """
+        :param bf_config: bloom filter 配置信息, 与 BloomFilterMemory 相同, 所有进程必须使用相同的配置
+        :param name: 共享内存的名称前缀, 使用相同 name 的过滤器共享同一块内存
+        :param lock_stripes: 分段锁的数量
+        """
+        if fcntl is None:
+            raise Exception('BloomFilterSharedMemory only supports posix system')
+
+        self.name = name
+        self.lock_stripes = lock_stripes
+        # 所有 bitarray 对应的共享内存, 与 _filter_list 一一对应
+        self._shm_list = []
+
+        # 分段锁使用的文件, 第 0 到 lock_stripes - 1 个字节对应 bitarray 的分段, 第 lock_stripes 个字节对应元数据
+        self._lock_file = open(os.path.join(tempfile.gettempdir(), '{}.lock'.format(name)), 'a+b')
+
+        # 元数据: [已保存的数据量, filter 的数量]
+        self._meta_shm = self._open_shared_memory('{}_meta'.format(name), size=16)
+        self._meta = np.ndarray((2,), dtype=np.int64, buffer=self._meta_shm.buf)
+
+        with self._locked([self.lock_stripes]):
+            # 父类初始化时会调用 _init_bitarray 创建或连接第一个 bitarray
+            super().__init__(bf_config)
+            # 连接其它进程已经创建的 bitarray, 并同步已保存的数据量
+            self._sync()
+
+    @staticmethod
+    def _open_shared_memory(shm_name, size):
+        """
+        创建共享内存, 如果已经存在就连接到已有的共享内存
+        新创建的共享内存中的值都为 0
+        """
+        kwargs = dict(track=False) if sys.version_info >= (3, 13) else {}
+        with _untracked():
+            try:
+                return shared_memory.SharedMemory(name=shm_name, create=True, size=size, **kwargs)
+            except FileExistsError:
+                return shared_memory.SharedMemory(name=shm_name, **kwargs)
+
+    @contextlib.contextmanager
+    def _locked(self, stripes):
+        """
+        按升序获取 stripes 中所有分段的锁, 以免多个进程之间出现死锁
+        """
+        stripes = sorted(stripes)
+        for _stripe in stripes:
+            fcntl.lockf(self._lock_file, fcntl.LOCK_EX, 1, _stripe)
+        try:
+            yield
+        finally:
+            for _stripe in reversed(stripes):
+                fcntl.lockf(self._lock_file, fcntl.LOCK_UN, 1, _stripe)
+
+    def _init_bitarray(self):
+        """
+        创建或连接下一个 bitarray 对应的共享内存, 并更新元数据中 filter 的数量
+        调用时必须持有元数据的锁
+        """
+        _index = len(self._filter_list) + 1
+        shm = self._open_shared_memory('{}_{}'.format(self.name, _index), size=self._add_filter_capacity() // 8)
+        self._shm_list.append(shm)
+        self._bitarray = bitarray.bitarray(buffer=shm.buf, endian='big')
+        self._filter_list.append(self._bitarray)
+        self._meta[1] = max(int(self._meta[1]), _index)
+
+    def _sync(self):
+        """
+        连接其它进程新增的 bitarray, 并从元数据中读取已保存的数据量
+        """
+        while len(self._filter_list) < self._meta[1]:
+            self._init_bitarray()
+        self.data_saved = int(self._meta[0])
+
+    @record_metrics('add')
+    def add(self, data):
+        """
+        向布隆过滤器中添加数据
+        持有元数据的锁时更新数据量并确定要写入的 bitarray, 持有分段锁时设置 bit 位
+        """
+        self._check_writable()
+        hashes = self._get_hashes(data)
+
+        with self._locked([self.lock_stripes]):
+            self._sync()
+            self._check_and_add_new_filter()
+            _filter = self._bitarray
+            self._meta[0] += 1
+            self.data_saved += 1
+
+        hash_indexes = self._hashes_to_indexes(hashes, len(_filter))
+        with self._locked({(_hash_index >> 3) % self.lock_stripes for _hash_index in hash_indexes}):
+            for _hash_index in hash_indexes:
+                _filter[_hash_index] = 1
+
+    def _add_many(self, hashes):
+        """
+        批量添加数据时, 一次性获取所有分段锁和元数据的锁, 只需要一次加锁操作
+        """
+        fcntl.lockf(self._lock_file, fcntl.LOCK_EX, self.lock_stripes + 1, 0)
+        try:
+            self._sync()
+            super()._add_many(hashes)
+            self._meta[0] = self.data_saved
+        finally:
+            fcntl.lockf(self._lock_file, fcntl.LOCK_UN, self.lock_stripes + 1, 0)
+
+    def merge(self, other):
+        """
+        合并时与批量添加相同, 一次性获取所有分段锁和元数据的锁, 合并的结果对所有进程可见
+        """
+        fcntl.lockf(self._lock_file, fcntl.LOCK_EX, self.lock_stripes + 1, 0)
+        try:
+            self._sync()
+            super().merge(other)
+            self._meta[0] = self.data_saved
+        finally:
+            fcntl.lockf(self._lock_file, fcntl.LOCK_UN, self.lock_stripes + 1, 0)
+        return self
+
+    @record_metrics('exists')
+    def exists(self, data):
+        """
+        判断之前先连接其它进程新增的 bitarray
+        """
+        self._sync()
+        return super().exists(data)
+
+    def _exists_many(self, hashes):
+        """
+        判断之前先连接其它进程新增的 bitarray
+        """
+        self._sync()
+        return super()._exists_many(hashes)
+
+    def __len__(self):
+        """
+        返回所有进程已保存的数据量
+        """
+        self._sync()
+        return self.data_saved
+
+    def close(self):
+        """
+        关闭本进程中的共享内存, 不影响其它进程
+        必须先释放所有使用共享内存的 bitarray 和 numpy 数组, 才能关闭共享内存
+        """
+        self._filter_list = []
+        self._bitarray = None
+        self._meta = None
+        for shm in self._shm_list + [self._meta_shm]:
+            shm.close()
+        self._shm_list = []
+        self._lock_file.close()
+
+    def __del__(self):
+        # __init__ 中途失败 (如非 posix 系统) 时没有 _lock_file
+        _lock_file = getattr(self, '_lock_file', None)
+        if _lock_file is not None and not _lock_file.closed:
+            self.close()
+
+    @classmethod
+    def load(cls, path, name='bloom_filter', lock_stripes=64):
+        """
+        把快照文件加载到共享内存中: 先以只读的 mmap 加载为 BloomFilterMemory, 再合并到名称为 name 的共享内存中,
+        共享内存中已经有数据时, 与快照中的数据合并, 而不是覆盖, 加载的结果对所有进程可见
+        :param path: 快照文件路径, 由 save 保存
+        :param name: 共享内存的名称前缀
+        :param lock_stripes: 分段锁的数量
+        """
+        snapshot = BloomFilterMemory.load(path, mmap=True, readonly=True)
+        bf = cls(snapshot.bf_config, name=name, lock_stripes=lock_stripes)
+        return bf.merge(snapshot)
+
+    def unlink(self):
+        """
+        删除所有的共享内存, 在所有进程都不再使用过滤器之后调用
+        """
+        with _untracked():
+            for shm in self._shm_list + [self._meta_shm]:
+                try:
+                    shm.unlink()
+                except FileNotFoundError:
+                    pass
+
+
+def _worker(bf_config, start, end):
+    """ 多进程测试中每个进程添加的数据 """
+    bf = BloomFilterSharedMemory(bf_config, name='bf_shared_test')
+    for i in range(start, end):
+        if not bf.exists(i):
+            bf.add(i)
+
+
+def main_multi_process():
+    """
+    测试多个进程共用一个过滤器
+    3 个进程添加的数据有重叠, 共 200 个不重复的数据, 最终保存的数据量应该接近 200 (存在多个进程同时判断同一个数据的情况)
+    """
+    import multiprocessing
+    bf_config = dict(
+        data_size_per_filter=20,
+        memory_size=1,
+        hash_seeds_num=2,
+        error_rate_threshold=1e-10
+    )
+    bf = BloomFilterSharedMemory(bf_config, name='bf_shared_test')
+    processes = [multiprocessing.Process(target=_worker, args=(bf_config, i * 50, i * 50 + 100)) for i in range(3)]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
+
+    print('data_size of bloom_filter: <{}>, filter num: <{}>'.format(len(bf), len(bf._filter_list)))
+    print('all data exists: {}'.format(all(i in bf for i in range(200))))
+    bf.unlink()
+    bf.close()
+
+
+if __name__ == '__main__':
+    main_multi_process()
@@ -0,0 +1,413 @@
+# -*- coding: utf-8 -*-
+# 基于 redis.asyncio 的异步 redis 队列, 用于 asyncio 的程序和使用 asyncio reactor 的 scrapy 爬虫中
+# 队列为空时等待 item 不会阻塞事件循环 (或 Twisted reactor), 其它请求可以继续执行
+import asyncio
+import time
+
+import redis.asyncio
+import scrapy.settings
+from scrapy.utils.defer import deferred_from_coro
+from scrapy.utils.reactor import is_asyncio_reactor_installed
+
+from redis_queue.queue import FifoRedisQueue, get_redis_params, logger
+
+
+def get_async_connection_pool(params: dict):
+    """
+    获取连接参数对应的 redis.asyncio 连接池, 与 get_connection_pool 不同, 每次调用都创建新的连接池
+    BLMOVE 等待 item 时会占用一个连接, 异步队列使用独立的连接池, 不会占用同步队列的连接
+    """
+    params = dict(params)
+    url = params.pop("url", None)
+    if url:
+        return redis.asyncio.ConnectionPool.from_url(url, **params)
+    return redis.asyncio.ConnectionPool(**params)
+
+
+class AsyncFifoRedisQueue(FifoRedisQueue.cls):
+    """
+    异步的 redis 队列
+    - redis key 的布局, lua 脚本和参数都与 FifoRedisQueue 相同, 两者可以同时操作同一个队列
+    - put_to_list, get_from_list, put_to_zset, remove_from_zset 等方法都是协程, 需要 await
+    - 每个实例使用独立的 redis.asyncio 连接池, 不是单例, 连接池只能在创建它的事件循环中使用
+    - 实例化时不访问 redis, 在第一次调用时重建摘要集合, 也可以提前 await open()
+    """
+
+    def __init__(self, settings: scrapy.settings.Settings, *args, **kwargs):
+        """
+        参数与 FifoRedisQueue 相同
+        """
+        # 多个协程同时第一次调用时, 只执行一次 open
+        self._open_lock = asyncio.Lock()
+        self._opened = False
+        super().__init__(settings, *args, **kwargs)
+
+    @staticmethod
+    def _get_redis_cli(settings):
+        """
+        获取 redis.asyncio 客户端, 使用本实例独立的连接池
+        """
+        return redis.asyncio.StrictRedis(connection_pool=get_async_connection_pool(get_redis_params(settings)))
+
+    def _open(self):
+        """
+        实例化时不能 await, 在 open 中执行
+        """
+
+    async def open(self):
+        """
+        重建摘要集合并转换旧版本的租约, 与 FifoRedisQueue._open 相同
+        """
+        async with self._open_lock:
+            if self._opened:
+                return
+            self._opened = True
+            await self.rebuild_list_set()
+            await self.migrate_leases()
+
+    async def _check_open(self):
+        """
+        第一次调用时执行 open
+        """
+        if not self._opened:
+            await self.open()
+
+    async def close(self):
+        """
+        停止后台的 reap 任务, 并关闭客户端和本实例的连接池
+        """
+        await self.stop_reaper()
+        await self.redis_cli.aclose(close_connection_pool=True)
+
+    async def rebuild_list_set(self):
+        """
+        按所有 list 中的所有 item 重建摘要集合, 与 FifoRedisQueue.rebuild_list_set 相同
+        """
+        projects = await self.get_projects(refresh=True) if self.multi_tenant else []
+        keys = self._get_rebuild_keys(projects)
+
+        async def _rebuild(pipe):
+            return self._queue_rebuild_list_set(pipe, keys[0], [await pipe.lrange(_key, 0, -1) for _key in keys[1:]])
+
+        size = await self.redis_cli.transaction(_rebuild, *keys[1:], value_from_callable=True)
+        logger.info("rebuild digest set of key: {}. total item: {}".format(self.redis_key_all, size))
+
+    async def migrate_leases(self):
+        """
+        把旧版本中 score 为保存时间的租约转换为 score 为到期时间, 与 FifoRedisQueue.migrate_leases 相同
+        """
+        keys = self._get_migrate_keys(await self.redis_cli.smembers(self.redis_key_projects))
+        count = await self._migrate_leases(keys=keys, args=[60 * self.expire])
+        self._log_migrate_leases(count)
+        return count
+
+    async def get_projects(self, refresh=False):
+        """
+        多项目模式下所有项目的名称, 与 FifoRedisQueue.get_projects 相同
+        """
+        if self._is_projects_expired(refresh):
+            return self._set_projects(await self.redis_cli.smembers(self.redis_key_projects))
+        return self._projects
+
+    async def get_list_size(self, key):
+        await self._check_open()
+        return await self.redis_cli.llen(key)
+
+    async def get_zset_size(self, project=None):
+        await self._check_open()
+        return await self.redis_cli.zcount(self.get_on_key(project), "({}".format(self.get_expire_score()), "+inf")
+
+    async def exists_in_list(self, key, item: dict):
+        """
+        判断 item 是否存在于 某个 list 中, 与 FifoRedisQueue.exists_in_list 相同
+        """
+        await self._check_open()
+        set_key = self.get_list_set_key(key)
+        if set_key is not None:
+            is_exists = await self.redis_cli.sismember(set_key, self.get_digest(self.dict_to_js(item)))
+        else:
+            is_exists = self.dict_to_js(item) in [v.decode() for v in await self.redis_cli.lrange(key, 0, -1)]
+        if is_exists:
+            logger.info("item exists in {}".format(key))
+        return bool(is_exists)
+
+    async def exists_in_zset(self, item: dict):
+        await self._check_open()
+        on_key = self.get_on_key(item.get("project"))
+        is_exists = self._is_lease_alive(await self.redis_cli.zscore(on_key, self.dict_to_js(item)))
+        if is_exists:
+            logger.info("item exists in {}".format(on_key))
+        return is_exists
+
+    async def put_to_list(self, item: dict):
+        """
+        把 item 保存到 list 中, 与 FifoRedisQueue.put_to_list 相同, 只需要一次往返
+        """
+        await self._check_open()
+        if self._is_sweep_due():
+            await self.sweep()
+        keys, args = self._get_put_args(item)
+        self._parse_put(item, keys, await self._put_to_list(keys=keys, args=args))
+
+    async def put_to_zset(self, item: dict):
+        await self._check_open()
+        on_key = self.get_on_key(item.get("project"))
+        pipe = self.redis_cli.pipeline(transaction=False)
+        pipe.zadd(on_key, {self.dict_to_js(item): self.get_expire_score() + self.get_lease_seconds(item)}, gt=True)
+        pipe.zcard(on_key)
+        self._log_put_to_zset(on_key, *(await pipe.execute()))
+
+    async def all_to_on(self, item):
+        """
+        把从 list 中取出的 json str 保存到 zset 中, 与 FifoRedisQueue.all_to_on 相同
+        """
+        await self.put_to_zset(item=self.js_to_dict(item))
+
+    async def get_from_list(self, key):
+        """
+        从 list 中取出来一个数据并保存到 cookie:on 中, 与 FifoRedisQueue.get_from_list 相同
+        队列为空时 await BLMOVE, 等待期间事件循环可以执行其它的协程
+        """
+        await self._check_open()
+        if self._is_sweep_due():
+            await self.sweep()
+        if self.multi_tenant:
+            return await self.get_from_projects(self._get_key_projects(key))
+
+        while True:
+            keys, args = self._get_pop_args(key)
+            item = self._parse_pop(key, await self._pop_from_list(keys=keys, args=args))
+            if item is not False:
+                break
+        if item:
+            return self.js_to_dict(item)
+
+        logger.info("redis key {} is empty, wait for {}s".format(key, self.timeout))
+        if self._is_new_blocking_key(key):
+            await self.redis_cli.sadd(self.redis_key_blocking, key)
+        item = await self.redis_cli.blmove(key, self.get_processing_key(key), self.timeout, src="LEFT", dest="RIGHT")
+        if item:
+            keys, args = self._get_lease_args(key, item)
+            return self._parse_lease(key, item, await self._lease(keys=keys, args=args))
+
+    async def get_from_projects(self, projects=None):
+        """
+        多项目模式下按权重从各个项目中取出一个 item, 与 FifoRedisQueue.get_from_projects 相同
+        :param projects: 只从这些项目中取出, 默认为所有项目
+        """
+        await self._check_open()
+        deadline = time.time() + self.timeout
+        while True:
+            _projects = projects or await self.get_projects()
+            if _projects:
+                order = self._get_project_order(_projects)
+                while True:
+                    keys, args = self._get_projects_pop_args(order)
+                    item = self._parse_projects_pop(
+                        _projects, order, await self._pop_from_projects(keys=keys, args=args))
+                    if item is not False:
+                        break
+                if item:
+                    return item
+
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None
+            await asyncio.sleep(min(0.5, remaining))
+            if projects is None:
+                await self.get_projects(refresh=True)
+
+    async def get_project_stats(self):
+        """
+        多项目模式下每个项目的统计信息, 与 FifoRedisQueue.get_project_stats 相同
+        """
+        projects = await self.get_projects(refresh=True)
+        pipe = self.redis_cli.pipeline(transaction=False)
+        self._queue_project_stats(pipe, projects)
+        results = await pipe.execute()
+
+        pipe = self.redis_cli.pipeline(transaction=False)
+        self._queue_project_heads(pipe, projects, results)
+        return self._parse_project_stats(projects, results, await pipe.execute())
+
+    async def sweep(self, batch_size=None):
+        """
+        清理一批过期的值, 每个 zset 最多处理 batch_size 个, 与 FifoRedisQueue.sweep 相同
+        """
+        batch_size = batch_size or self.sweep_batch_size
+        projects = await self.get_projects() if self.multi_tenant else []
+        expired_list = None
+        if self.requeue_expires:
+            pipe = self.redis_cli.pipeline(transaction=False)
+            self._queue_expired_items(pipe, self._get_requeue_targets(projects), batch_size)
+            expired_list = await pipe.execute()
+        pipe = self.redis_cli.pipeline(transaction=False)
+        for script, keys, args in self._get_sweep_targets(projects, batch_size, expired_list):
+            await script(keys=keys, args=args, client=pipe)
+        total = sum(await pipe.execute())
+        self._log_sweep(total)
+        return total
+
+    async def remove_expires(self, batch_size=1000):
+        """
+        分批删除 zset 中所有租约过期的值, 与 FifoRedisQueue.remove_expires 相同
+        """
+        total = 0
+        for on_key in self._get_on_keys(await self.get_projects() if self.multi_tenant else []):
+            while True:
+                count = await self._remove_expires(keys=[on_key], args=[self.get_expire_score(), batch_size])
+                total += count
+                if count < batch_size:
+                    break
+        self._log_expires(total)
+        return total
+
+    async def requeue_expires_batch(self, batch_size=1000):
+        """
+        把租约过期的 item 分批放回队列中, 与 FifoRedisQueue.requeue_expires_batch 相同
+        """
+        total = 0
+        for keys, args in self._get_requeue_targets(await self.get_projects() if self.multi_tenant else []):
+            while True:
+                items = await self.redis_cli.zrangebyscore(
+                    keys[0], 0, self.get_expire_score(), start=0, num=batch_size)
+                if items:
+                    total += await self._requeue_expires(keys=keys, args=self._get_requeue_args(args, items))
+                if len(items) < batch_size:
+                    break
+        self._log_requeue_expires(total)
+        return total
+
+    async def requeue_processing(self):
+        """
+        把 processing list 中连续两次 reap 都存在的 item 放回队列的头部, 与 FifoRedisQueue.requeue_processing 相同
+        """
+        keys = self._get_blocking_keys(await self.redis_cli.smembers(self.redis_key_blocking))
+        pipe = self.redis_cli.pipeline(transaction=False)
+        for key in keys:
+            pipe.lrange(self.get_processing_key(key), 0, -1)
+        targets = self._get_processing_targets(keys, await pipe.execute())
+        if not targets:
+            return 0
+        pipe = self.redis_cli.pipeline(transaction=False)
+        for _keys, args in targets:
+            await self._requeue_processing(keys=_keys, args=args, client=pipe)
+        return self._log_requeue_processing(targets, await pipe.execute())
+
+    async def reap(self, batch_size=1000):
+        await self._check_open()
+        await self.requeue_processing()
+        if self.requeue_expires:
+            await self.requeue_expires_batch(batch_size)
+        else:
+            await self.remove_expires(batch_size)
+
+    async def _run_reaper(self, interval, batch_size):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.reap(batch_size)
+            except Exception as e:
+                logger.error("error reap expired items. error: {}".format(e))
+
+    def start_reaper(self, interval=30, batch_size=1000):
+        """
+        在当前的事件循环中启动后台任务, 每隔 interval 秒执行一次 reap
+        """
+        if self._reaper is not None and not self._reaper.done():
+            return
+        self._reaper = asyncio.ensure_future(self._run_reaper(interval, batch_size))
+
+    async def stop_reaper(self):
+        if self._reaper is not None:
+            self._reaper.cancel()
+            try:
+                await self._reaper
+            except asyncio.CancelledError:
+                pass
+            self._reaper = None
+
+    async def remove_from_zset(self, item: dict):
+        await self._check_open()
+        on_key = self.get_on_key(item.get("project"))
+        self._log_remove_from_zset(on_key, await self.redis_cli.zrem(on_key, self.dict_to_js(item)))
+
+
+class TwistedFifoRedisQueue(object):
+    """
+    AsyncFifoRedisQueue 的 Twisted 适配器, 所有方法都返回 Deferred, 用于不能使用 async def 的 scrapy 组件中
+    只能在 asyncio reactor (TWISTED_REACTOR = "twisted.internet.asyncioreactor.AsyncioSelectorReactor") 中使用,
+    async def 的回调中可以直接 await AsyncFifoRedisQueue 的方法
+    """
+
+    def __init__(self, settings: scrapy.settings.Settings, *args, **kwargs):
+        """
+        参数与 FifoRedisQueue 相同
+        """
+        if not is_asyncio_reactor_installed():
+            raise Exception("TwistedFifoRedisQueue requires the asyncio reactor. "
+                            "set TWISTED_REACTOR = 'twisted.internet.asyncioreactor.AsyncioSelectorReactor'")
+        self.queue = AsyncFifoRedisQueue(settings, *args, **kwargs)
+
+    def put_to_list(self, item: dict):
+        return deferred_from_coro(self.queue.put_to_list(item))
+
+    def get_from_list(self, key):
+        return deferred_from_coro(self.queue.get_from_list(key))
+
+    def put_to_zset(self, item: dict):
+        return deferred_from_coro(self.queue.put_to_zset(item))
+
+    def all_to_on(self, item):
+        return deferred_from_coro(self.queue.all_to_on(item))
+
+    def remove_from_zset(self, item: dict):
+        return deferred_from_coro(self.queue.remove_from_zset(item))
+
+    def exists_in_list(self, key, item: dict):
+        return deferred_from_coro(self.queue.exists_in_list(key, item))
+
+    def exists_in_zset(self, item: dict):
+        return deferred_from_coro(self.queue.exists_in_zset(item))
+
+    def get_list_size(self, key):
+        return deferred_from_coro(self.queue.get_list_size(key))
+
+    def get_zset_size(self, project=None):
+        return deferred_from_coro(self.queue.get_zset_size(project))
+
+    def get_project_stats(self):
+        return deferred_from_coro(self.queue.get_project_stats())
+
+    def reap(self, batch_size=1000):
+        return deferred_from_coro(self.queue.reap(batch_size))
+
+    def start_reaper(self, interval=30, batch_size=1000):
+        self.queue.start_reaper(interval, batch_size)
+
+    def close(self):
+        return deferred_from_coro(self.queue.close())
+
+
+async def main_concurrent(settings: scrapy.settings.Settings):
+    """
+    测试队列为空时等待 item 不会阻塞事件循环:
+    一个协程在空队列上等待, 另一个协程 1 秒后 put_to_list, 等待的协程立即取到 item, 期间事件循环可以执行其它的协程
+    """
+    q = AsyncFifoRedisQueue(settings, timeout=5)
+    item = dict(project="demo", spider="demo", account_info=dict(account="account", password="password"))
+
+    async def _put_later():
+        await asyncio.sleep(1)
+        await q.put_to_list(item)
+
+    start = time.time()
+    result, _ = await asyncio.gather(q.get_from_list(q.redis_key_all), _put_later())
+    print("get item after {:.2f}s: {}".format(time.time() - start, result))
+    await q.remove_from_zset(item)
+    await q.close()
+
+
+if __name__ == '__main__':
+    from get_scrapy_settings.project import get_project_settings
+    asyncio.run(main_concurrent(get_project_settings(settings_name='news_pro')))
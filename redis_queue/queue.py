@@ -2,15 +2,67 @@
 # redis 队列, 添加数据, 删除数据
 # 参考 pyspider redis_queue.py
 # https://github.com/binux/pyspider/blob/master/pyspider/message_queue/redis_queue.py
+import hashlib
 import json
 import logging
+import threading
 import time
 from collections import OrderedDict
 
 import redis
 import scrapy.settings
 
-from scrapy_redis import connection
+from scrapy_redis import connection, defaults
+
+
+# 连接池的默认参数, 可以在 settings.REDIS_PARAMS 中覆盖
+# health_check_interval: 连接空闲超过这个秒数后, 再次使用之前先发送 PING 检查连接是否可用
+# socket_keepalive: 开启 TCP keepalive, 以免长时间空闲的连接被防火墙或 NAT 断开
+REDIS_POOL_DEFAULTS = dict(
+    health_check_interval=30,
+    socket_keepalive=True,
+)
+
+# 按连接参数保存的连接池
+_connection_pools = {}
+
+
+def get_redis_params(settings: scrapy.settings.Settings):
+    """
+    与 scrapy_redis.connection.get_redis_from_settings 相同, 从 settings 中读取 redis 的连接参数
+    REDIS_PARAMS 中可以设置 max_connections, health_check_interval, socket_keepalive 等连接池参数
+    """
+    params = defaults.REDIS_PARAMS.copy()
+    params.update(REDIS_POOL_DEFAULTS)
+    params.update(settings.getdict("REDIS_PARAMS"))
+    for source, dest in connection.SETTINGS_PARAMS_MAP.items():
+        val = settings.get(source)
+        if val:
+            params[dest] = val
+    params.pop("redis_cls", None)
+    return params
+
+
+def get_params_key(params: dict):
+    """
+    把连接参数转换为可以作为 dict key 的 tuple
+    """
+    return tuple(sorted((k, repr(v)) for k, v in params.items()))
+
+
+def get_connection_pool(params: dict):
+    """
+    获取连接参数对应的连接池, 相同连接参数共用一个连接池
+    """
+    key = get_params_key(params)
+    if key not in _connection_pools:
+        params = dict(params)
+        url = params.pop("url", None)
+        if url:
+            _connection_pools[key] = redis.ConnectionPool.from_url(url, **params)
+        else:
+            _connection_pools[key] = redis.ConnectionPool(**params)
+    return _connection_pools[key]
 
 
 def singleton(cls, *args, **kwargs):
@@ -19,16 +71,24 @@ def singleton(cls, *args, **kwargs):
     https://www.cnblogs.com/PigeonNoir/articles/9392047.html
     https://www.cnblogs.com/jiangxinyang/p/8454418.html
     https://blog.csdn.net/qq_35462323/article/details/82912027
+    按 settings 中的 redis 连接参数和其它初始化参数保存单例, 不同的 redis 或 db 各有一个实例,
+    而不是第一次传入的 settings 被所有的实例使用; 初始化参数 (如 multi_tenant, expire, project_weights) 不同时
+    也各有一个实例, 而不是忽略后续传入的参数
     """
     # 创建一个instances字典用来保存单例
     instances = {}
 
     # 创建一个内层函数来获得单例, 添加不定长参数, 以与 redis_conn 中 __init__ 中传递的参数相符合
-    def _get_instance(*args, **kwargs):
+    def _get_instance(settings, *args, **kwargs):
         # 判断instances字典中是否含有单例, 如果没有就创建单例并保存到instances字典中, 然后返回该单例
-        if cls not in instances:
-            instances[cls] = cls(*args, **kwargs)
-        return instances[cls]
+        key = (get_params_key(get_redis_params(settings)),
+               tuple(repr(arg) for arg in args), get_params_key(kwargs))
+        if key not in instances:
+            instances[key] = cls(settings, *args, **kwargs)
+        return instances[key]
+
+    # 保存被装饰的类, 以便继承, 如 async_queue.AsyncFifoRedisQueue
+    _get_instance.cls = cls
 
     # 返回内层函数 get_instance
     return _get_instance
@@ -57,24 +117,299 @@ class FifoRedisQueue(object):
     redis_key_all = "cookie:all"
     # 正在进行登录的账号信息保存的 key
     redis_key_on = "cookie:on"
+    # redis_key_all 中所有 item 的 json str 的 sha1 摘要, 与 redis_key_all 同时更新, 用于 O(1) 判断 item 是否已经在 list 中
+    redis_key_all_set = "cookie:all:set"
+    # 多项目模式下, 所有有过 item 的项目的名称
+    redis_key_projects = "cookie:projects"
+    # 旧版本中 zset 的 score 为保存时间, 转换为租约的到期时间之后设置这个 key, 见 LUA_MIGRATE_LEASES
+    redis_key_leases_migrated = "cookie:migrated:lease_deadline"
+    # 所有使用过 BLMOVE 阻塞取出的 list key, reap 时检查它们的 processing list
+    redis_key_blocking = "cookie:blocking"
+
+    # 每个操作都只需要一次往返: 多条命令放在一个 lua 脚本或 pipeline 中执行, 不再在每条命令之前 PING,
+    # 连接是否可用由连接池的 health_check_interval 检查, 见 REDIS_POOL_DEFAULTS
+
+    # zset 中的 score 为租约的到期时间 (与 redis key 的 EXPIREAT 相同), 过期的值分两种方式处理:
+    # - 惰性: 访问时比较 score 与当前时间, 已经过期的值视为不存在, 不需要先删除
+    # - 定期: 每隔 sweep_interval 秒 (或由 start_reaper 启动的后台线程) 清理一批, 每个 zset 每次最多 sweep_batch_size 个
+
+    # item 的租约时长 (秒): item 中有数字类型的 expire 字段 (分钟) 时使用 item 自己的租约时长, 否则使用默认值
+    LUA_GET_LEASE_SECONDS = """
+    local function get_lease_seconds(item, default)
+        local ok, obj = pcall(cjson.decode, item)
+        if ok and type(obj) == 'table' and type(obj['expire']) == 'number' then
+            return obj['expire'] * 60
+        end
+        return tonumber(default)
+    end
+    """
+
+    # item 的摘要都在 python 中计算 (get_digest) 后作为 ARGV 传入, lua 脚本中不使用 redis.sha1hex,
+    # 兼容不支持 redis.sha1hex 的 redis 实现 (如 fakeredis); 从 list 中取出 item 时, 脚本中才知道取出的是哪个 item,
+    # 所以先由 python 计算 list 中第一个 item 的摘要, 脚本中第一个 item 与传入的相同时才取出, 见 LUA_POP_FROM_LIST
+
+    # 判断并添加到 list 的 lua 脚本, 在 redis 服务端原子执行, 摘要集合和 list 同时更新
+    # KEYS: redis_key_all, redis_key_all_set, redis_key_on, 多项目模式下还有 redis_key_projects, 入队时间的 hash key
+    # ARGV: item 的 json str, 当前时间, item 的摘要, 多项目模式下还有 项目名称, 入队时间
+    # 返回 -1: 已经在 list 中, -2: 已经在 zset 中且租约没有过期, 否则为添加后 list 的长度
+    LUA_PUT_TO_LIST = """
+    local digest = ARGV[3]
+    if redis.call('SISMEMBER', KEYS[2], digest) == 1 then
+        return -1
+    end
+    local score = redis.call('ZSCORE', KEYS[3], ARGV[1])
+    if score then
+        if tonumber(score) > tonumber(ARGV[2]) then
+            return -2
+        end
+        redis.call('ZREM', KEYS[3], ARGV[1])
+    end
+    redis.call('SADD', KEYS[2], digest)
+    if #KEYS == 5 then
+        redis.call('SADD', KEYS[4], ARGV[4])
+        redis.call('HSET', KEYS[5], digest, ARGV[5])
+    end
+    return redis.call('RPUSH', KEYS[1], ARGV[1])
+    """
+
+    # 从 list 中取出一个 item 并以租约的到期时间为 score 保存到 zset 中, 有摘要集合时同时删除摘要
+    # 有摘要集合时, list 中第一个 item 与传入的 item 相同才取出, 否则返回实际的第一个 item, 由 python 计算摘要后重试;
+    # 返回取出之后新的第一个 item, 下一次调用时传入, 只有一个进程取出时每次只需要一次往返
+    # KEYS: list key, redis_key_on, 摘要集合的 key (可选)
+    # ARGV: 当前时间, 默认的租约时长 (秒), 预期的第一个 item, 它的摘要
+    # 返回 {1, item, 新的第一个 item}: 成功; {0, 实际的第一个 item}: 与预期的不同, list 为空时为 {0, false}
+    LUA_POP_FROM_LIST = LUA_GET_LEASE_SECONDS + """
+    local item = redis.call('LINDEX', KEYS[1], 0)
+    if not item or (#KEYS == 3 and item ~= ARGV[3]) then
+        return {0, item}
+    end
+    redis.call('LPOP', KEYS[1])
+    if #KEYS == 3 then
+        redis.call('SREM', KEYS[3], ARGV[4])
+    end
+    redis.call('ZADD', KEYS[2], ARGV[1] + get_lease_seconds(item, ARGV[2]), item)
+    return {1, item, redis.call('LINDEX', KEYS[1], 0)}
+    """
+
+    # BLMOVE 阻塞取出的 item 会先放到 processing list 中, 再使用这个脚本从 processing list 中删除并保存到 zset 中
+    # KEYS: processing list key, redis_key_on, 摘要集合的 key (可选)
+    # ARGV: item, 当前时间, 默认的租约时长 (秒), item 的摘要
+    # 返回 1: 成功, 0: item 已经被 reap 放回了队列中
+    LUA_LEASE = LUA_GET_LEASE_SECONDS + """
+    if redis.call('LREM', KEYS[1], 1, ARGV[1]) == 0 then
+        return 0
+    end
+    if #KEYS == 3 then
+        redis.call('SREM', KEYS[3], ARGV[4])
+    end
+    redis.call('ZADD', KEYS[2], ARGV[2] + get_lease_seconds(ARGV[1], ARGV[3]), ARGV[1])
+    return 1
+    """
+
+    # 把 processing list 中没有完成租约的 item 放回队列的头部
+    # KEYS: processing list key, list key, 摘要集合的 key (可选)
+    # ARGV: 依次为每个 item 和它的摘要
+    # 返回放回队列的数量
+    LUA_REQUEUE_PROCESSING = """
+    local count = 0
+    for i = 1, #ARGV, 2 do
+        if redis.call('LREM', KEYS[1], 1, ARGV[i]) > 0 then
+            redis.call('LPUSH', KEYS[2], ARGV[i])
+            if #KEYS == 3 then
+                redis.call('SADD', KEYS[3], ARGV[i + 1])
+            end
+            count = count + 1
+        end
+    end
+    return count
+    """
+
+    # 把 zset 中租约过期的 item 批量放回队列的尾部, 已经在队列中的 item 不再重复添加
+    # 过期的 item 由 python 先读取 (ZRANGEBYSCORE) 并计算摘要, 脚本中只处理租约仍然过期的 item,
+    # 读取之后被其它进程放回或者续租的 item 会被跳过
+    # KEYS: redis_key_on, redis_key_all, redis_key_all_set, 多项目模式下还有 入队时间的 hash key
+    # ARGV: 当前时间, 入队时间 (多项目模式下使用), 之后依次为每个 item 和它的摘要
+    # 返回本批次中处理的过期的 item 的数量
+    LUA_REQUEUE_EXPIRES = """
+    local count = 0
+    for i = 3, #ARGV, 2 do
+        local score = redis.call('ZSCORE', KEYS[1], ARGV[i])
+        if score and tonumber(score) <= tonumber(ARGV[1]) then
+            redis.call('ZREM', KEYS[1], ARGV[i])
+            if redis.call('SADD', KEYS[3], ARGV[i + 1]) == 1 then
+                redis.call('RPUSH', KEYS[2], ARGV[i])
+                if #KEYS == 4 then
+                    redis.call('HSET', KEYS[4], ARGV[i + 1], ARGV[2])
+                end
+            end
+            count = count + 1
+        end
+    end
+    return count
+    """
 
-    def __init__(self, settings: scrapy.settings.Settings, timeout=5, expire=15):
+    # 删除 zset 中一批租约过期的 item, zset 按到期时间排序, 过期的 item 总是排在最前面
+    # KEYS: zset key
+    # ARGV: 当前时间, 每批的最大数量
+    # 返回本批次删除的数量
+    LUA_REMOVE_EXPIRES = """
+    local count = math.min(redis.call('ZCOUNT', KEYS[1], 0, ARGV[1]), tonumber(ARGV[2]))
+    if count > 0 then
+        redis.call('ZREMRANGEBYRANK', KEYS[1], 0, count - 1)
+    end
+    return count
+    """
+
+    # 把旧版本中 score 为保存时间的 item 的 score 转换为租约的到期时间 (加上租约时长), 否则这些 item 都会被视为已经过期
+    # 所有进程中只执行一次: 设置标记 key 和转换在同一个脚本中原子执行, 之后新建的 zset (如新的项目) 不会被重复转换
+    # KEYS: redis_key_leases_migrated, 之后为所有的 zset key
+    # ARGV: 默认的租约时长 (秒)
+    # 返回转换的 item 数量, 已经转换过时为 -1
+    LUA_MIGRATE_LEASES = LUA_GET_LEASE_SECONDS + """
+    if redis.call('SETNX', KEYS[1], 1) == 0 then
+        return -1
+    end
+    local count = 0
+    for i = 2, #KEYS do
+        local values = redis.call('ZRANGE', KEYS[i], 0, -1, 'WITHSCORES')
+        for j = 1, #values, 2 do
+            local score = tonumber(values[j + 1]) + get_lease_seconds(values[j], ARGV[1])
+            redis.call('ZADD', KEYS[i], 'XX', score, values[j])
+            count = count + 1
+        end
+    end
+    return count
+    """
+
+    # 多项目模式下, 按顺序依次尝试从每个项目的 list 中取出一个 item 并保存到项目的 zset 中 (租约),
+    # 跳过 list 为空, 或者 zset 中租约没有过期的数量 (正在处理的数量) 已经达到上限的项目
+    # 与 LUA_POP_FROM_LIST 相同, 项目的 list 中第一个 item 与传入的 item 相同才取出
+    # KEYS: redis_key_all_set, 之后每个项目依次为 list key, zset key, 入队时间的 hash key
+    # ARGV: 当前时间, 默认的租约时长 (秒), 之后每个项目依次为 正在处理的数量的上限 (为 0 时不限制), 预期的第一个 item, 它的摘要
+    # 返回 {取出的项目的序号 (从 1 开始, 没有取出时为 0), item, 入队时间, 项目的 list 中新的第一个 item},
+    # 第一个 item 与预期的不同时为 {-序号, 实际的第一个 item}
+    LUA_POP_FROM_PROJECTS = LUA_GET_LEASE_SECONDS + """
+    for i = 1, (#KEYS - 1) / 3 do
+        local list_key, on_key, ts_key = KEYS[i * 3 - 1], KEYS[i * 3], KEYS[i * 3 + 1]
+        local limit = tonumber(ARGV[i * 3])
+        if limit == 0 or redis.call('ZCOUNT', on_key, '(' .. ARGV[1], '+inf') < limit then
+            local item = redis.call('LINDEX', list_key, 0)
+            if item then
+                if item ~= ARGV[i * 3 + 1] then
+                    return {-i, item}
+                end
+                local digest = ARGV[i * 3 + 2]
+                redis.call('LPOP', list_key)
+                redis.call('SREM', KEYS[1], digest)
+                redis.call('ZADD', on_key, ARGV[1] + get_lease_seconds(item, ARGV[2]), item)
+                local enqueued = redis.call('HGET', ts_key, digest)
+                redis.call('HDEL', ts_key, digest)
+                return {i, item, enqueued, redis.call('LINDEX', list_key, 0)}
+            end
+        end
+    end
+    return {0, false}
+    """
+
+    def __init__(self, settings: scrapy.settings.Settings, timeout=5, expire=15, requeue_expires=False,
+                 multi_tenant=False, project_weights=None, project_max_in_flight=None, project_refresh_interval=5,
+                 sweep_interval=60, sweep_batch_size=1000):
         """
         因为 queue 是在爬虫中使用的, 所以这里无法获取到 settings_name
         传递进来的是 已经经过实例化的 self.settings
         :param settings: scrapy.settings.Settings
         :param timeout: 当 list 为空时, 阻塞的时间
-        :param expire: zset 中值的过期时间
+        :param expire: 默认的租约时长 (分钟), 即取出 item 之后在 zset 中的过期时间,
+            item 中有数字类型的 expire 字段时, 使用 item 自己的租约时长, 如 dict(project=..., expire=30)
+        :param requeue_expires: 租约过期的 item 是否放回队列中, 为 False 时直接删除,
+            为 True 时由 reap (或 start_reaper 启动的后台线程) 放回 redis_key_all, 没有调用 remove_from_zset 的 item 会被重新处理
+        :param multi_tenant: 是否使用多项目模式, 每个项目 (item["project"]) 使用独立的 list cookie:all:{project}
+            和 zset cookie:on:{project}, get_from_list 按权重轮流从各个项目中取出 item, 一个项目大量过期的账号不会阻塞其它项目
+        :param project_weights: 多项目模式下每个项目的权重, {project: weight}, 没有设置的项目权重为 1
+        :param project_max_in_flight: 多项目模式下每个项目正在处理 (在 zset 中) 的 item 数量的上限, {project: limit}, 没有设置的项目不限制
+        :param project_refresh_interval: 多项目模式下重新读取项目列表的间隔秒数
+        :param sweep_interval: put_to_list 和 get_from_list 中清理过期值的最小间隔秒数, 为 0 或 None 时不清理,
+            由 start_reaper 启动的后台线程清理; 过期的值在清理之前不影响结果, 见 LUA_PUT_TO_LIST
+        :param sweep_batch_size: 每次清理时每个 zset 最多处理的过期值的数量
         """
-        self.redis_cli = connection.from_settings(settings)
-        self.redis_cli: redis.StrictRedis
+        self.redis_cli = self._get_redis_cli(settings)
 
         # 队列为空时等待的时间
         self.timeout = timeout
-        # redis_key_on 中的 value 的过期时间, 单位 mins
+        # redis_key_on 中的 value 的默认过期时间, 单位 mins
         self.expire = expire
-        # 启动时删除 REDIS_KEY_ON 中 self.expire 之前的值
-        self.remove_expires()
+        self.requeue_expires = requeue_expires
+        self.sweep_interval = sweep_interval
+        self.sweep_batch_size = sweep_batch_size
+        # 上一次清理的时间, 为 0 时第一次调用 put_to_list 或 get_from_list 就会清理
+        self._last_sweep = 0
+
+        self.multi_tenant = multi_tenant
+        self.project_weights = project_weights or {}
+        self.project_max_in_flight = project_max_in_flight or {}
+        self.project_refresh_interval = project_refresh_interval
+        self._projects = []
+        self._projects_refreshed = 0
+        # 平滑加权轮询中每个项目当前的权重
+        self._wrr_current = {}
+        # 本进程取出的 item 在队列中的等待时间, {project: dict(count, sum, max)}
+        self.project_wait_stats = {}
+
+        # 每个 list 中第一个 item 的缓存, {list key: item}, 取出时作为预期的第一个 item 传入 lua 脚本, 见 LUA_POP_FROM_LIST
+        self._list_heads = {}
+        # reap 上一次看到的每个 processing list 中的 item, {processing list key: set(item)}
+        self._processing_seen = {}
+        # 本进程已经保存到 redis_key_blocking 中的 list key
+        self._blocking_keys = set()
+        self._reaper = None
+        self._reaper_stop = threading.Event()
+
+        self._put_to_list = self.redis_cli.register_script(self.LUA_PUT_TO_LIST)
+        self._pop_from_list = self.redis_cli.register_script(self.LUA_POP_FROM_LIST)
+        self._pop_from_projects = self.redis_cli.register_script(self.LUA_POP_FROM_PROJECTS)
+        self._lease = self.redis_cli.register_script(self.LUA_LEASE)
+        self._requeue_processing = self.redis_cli.register_script(self.LUA_REQUEUE_PROCESSING)
+        self._requeue_expires = self.redis_cli.register_script(self.LUA_REQUEUE_EXPIRES)
+        self._remove_expires = self.redis_cli.register_script(self.LUA_REMOVE_EXPIRES)
+        self._migrate_leases = self.redis_cli.register_script(self.LUA_MIGRATE_LEASES)
+
+        self._open()
+
+    @staticmethod
+    def _get_redis_cli(settings):
+        """
+        相同连接参数的 FifoRedisQueue 共用一个连接池
+        """
+        return redis.StrictRedis(connection_pool=get_connection_pool(get_redis_params(settings)))
+
+    def _open(self):
+        """
+        启动时重建摘要集合, 兼容没有摘要集合的旧数据, 并转换旧版本的租约, 过期的值在第一次调用 put_to_list 或 get_from_list 时清理
+        """
+        self.rebuild_list_set()
+        self.migrate_leases()
+
+    def _get_migrate_keys(self, projects):
+        """
+        转换旧版本的租约时的 KEYS, 包括所有项目的 zset, 与是否使用多项目模式无关, 同步和异步共用
+        """
+        return [self.redis_key_leases_migrated, self.redis_key_on] + [
+            "{}:{}".format(self.redis_key_on, _project) for _project in sorted(_p.decode("utf-8") for _p in projects)]
+
+    @staticmethod
+    def _log_migrate_leases(count):
+        if count >= 0:
+            logger.info("convert {} legacy lease scores to lease deadlines".format(count))
+
+    def migrate_leases(self):
+        """
+        把旧版本中 score 为保存时间的租约转换为 score 为到期时间, 所有进程中只执行一次, 见 LUA_MIGRATE_LEASES
+        :return: 转换的 item 数量, 已经转换过时为 -1
+        """
+        keys = self._get_migrate_keys(self.redis_cli.smembers(self.redis_key_projects))
+        count = self._migrate_leases(keys=keys, args=[60 * self.expire])
+        self._log_migrate_leases(count)
+        return count
 
     def all_to_on(self, item):
         """
@@ -85,6 +420,31 @@ class FifoRedisQueue(object):
         item = self.js_to_dict(item)
         self.put_to_zset(item=item)
 
+    @staticmethod
+    def get_expire_score():
+        """
+        zset 中的 score 为租约的到期时间, score 小于等于这个值 (当前时间) 的 item 已经过期
+        """
+        return int(time.time())
+
+    def get_lease_seconds(self, item: dict):
+        """
+        item 的租约时长 (秒), 与 lua 脚本中的 get_lease_seconds 相同
+        """
+        expire = item.get("expire")
+        if not isinstance(expire, (int, float)) or isinstance(expire, bool):
+            expire = self.expire
+        return 60 * expire
+
+    def _log_expires(self, result):
+        if result:
+            logger.info(
+                "successfully remove {} expired item from key: {}".format(
+                    result,
+                    self.redis_key_on
+                )
+            )
+
     @staticmethod
     def sort_keys(item: dict):
         """
@@ -119,23 +479,133 @@ class FifoRedisQueue(object):
         except Exception as e:
             logger.error("error load js to dict. error: {}".format(e))
 
+    @staticmethod
+    def get_digest(js_str: str):
+        """
+        item 的 json str 的 sha1 摘要, 作为 ARGV 传入 lua 脚本中
+        """
+        return hashlib.sha1(js_str.encode("utf-8")).hexdigest()
+
+    def get_list_set_key(self, key):
+        """
+        list key 对应的摘要集合的 key, 只有 redis_key_all 有摘要集合, 其它的 list key 返回 None
+        """
+        return self.redis_key_all_set if key == self.redis_key_all else None
+
+    def _get_rebuild_keys(self, projects):
+        """
+        重建摘要集合时的 KEYS, 同步和异步共用
+        """
+        return [self.redis_key_all_set, self.redis_key_all] + [self.get_project_key(_project) for _project in projects]
+
+    def rebuild_list_set(self):
+        """
+        按 redis_key_all (多项目模式下还有所有项目的 list) 中的所有 item 重建摘要集合, 时间复杂度为 O(n), 只在启动时执行
+        在 WATCH 所有 list 的事务中执行, 期间有其它进程修改 list 时重试
+        """
+        projects = self.get_projects(refresh=True) if self.multi_tenant else []
+        keys = self._get_rebuild_keys(projects)
+
+        def _rebuild(pipe):
+            return self._queue_rebuild_list_set(pipe, keys[0], [pipe.lrange(_key, 0, -1) for _key in keys[1:]])
+
+        size = self.redis_cli.transaction(_rebuild, *keys[1:], value_from_callable=True)
+        logger.info("rebuild digest set of key: {}. total item: {}".format(self.redis_key_all, size))
+
+    def _queue_rebuild_list_set(self, pipe, set_key, values_list):
+        """
+        把按所有 list 中的 item 重建摘要集合的命令添加到事务中, 同步和异步共用
+        :return: item 的总数
+        """
+        digests = {self.get_digest(_v.decode("utf-8")) for _values in values_list for _v in _values}
+        pipe.multi()
+        pipe.delete(set_key)
+        if digests:
+            pipe.sadd(set_key, *digests)
+        return sum(len(_values) for _values in values_list)
+
+    @staticmethod
+    def get_processing_key(key):
+        """
+        阻塞取出的 item 在完成租约之前保存的 list key
+        """
+        return "{}:processing".format(key)
+
+    def get_project_key(self, project):
+        """
+        多项目模式下项目的 list key
+        """
+        return "{}:{}".format(self.redis_key_all, project)
+
+    def _get_key_projects(self, key):
+        """
+        多项目模式下 get_from_list 的 key 对应的项目, 同步和异步共用
+        redis_key_all 对应所有项目 (返回 None), 项目的 list key 只对应这一个项目; 项目的 item 必须保存到项目的 zset 中,
+        并同时删除摘要和入队时间, 否则会绕过 project_max_in_flight, 且摘要一直留在摘要集合中, 同一个 item 无法再次添加
+        """
+        if key == self.redis_key_all:
+            return None
+        prefix = "{}:".format(self.redis_key_all)
+        if not key.startswith(prefix):
+            raise ValueError("key must be {} or a project key {}{{project}} in multi tenant mode, got: {}".format(
+                self.redis_key_all, prefix, key))
+        return [key[len(prefix):]]
+
+    def get_project_ts_key(self, project):
+        """
+        多项目模式下项目的 list 中每个 item 的入队时间的 hash key, {item 的摘要: 入队时间}
+        """
+        return "{}:{}:ts".format(self.redis_key_all, project)
+
+    def get_on_key(self, project=None):
+        """
+        保存正在处理的 item 的 zset key, 多项目模式下每个项目使用独立的 zset
+        """
+        if self.multi_tenant:
+            if project is None:
+                raise Exception("project is required in multi tenant mode")
+            return "{}:{}".format(self.redis_key_on, project)
+        return self.redis_key_on
+
+    def _is_projects_expired(self, refresh=False):
+        return refresh or time.time() - self._projects_refreshed > self.project_refresh_interval
+
+    def _set_projects(self, members):
+        self._projects = sorted(_p.decode("utf-8") for _p in members)
+        self._projects_refreshed = time.time()
+        return self._projects
+
+    def get_projects(self, refresh=False):
+        """
+        多项目模式下所有项目的名称, 每隔 project_refresh_interval 秒从 redis_key_projects 中重新读取
+        """
+        if self._is_projects_expired(refresh):
+            return self._set_projects(self.redis_cli.smembers(self.redis_key_projects))
+        return self._projects
+
     def get_list_size(self, key):
         """
         获取 list key 的长度
         """
         return self.redis_cli.llen(key)
 
-    def get_zset_size(self):
+    def get_zset_size(self, project=None):
         """
-        获取 set key 的长度
+        获取 set key 中租约没有过期的 item 的数量
         """
-        return self.redis_cli.zcard(self.redis_key_on)
+        return self.redis_cli.zcount(self.get_on_key(project), "({}".format(self.get_expire_score()), "+inf")
 
     def exists_in_list(self, key, item: dict):
         """
         判断 item 是否存在于 某个 list 中
+        有摘要集合的 list 使用 SISMEMBER 判断, 时间复杂度为 O(1); 其它的 list 需要取出所有的值逐个比较
         """
-        self.redis_cli.ping()
+        set_key = self.get_list_set_key(key)
+        if set_key is not None:
+            if self.redis_cli.sismember(set_key, self.get_digest(self.dict_to_js(item))):
+                logger.info("item exists in {}".format(key))
+                return True
+            return False
 
         # 返回列表, 列表中每个元素都是 bytes 类型的 json.dumps(item)
         values_all = self.redis_cli.lrange(key, start=0, end=-1)
@@ -145,29 +615,55 @@ class FifoRedisQueue(object):
             return True
         return False
 
-    def exists_in_zset(self, item: dict):
+    def _is_lease_alive(self, score):
         """
-        判断 item 是否存在 某个 set 中
+        zset 中的 score 对应的租约是否没有过期, 过期的值视为不存在
         """
-        self.redis_cli.ping()
+        return score is not None and score > self.get_expire_score()
 
-        is_exists = self.redis_cli.zscore(self.redis_key_on, self.dict_to_js(item))
+    def exists_in_zset(self, item: dict):
+        """
+        判断 item 是否存在 某个 set 中, 且租约没有过期
+        """
+        on_key = self.get_on_key(item.get("project"))
+        is_exists = self._is_lease_alive(self.redis_cli.zscore(on_key, self.dict_to_js(item)))
         if is_exists:
-            logger.info("item exists in {}".format(self.redis_key_on))
+            logger.info("item exists in {}".format(on_key))
         return is_exists
 
     def put_to_list(self, item: dict):
         """
         把 item 保存到 list redis_key_all 中
+        删除过期的值, 判断是否已经在 list 或 zset 中, 和添加到 list 中, 在一个 lua 脚本中原子执行, 只需要一次往返
+        多项目模式下保存到项目的 list 中, 同时记录项目名称和入队时间, 所有项目共用一个摘要集合
         """
-        self.redis_cli.ping()
+        if self._is_sweep_due():
+            self.sweep()
+        keys, args = self._get_put_args(item)
+        self._parse_put(item, keys, self._put_to_list(keys=keys, args=args))
 
-        self.remove_expires()
+    def _get_put_args(self, item: dict):
+        """
+        put_to_list 的 lua 脚本的 KEYS 和 ARGV, 同步和异步共用
+        """
+        js_str = self.dict_to_js(item)
+        if self.multi_tenant:
+            keys = [self.get_project_key(item["project"]), self.redis_key_all_set, self.get_on_key(item["project"]),
+                    self.redis_key_projects, self.get_project_ts_key(item["project"])]
+            return keys, [js_str, self.get_expire_score(), self.get_digest(js_str), item["project"], time.time()]
+        keys = [self.redis_key_all, self.redis_key_all_set, self.redis_key_on]
+        return keys, [js_str, self.get_expire_score(), self.get_digest(js_str)]
 
-        if self.exists_in_list(self.redis_key_all, item):
+    def _parse_put(self, item: dict, keys, qsize):
+        """
+        解析 put_to_list 的 lua 脚本的结果, 输出日志
+        """
+        list_key, on_key = keys[0], keys[2]
+
+        if qsize == -1:
             logger.warning(
                 "item already exists in key: {}. project: {}, spider: {}, account: {}".format(
-                    self.redis_key_all,
+                    list_key,
                     item["project"],
                     item["spider"],
                     item["account_info"]["account"],
@@ -175,10 +671,10 @@ class FifoRedisQueue(object):
             )
             return
 
-        if self.exists_in_zset(item):
+        if qsize == -2:
             logger.warning(
                 "item already exists in key_on: {}. project: {}, spider: {}, account: {}".format(
-                    self.redis_key_on,
+                    on_key,
                     item["project"],
                     item["spider"],
                     item["account_info"]["account"],
@@ -186,90 +682,543 @@ class FifoRedisQueue(object):
             )
             return
 
-        # qsize = self.redis_cli.rpush(key, json.dumps(self._sort_keys(item)))
-        qsize = self.redis_cli.rpush(self.redis_key_all, self.dict_to_js(item))
-        logger.info("total {} item in key {}".format(qsize, self.redis_key_all))
+        if qsize == 1:
+            # 添加到了空的 list 中, item 就是 list 中第一个 item, 取出时不需要重试
+            self._list_heads[list_key] = self.dict_to_js(item).encode("utf-8")
+        logger.info("total {} item in key {}".format(qsize, list_key))
 
     def put_to_zset(self, item: dict):
         """
-        把 item 保存到 有序集合中, 记录其加入时间
-        并定时清理 15 分钟前设置的 value
+        把 item 保存到 有序集合中, score 为租约的到期时间
         """
-        self.redis_cli.ping()
-
+        on_key = self.get_on_key(item.get("project"))
         mapping = {
-            self.dict_to_js(item): int(time.time())
+            self.dict_to_js(item): self.get_expire_score() + self.get_lease_seconds(item)
         }
-        # 只有当 值 不存在时 才添加
-        result = self.redis_cli.zadd(self.redis_key_on, mapping, nx=True)
+        # 值不存在, 或者新的到期时间更晚时才更新, 与 zcard 在同一个 pipeline 中发送
+        pipe = self.redis_cli.pipeline(transaction=False)
+        pipe.zadd(on_key, mapping, gt=True)
+        pipe.zcard(on_key)
+        self._log_put_to_zset(on_key, *pipe.execute())
+
+    @staticmethod
+    def _log_put_to_zset(on_key, result, size):
         if result:
             logger.info(
                 "successfully put item to zset: {}. total item: {}".format(
-                    self.redis_key_on,
-                    self.get_zset_size()
+                    on_key,
+                    size
                 )
             )
         else:
-            logger.info("item already in key: {}".format(self.redis_key_on))
+            logger.info("item already in key: {}".format(on_key))
 
     def get_from_list(self, key):
         """
-        从 list 中取出来一个数据
+        从 list 中取出来一个数据, 同时以租约的到期时间为 score 保存到 cookie:on 中 (租约), 取出和保存之间不会丢失 item
+        - 队列不为空时, 取出 item, 删除摘要, 保存到 cookie:on 中, 在一个 lua 脚本中原子执行, 只需要一次往返
+        - 队列为空时, 使用 BLMOVE 阻塞等待, 取到的 item 原子的移动到 processing list 中, 再使用 lua 脚本从 processing list
+          移动到 cookie:on 中; 两步之间进程中断时, item 保留在 processing list 中, 由 reap 放回队列
+        - 多个进程同时调用时, 每个 item 只会被一个进程取出
+        - 多项目模式下 key 为 redis_key_all 时, 按权重从各个项目中取出, 为项目的 list key 时只从这个项目中取出,
+          都保存到项目的 zset 中, 见 get_from_projects
         """
-        self.redis_cli.ping()
+        if self._is_sweep_due():
+            self.sweep()
+        if self.multi_tenant:
+            return self.get_from_projects(self._get_key_projects(key))
 
-        # 执行之前删除 self.expires 之前的值
-        self.remove_expires()
+        while True:
+            keys, args = self._get_pop_args(key)
+            item = self._parse_pop(key, self._pop_from_list(keys=keys, args=args))
+            if item is not False:
+                break
+        if item:
+            return self.js_to_dict(item)
 
-        # 如果队列不为空, 直接取出一个返回
-        if self.get_list_size(key):
-            item = self.redis_cli.lpop(key)
-        else:
-            logger.info("redis key {} is empty, wait for {}s".format(key, self.timeout))
-            # 队列为空时, 阻塞一段时间
-            item = self.redis_cli.blpop(key, self.timeout)
+        logger.info("redis key {} is empty, wait for {}s".format(key, self.timeout))
+        # 队列为空时, 阻塞一段时间, lua 脚本中不能执行阻塞命令
+        if self._is_new_blocking_key(key):
+            self.redis_cli.sadd(self.redis_key_blocking, key)
+        processing_key = self.get_processing_key(key)
+        item = self.redis_cli.blmove(key, processing_key, self.timeout, src="LEFT", dest="RIGHT")
         # 如果获取到了非空的 item, 才把它保存到 cookie:on 中并返回
         if item:
-            self.all_to_on(item=item)
-            # 转换为 dict 再返回
+            keys, args = self._get_lease_args(key, item)
+            return self._parse_lease(key, item, self._lease(keys=keys, args=args))
+
+    def _get_head_args(self, key):
+        """
+        list 中预期的第一个 item (上一次 lua 脚本返回的) 和它的摘要, 没有缓存时为空字符串
+        """
+        head = self._list_heads.get(key)
+        if not head:
+            return ["", ""]
+        return [head, self.get_digest(head.decode("utf-8"))]
+
+    def _is_new_blocking_key(self, key):
+        """
+        本进程第一次在 key 上 BLMOVE 时返回 True, 需要先把 key 保存到 redis_key_blocking 中, 以便 reap 检查它的 processing list
+        """
+        if key in self._blocking_keys:
+            return False
+        self._blocking_keys.add(key)
+        return True
+
+    def _get_pop_args(self, key):
+        """
+        get_from_list 的 lua 脚本的 KEYS 和 ARGV, 同步和异步共用
+        """
+        set_key = self.get_list_set_key(key)
+        keys = [key, self.redis_key_on] + ([set_key] if set_key else [])
+        return keys, [self.get_expire_score(), 60 * self.expire] + self._get_head_args(key)
+
+    def _parse_pop(self, key, result):
+        """
+        解析 get_from_list 的 lua 脚本的结果, 缓存 list 中新的第一个 item
+        :return: 取出的 item, list 为空时为 None, 第一个 item 与预期的不同 (需要重试) 时为 False
+        """
+        if result[0]:
+            self._list_heads[key] = result[2]
+            return result[1]
+        self._list_heads[key] = result[1]
+        return False if result[1] else None
+
+    def _get_lease_args(self, key, item):
+        """
+        BLMOVE 之后完成租约的 lua 脚本的 KEYS 和 ARGV, 同步和异步共用
+        """
+        set_key = self.get_list_set_key(key)
+        keys = [self.get_processing_key(key), self.redis_key_on] + ([set_key] if set_key else [])
+        return keys, [item, self.get_expire_score(), 60 * self.expire, self.get_digest(item.decode("utf-8"))]
+
+    def _parse_lease(self, key, item, result):
+        """
+        租约成功时返回 dict 格式的 item, item 已经被 reap 放回队列中时返回 None
+        """
+        if not result:
+            logger.warning("item has been requeued by reaper, skip it. key: {}".format(key))
+            return None
+        # 转换为 dict 再返回
+        return self.js_to_dict(item)
+
+    def _get_weight(self, project):
+        return self.project_weights.get(project, 1)
+
+    def _get_project_order(self, projects):
+        """
+        平滑加权轮询 (与 nginx 的 smooth weighted round-robin 相同): 每次把每个项目当前的权重加上它的权重,
+        按当前的权重从大到小排列, 取出 item 的项目的当前权重再减去所有项目的权重之和
+        排在前面的项目为空或者正在处理的数量达到上限时, 依次尝试后面的项目
+        """
+        for project in projects:
+            self._wrr_current[project] = self._wrr_current.get(project, 0) + self._get_weight(project)
+        return sorted(projects, key=lambda _p: self._wrr_current[_p], reverse=True)
+
+    def _update_project_order(self, projects, project):
+        """
+        更新取出 item 的项目的当前权重, 没有取出 item 时 project 为 None
+        被跳过的项目的当前权重不超过所有项目的权重之和, 以免一个长时间为空的项目有了 item 之后连续被选中
+        """
+        total = sum(self._get_weight(_p) for _p in projects)
+        if project is None:
+            for _p in projects:
+                self._wrr_current[_p] -= self._get_weight(_p)
+            return
+        self._wrr_current[project] -= total
+        for _p in projects:
+            self._wrr_current[_p] = min(self._wrr_current[_p], total)
+
+    def _record_wait(self, project, enqueued):
+        """
+        记录 item 在队列中的等待时间
+        """
+        if enqueued is None:
+            return
+        wait = max(time.time() - float(enqueued), 0)
+        stats = self.project_wait_stats.setdefault(project, dict(count=0, sum=0.0, max=0.0))
+        stats["count"] += 1
+        stats["sum"] += wait
+        stats["max"] = max(stats["max"], wait)
+
+    def get_from_projects(self, projects=None):
+        """
+        多项目模式下, 按平滑加权轮询的顺序从各个项目的 list 中取出一个 item, 跳过 zset 中正在处理的数量达到上限的项目,
+        判断, 取出和保存到项目的 zset 中在一个 lua 脚本中原子执行
+        所有项目都没有可以取出的 item 时, 每隔 0.5 秒重试一次, 最多等待 timeout 秒
+        :param projects: 只从这些项目中取出, 默认为所有项目
+        """
+        deadline = time.time() + self.timeout
+        while True:
+            _projects = projects or self.get_projects()
+            if _projects:
+                order = self._get_project_order(_projects)
+                while True:
+                    keys, args = self._get_projects_pop_args(order)
+                    item = self._parse_projects_pop(_projects, order, self._pop_from_projects(keys=keys, args=args))
+                    if item is not False:
+                        break
+                if item:
+                    return item
+
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None
+            time.sleep(min(0.5, remaining))
+            # 等待期间可能有新的项目
+            if projects is None:
+                self.get_projects(refresh=True)
+
+    def _get_projects_pop_args(self, order):
+        """
+        get_from_projects 的 lua 脚本的 KEYS 和 ARGV, 同步和异步共用
+        """
+        keys, args = [self.redis_key_all_set], [self.get_expire_score(), 60 * self.expire]
+        for project in order:
+            keys += [self.get_project_key(project), self.get_on_key(project), self.get_project_ts_key(project)]
+            args += [self.project_max_in_flight.get(project, 0)] + self._get_head_args(self.get_project_key(project))
+        return keys, args
+
+    def _parse_projects_pop(self, projects, order, result):
+        """
+        解析 get_from_projects 的 lua 脚本的结果, 更新平滑加权轮询的权重, 返回 dict 格式的 item, 没有取出时返回 None
+        项目的 list 中第一个 item 与预期的不同时, 缓存实际的第一个 item, 返回 False, 按相同的顺序重试
+        """
+        index, item = result[0], result[1]
+        if index < 0:
+            self._list_heads[self.get_project_key(order[-index - 1])] = item
+            return False
+        project = order[index - 1] if index else None
+        self._update_project_order(projects, project)
+        if item:
+            self._list_heads[self.get_project_key(project)] = result[3]
+            self._record_wait(project, result[2])
             return self.js_to_dict(item)
 
-    def remove_expires(self):
+    def get_project_stats(self):
         """
-        从 zset 中删除掉 self.expire 之前的值
-        执行每条命令之前都先执行一下 remove_expires 的命令
-        :return:
+        多项目模式下每个项目的队列长度, 正在处理的数量, 队列中最早的 item 已经等待的秒数,
+        以及本进程取出的 item 的等待时间的次数, 平均值和最大值
         """
-        self.redis_cli.ping()
+        projects = self.get_projects(refresh=True)
+        pipe = self.redis_cli.pipeline(transaction=False)
+        self._queue_project_stats(pipe, projects)
+        results = pipe.execute()
 
-        # 删除 score 在 15 分钟之前的值
-        result = self.redis_cli.zremrangebyscore(
-            name=self.redis_key_on,
-            min=0,
-            max=int(time.time()) - 60 * self.expire
-        )
-        if result:
-            logger.info(
-                "successfully remove {} expired item from key: {}".format(
-                    result,
-                    self.redis_key_on
-                )
+        pipe = self.redis_cli.pipeline(transaction=False)
+        self._queue_project_heads(pipe, projects, results)
+        return self._parse_project_stats(projects, results, pipe.execute())
+
+    def _queue_project_stats(self, pipe, projects):
+        """
+        把每个项目的 llen, zcard 和 lindex 命令添加到 pipeline 中, 同步和异步共用
+        """
+        for project in projects:
+            pipe.llen(self.get_project_key(project))
+            pipe.zcount(self.get_on_key(project), "({}".format(self.get_expire_score()), "+inf")
+            pipe.lindex(self.get_project_key(project), 0)
+
+    def _queue_project_heads(self, pipe, projects, results):
+        """
+        把读取每个项目的 list 中第一个 item 的入队时间的 hget 命令添加到 pipeline 中
+        """
+        for _i, project in enumerate(projects):
+            head = results[_i * 3 + 2]
+            pipe.hget(self.get_project_ts_key(project), self.get_digest(head.decode("utf-8")) if head else "")
+
+    def _parse_project_stats(self, projects, results, enqueued_list):
+        """
+        汇总 _queue_project_stats 和 _queue_project_heads 的结果
+        """
+        now = time.time()
+        stats = {}
+        for _i, project in enumerate(projects):
+            wait_stats = self.project_wait_stats.get(project, dict(count=0, sum=0.0, max=0.0))
+            stats[project] = dict(
+                depth=results[_i * 3],
+                in_flight=results[_i * 3 + 1],
+                weight=self._get_weight(project),
+                max_in_flight=self.project_max_in_flight.get(project, 0),
+                oldest_wait=now - float(enqueued_list[_i]) if enqueued_list[_i] else 0,
+                wait_count=wait_stats["count"],
+                wait_avg=wait_stats["sum"] / wait_stats["count"] if wait_stats["count"] else 0,
+                wait_max=wait_stats["max"],
             )
-        # else:
-        #     logger.info("no expire item in key: {}".format(self.redis_key_on))
+        return stats
+
+    def _get_on_keys(self, projects):
+        """
+        所有保存正在处理的 item 的 zset key, 多项目模式下包括所有项目的 zset
+        """
+        return [self.redis_key_on] + [self.get_on_key(_project) for _project in projects]
+
+    def _is_sweep_due(self):
+        """
+        距离上一次清理已经超过 sweep_interval 秒, 同步和异步共用
+        """
+        if not self.sweep_interval or time.time() - self._last_sweep < self.sweep_interval:
+            return False
+        self._last_sweep = time.time()
+        return True
+
+    def _get_sweep_targets(self, projects, batch_size, expired_list=None):
+        """
+        清理过期值时每个 zset 对应的 lua 脚本, KEYS 和 ARGV, 同步和异步共用
+        requeue_expires 为 True 时放回队列, expired_list 为 _queue_expired_items 读取的每个 zset 中过期的 item; 否则删除
+        """
+        if self.requeue_expires:
+            return [
+                (self._requeue_expires, keys, self._get_requeue_args(args, items))
+                for (keys, args), items in zip(self._get_requeue_targets(projects), expired_list) if items
+            ]
+        return [(self._remove_expires, [on_key], [self.get_expire_score(), batch_size])
+                for on_key in self._get_on_keys(projects)]
+
+    def _log_sweep(self, total):
+        if self.requeue_expires:
+            self._log_requeue_expires(total)
+        else:
+            self._log_expires(total)
+
+    def sweep(self, batch_size=None):
+        """
+        清理一批过期的值: 每个 zset 最多处理 batch_size (默认为 sweep_batch_size) 个, 所有 zset 在一个 pipeline 中发送,
+        只需要一次往返 (放回队列时两次), 每次清理的耗时有上限; put_to_list 和 get_from_list 中每隔 sweep_interval 秒调用一次
+        :return: 本次处理的过期值的数量
+        """
+        batch_size = batch_size or self.sweep_batch_size
+        projects = self.get_projects() if self.multi_tenant else []
+        expired_list = None
+        if self.requeue_expires:
+            # 放回队列之前先读取过期的 item, 以便计算摘要, 多一次往返
+            pipe = self.redis_cli.pipeline(transaction=False)
+            self._queue_expired_items(pipe, self._get_requeue_targets(projects), batch_size)
+            expired_list = pipe.execute()
+        pipe = self.redis_cli.pipeline(transaction=False)
+        for script, keys, args in self._get_sweep_targets(projects, batch_size, expired_list):
+            script(keys=keys, args=args, client=pipe)
+        total = sum(pipe.execute())
+        self._log_sweep(total)
+        return total
+
+    def remove_expires(self, batch_size=1000):
+        """
+        分批删除 zset 中所有租约过期的值, 每批在一个 lua 脚本中执行, 以免长时间阻塞 redis
+        过期的值在删除之前不影响 put_to_list 和 get_from_list 的结果, 不需要在每次调用之前删除
+        :return: 删除的数量
+        """
+        total = 0
+        for on_key in self._get_on_keys(self.get_projects() if self.multi_tenant else []):
+            while True:
+                count = self._remove_expires(keys=[on_key], args=[self.get_expire_score(), batch_size])
+                total += count
+                if count < batch_size:
+                    break
+        self._log_expires(total)
+        return total
+
+    def _get_requeue_targets(self, projects):
+        """
+        requeue_expires_batch 中每个 zset 对应的 lua 脚本的 KEYS 和 ARGV 中的入队时间, 同步和异步共用
+        """
+        targets = [([self.redis_key_on, self.redis_key_all, self.redis_key_all_set], [0])]
+        targets += [
+            ([self.get_on_key(_project), self.get_project_key(_project), self.redis_key_all_set,
+              self.get_project_ts_key(_project)], [time.time()])
+            for _project in projects
+        ]
+        return targets
+
+    def _queue_expired_items(self, pipe, targets, batch_size):
+        """
+        把读取每个 zset 中一批租约过期的 item 的命令添加到 pipeline 中, 同步和异步共用
+        """
+        for keys, _ in targets:
+            pipe.zrangebyscore(keys[0], 0, self.get_expire_score(), start=0, num=batch_size)
+
+    def _get_requeue_args(self, args, items):
+        """
+        requeue_expires 的 lua 脚本的 ARGV: 当前时间, 入队时间, 之后依次为每个 item 和它的摘要
+        """
+        _args = [self.get_expire_score()] + args
+        for item in items:
+            _args += [item, self.get_digest(item.decode("utf-8"))]
+        return _args
+
+    def _log_requeue_expires(self, total):
+        if total:
+            logger.info("successfully requeue {} expired item from key: {} to key: {}".format(
+                total, self.redis_key_on, self.redis_key_all))
+
+    def requeue_expires_batch(self, batch_size=1000):
+        """
+        把 cookie:on 中租约过期的 item 分批放回 redis_key_all 的尾部, 每批在一个 lua 脚本中执行, 以免长时间阻塞 redis
+        多项目模式下把每个项目的 zset 中租约过期的 item 放回项目的 list 中
+        :return: 放回队列的 item 数量
+        """
+        total = 0
+        for keys, args in self._get_requeue_targets(self.get_projects() if self.multi_tenant else []):
+            while True:
+                items = self.redis_cli.zrangebyscore(keys[0], 0, self.get_expire_score(), start=0, num=batch_size)
+                if items:
+                    total += self._requeue_expires(keys=keys, args=self._get_requeue_args(args, items))
+                if len(items) < batch_size:
+                    break
+        self._log_requeue_expires(total)
+        return total
+
+    def requeue_processing(self):
+        """
+        把 processing list 中连续两次 reap 都存在的 item 放回对应的 list 的头部
+        这些 item 在 BLMOVE 之后, 进程没有来得及完成租约就中断了; 刚刚 BLMOVE 的 item 要等到下一次 reap 才会处理,
+        即使被放回, get_from_list 中的租约也会失败, 不会出现一个 item 同时在队列和 cookie:on 中的情况
+        检查 redis_key_all 和 redis_key_blocking 中所有 list key 的 processing list, 所有的读取和放回各使用一个 pipeline
+        :return: 放回队列的 item 数量
+        """
+        keys = self._get_blocking_keys(self.redis_cli.smembers(self.redis_key_blocking))
+        pipe = self.redis_cli.pipeline(transaction=False)
+        for key in keys:
+            pipe.lrange(self.get_processing_key(key), 0, -1)
+        targets = self._get_processing_targets(keys, pipe.execute())
+        if not targets:
+            return 0
+        pipe = self.redis_cli.pipeline(transaction=False)
+        for _keys, args in targets:
+            self._requeue_processing(keys=_keys, args=args, client=pipe)
+        return self._log_requeue_processing(targets, pipe.execute())
+
+    def _get_blocking_keys(self, members):
+        """
+        需要检查 processing list 的 list key: redis_key_all 和 redis_key_blocking 中的所有 key, 同步和异步共用
+        """
+        return [self.redis_key_all] + sorted({_m.decode("utf-8") for _m in members} - {self.redis_key_all})
+
+    def _get_processing_targets(self, keys, values_list):
+        """
+        每个有中断的 item 的 processing list 对应的 lua 脚本的 KEYS 和 ARGV, 同步和异步共用
+        """
+        targets = []
+        for key, values in zip(keys, values_list):
+            processing_key = self.get_processing_key(key)
+            stale = self._get_stale_processing(processing_key, values)
+            if stale:
+                set_key = self.get_list_set_key(key)
+                targets.append(([processing_key, key] + ([set_key] if set_key else []), self._get_processing_args(stale)))
+        return targets
+
+    def _get_stale_processing(self, processing_key, values):
+        """
+        processing list 中连续两次 reap 都存在的 item, 同步和异步共用
+        """
+        current = set(values)
+        stale = current & self._processing_seen.get(processing_key, set())
+        self._processing_seen[processing_key] = current - stale
+        return list(stale)
+
+    def _get_processing_args(self, items):
+        """
+        requeue_processing 的 lua 脚本的 ARGV: 依次为每个 item 和它的摘要
+        """
+        args = []
+        for item in items:
+            args += [item, self.get_digest(item.decode("utf-8"))]
+        return args
+
+    @staticmethod
+    def _log_requeue_processing(targets, counts):
+        for (keys, _), count in zip(targets, counts):
+            if count:
+                logger.warning("requeue {} item from key: {} to key: {}".format(count, keys[0], keys[1]))
+        return sum(counts)
+
+    def reap(self, batch_size=1000):
+        """
+        放回 processing list 中中断的 item, 以及处理 cookie:on 中租约过期的 item:
+        requeue_expires 为 True 时放回队列, 否则删除
+        """
+        self.requeue_processing()
+        if self.requeue_expires:
+            self.requeue_expires_batch(batch_size)
+        else:
+            self.remove_expires(batch_size)
+
+    def _run_reaper(self, interval, batch_size):
+        while not self._reaper_stop.wait(interval):
+            try:
+                self.reap(batch_size)
+            except Exception as e:
+                logger.error("error reap expired items. error: {}".format(e))
+
+    def start_reaper(self, interval=30, batch_size=1000):
+        """
+        启动后台线程, 每隔 interval 秒执行一次 reap, 多个进程可以同时运行, 每个 item 只会被放回一次
+        """
+        if self._reaper is not None and self._reaper.is_alive():
+            return
+        self._reaper_stop.clear()
+        self._reaper = threading.Thread(target=self._run_reaper, args=(interval, batch_size), daemon=True)
+        self._reaper.start()
+
+    def stop_reaper(self):
+        """
+        停止后台线程
+        """
+        if self._reaper is not None:
+            self._reaper_stop.set()
+            self._reaper.join()
+            self._reaper = None
 
     def remove_from_zset(self, item: dict):
         """
         从 set 中删除 item
         用于当获取 cookie 成功并更新到 mysql 之后, 从 set key 中删除
         """
-        self.redis_cli.ping()
+        on_key = self.get_on_key(item.get("project"))
+        self._log_remove_from_zset(on_key, self.redis_cli.zrem(on_key, self.dict_to_js(item)))
 
-        result = self.redis_cli.zrem(self.redis_key_on, self.dict_to_js(item))
+    @staticmethod
+    def _log_remove_from_zset(on_key, result):
         if result:
-            logger.info("successfully remove item from key: {}".format(self.redis_key_on))
+            logger.info("successfully remove item from key: {}".format(on_key))
         else:
-            logger.info("item doesnt exists in key: {}".format(self.redis_key_on))
+            logger.info("item doesnt exists in key: {}".format(on_key))
+
+
+def main_benchmark(settings: scrapy.settings.Settings, n=10000, key_prefix="benchmark:"):
+    """
+    测试 put_to_list 和 get_from_list 的吞吐量
+    使用 key_prefix 开头的 key, 不影响线上的 cookie:all 和 cookie:on, 测试结束后删除
+    本机 redis-server 上每次往返约 0.05 ms, 往返次数越少, 吞吐量越高
+    """
+    q = FifoRedisQueue(settings)
+    keys = (q.redis_key_all, q.redis_key_on, q.redis_key_all_set)
+    q.redis_key_all, q.redis_key_on, q.redis_key_all_set = ["{}{}".format(key_prefix, _k) for _k in keys]
+    q.redis_cli.delete(q.redis_key_all, q.redis_key_on, q.redis_key_all_set)
+    # 每次 put 和 get 都会输出 info 日志, 测试时只输出 warning
+    level = logger.level
+    logger.setLevel(logging.WARNING)
+
+    items = [
+        dict(project="benchmark", spider="benchmark", account_info=dict(account=str(_i), password="password"))
+        for _i in range(n)
+    ]
+    try:
+        start = time.perf_counter()
+        for item in items:
+            q.put_to_list(item)
+        put_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for _ in range(n):
+            q.get_from_list(q.redis_key_all)
+        get_seconds = time.perf_counter() - start
+    finally:
+        q.redis_cli.delete(q.redis_key_all, q.redis_key_on, q.redis_key_all_set)
+        q.redis_key_all, q.redis_key_on, q.redis_key_all_set = keys
+        logger.setLevel(level)
+
+    print("put_to_list: {} items, {:.2f}s, {:.0f} items/s".format(n, put_seconds, n / put_seconds))
+    print("get_from_list: {} items, {:.2f}s, {:.0f} items/s".format(n, get_seconds, n / get_seconds))
 
 
 if __name__ == '__main__':
@@ -278,3 +1227,4 @@ if __name__ == '__main__':
     q = FifoRedisQueue(settings)
     q.put_to_list(item=dict(account='account', password='password'))
     q.put_to_zset(item=dict(account='account', password='password'))
+    # main_benchmark(settings)
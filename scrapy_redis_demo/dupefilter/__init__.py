@@ -0,0 +1,457 @@
+# -*- coding: utf-8 -*-
+# 使用 内存型 和 redis 型两层布隆过滤器 对请求进行去重
+# scrapy_redis.dupefilter.RFPDupeFilter 在 redis 的 set 中保存每个请求的 40 字节的 sha1 指纹, 内存占用随请求数量线性增长,
+# 这里使用固定大小的 redis bitmap 代替 set, 并在每个节点的内存中再使用一个布隆过滤器, 减少对 redis 的访问
+# 在 settings 中设置 DUPEFILTER_CLASS = "dupefilter.BloomDupeFilter" 即可使用
+import logging
+import os
+import sys
+
+from scrapy import signals
+from scrapy.dupefilters import BaseDupeFilter
+from scrapy.exceptions import DontCloseSpider
+from twisted.internet import defer, task, threads
+
+try:
+    # scrapy >= 2.7
+    from scrapy.utils.request import fingerprint as request_fingerprint
+except ImportError:
+    from scrapy.utils.request import request_fingerprint
+
+# bloom_filter 中的模块使用的是平级导入
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'bloom_filter'))
+
+from bloom_filter_metrics import dump_prometheus, metrics_to_stats  # noqa: E402
+from memory_bloom_filter import BloomFilterMemory  # noqa: E402
+from redis_bloom_filter import BloomFilterRedis  # noqa: E402
+
+logger = logging.getLogger(__name__)
+
+# 内存型布隆过滤器的默认配置, 每个节点对 1000W 个请求进行去重
+BLOOM_DUPEFILTER_MEMORY_CONFIG = dict(
+    data_size_per_filter=10 ** 7,
+    memory_size=100,
+    hash_seeds_num=5,
+    error_rate_threshold=1e-6,
+)
+
+# redis 型布隆过滤器的默认配置, 对 1.4 亿个请求进行去重, 使用 500M 内存, 误判率 十万分之一
+BLOOM_DUPEFILTER_REDIS_CONFIG = dict(
+    data_size_per_key=14 * 10 ** 7,
+    memory_size=500,
+    hash_seeds_num=8,
+    error_rate_threshold=1e-5,
+)
+
+
+class BloomDupeFilter(BaseDupeFilter):
+    """
+    两层布隆过滤器去重
+    - 先使用本节点的内存型布隆过滤器判断, 内存中已经存在的请求, redis 中也肯定存在, 不需要再访问 redis
+    - 内存中不存在的请求, 再使用所有节点共用的 redis 型布隆过滤器判断并添加
+    - 在爬虫中运行时, 内存中不存在的请求先暂存起来, 每隔 flush_interval 秒或达到 batch_size 个时,
+      使用一次 add_if_absent_many 批量判断并添加到 redis 中, redis 中也不存在的请求再重新交给 engine 调度,
+      暂存的请求在 request_seen 中返回 True, scrapy 会发送 request_dropped 信号, 但不会记录为重复请求
+    - 访问 redis 都在 reactor 的线程池中执行 (deferToThread), 不会阻塞 reactor, 同一时间只有一个线程使用 bf_redis,
+      导出监控指标在正在执行的 flush 结束之后开始, 导出期间不开始新的 flush
+    - 批量判断和添加不是原子操作, 多个节点在同一批次中添加相同的请求时, 可能会重复抓取, 需要严格不重复时, 把 batch_size 设置为 1,
+      每个请求都使用 lua 脚本原子的判断并添加
+    - 没有 crawler 时 (如 exe_gen_seeds 中的 SeedsSpider, 没有运行 reactor) 在 request_seen 中直接访问 redis
+    - 每一层的命中数量和命中率保存在 scrapy stats 中, 如 bloom_dupefilter/memory/hit_ratio
+    - 开启 metrics 时, 每隔 metrics_interval 秒和爬虫关闭时, 把两层过滤器的调用次数, 探测的 bit 位数量和延迟
+      保存到 scrapy stats 中, 如 bloom_dupefilter/memory/exists/latency_p99_ms, 同时开启 metrics_fill_ratio 时,
+      还会保存填充率和估算的误判率, 如 bloom_dupefilter/redis/fill_ratio,
+      设置了 prometheus_file 时, 同时写入 prometheus 的文本格式, 在误判率明显上升之前发现过滤器快要饱和
+
+    settings 中的配置
+    - BLOOM_DUPEFILTER_KEY: redis 中布隆过滤器的 key, 默认为 dupefilter:%(spider)s, 元数据和数据量分别保存在 {key}_meta 和 {key}_count 中
+    - BLOOM_DUPEFILTER_MEMORY_CONFIG: 内存型布隆过滤器的配置, 与 BloomFilterMemory 的 bf_config 相同
+    - BLOOM_DUPEFILTER_REDIS_CONFIG: redis 型布隆过滤器的配置, 与 BloomFilterRedis 的 bf_config 相同
+    - BLOOM_DUPEFILTER_BATCH_SIZE: 批量访问 redis 时每一批的最大数量, 默认为 1000
+    - BLOOM_DUPEFILTER_FLUSH_INTERVAL: 批量访问 redis 的间隔秒数, 默认为 1
+    - BLOOM_DUPEFILTER_METRICS: 是否记录两层过滤器的监控指标, 默认为 False
+    - BLOOM_DUPEFILTER_METRICS_INTERVAL: 导出监控指标的间隔秒数, 默认为 60
+    - BLOOM_DUPEFILTER_METRICS_FILL_RATIO: 导出监控指标时是否计算填充率和估算的误判率, 默认为 False,
+      开启后每次导出都会对 redis 中所有的 filter key 执行 BITCOUNT (每个最大 512MB), 会阻塞 redis, 导出间隔不要太短
+    - BLOOM_DUPEFILTER_PROMETHEUS_FILE: prometheus 文本格式的监控指标文件路径, 可以使用 %(spider)s, 默认为 None, 不写入文件
+    - REDIS_CONFIG: redis 数据库的配置信息, 包含 host, port, db, password (或 url),
+      以及 max_connections, health_check_interval, socket_keepalive 等连接池参数, 见 redis_bloom_filter.get_pool_kwargs
+    """
+
+    def __init__(self, bf_memory, bf_redis, crawler=None, batch_size=1000, flush_interval=1, debug=False,
+                 metrics_interval=60, prometheus_file=None, metrics_fill_ratio=False):
+        """
+        :param bf_memory: 内存型布隆过滤器
+        :param bf_redis: redis 型布隆过滤器
+        :param crawler: 在爬虫中运行时的 crawler, 用于记录 stats 和 重新调度请求, 为 None 时同步访问 redis
+        :param batch_size: 批量访问 redis 时每一批的最大数量, 为 1 时每个请求都使用 add_if_absent 原子的判断并添加
+        :param flush_interval: 批量访问 redis 的间隔秒数
+        :param debug: 是否记录所有的重复请求
+        :param metrics_interval: 导出监控指标的间隔秒数, 为 0 时只在爬虫关闭时导出
+        :param prometheus_file: prometheus 文本格式的监控指标文件路径
+        :param metrics_fill_ratio: 导出监控指标时是否计算填充率和估算的误判率
+        """
+        self.bf_memory = bf_memory
+        self.bf_redis = bf_redis
+        self.crawler = crawler
+        self.stats = crawler.stats if crawler else None
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.debug = debug
+        self.logdupes = True
+        self.metrics_interval = metrics_interval
+        self.prometheus_file = prometheus_file
+        self.metrics_fill_ratio = metrics_fill_ratio
+
+        # 批量模式下暂存的 (指纹, 请求)
+        self._pending = []
+        # 最近一个被暂存的请求, log 中不把它记录为重复请求
+        self._last_pending = None
+        # redis 中不存在, 重新交给 engine 调度的请求的指纹, 再次经过 request_seen 时直接放行
+        self._passed = set()
+        self._flush_task = None
+        # 正在线程池中访问 redis 的 flush, 同一时间只有一个
+        self._flushing = None
+        self._closed = False
+        self._metrics_task = None
+        # 正在线程池中导出的监控指标, 同一时间只有一个, 导出期间不开始新的 flush
+        self._exporting = None
+        self._hits = dict(memory=0, redis=0)
+        self._misses = dict(memory=0, redis=0)
+
+        if self.crawler is not None:
+            # scrapy_redis 的 scheduler 不会调用 dupefilter 的 open 和 close, 使用信号处理
+            self.crawler.signals.connect(self.close, signal=signals.spider_closed)
+            if self.is_metrics and self.metrics_interval > 0:
+                # 在爬虫中实例化时, reactor 已经安装
+                self._metrics_task = task.LoopingCall(self._try_export_metrics)
+                self._metrics_task.start(self.metrics_interval, now=False)
+        if self.is_batch:
+            self.crawler.signals.connect(self._spider_idle, signal=signals.spider_idle)
+
+    @property
+    def is_batch(self):
+        """
+        是否暂存请求, 在线程池中访问 redis, 只有在爬虫中运行时才能重新调度请求
+        """
+        return self.crawler is not None
+
+    @property
+    def is_metrics(self):
+        """
+        是否记录了监控指标
+        """
+        return self.bf_memory.metrics is not None or self.bf_redis.metrics is not None
+
+    @classmethod
+    def from_spider(cls, spider):
+        """
+        scrapy_redis.scheduler.Scheduler.open 中调用, 按照 spider.name 生成 redis key
+        exe_gen_seeds 中的 SeedsSpider 没有 crawler, 此时只使用同步模式
+        """
+        settings = spider.settings
+        key = settings.get('BLOOM_DUPEFILTER_KEY', 'dupefilter:%(spider)s') % {'spider': spider.name}
+        redis_db_config = settings.getdict('REDIS_CONFIG') or dict(
+            host=settings.get('REDIS_HOST', '127.0.0.1'),
+            port=settings.getint('REDIS_PORT', 6379),
+        )
+        metrics = settings.getbool('BLOOM_DUPEFILTER_METRICS', False)
+        bf_memory = BloomFilterMemory(dict(
+            settings.getdict('BLOOM_DUPEFILTER_MEMORY_CONFIG', BLOOM_DUPEFILTER_MEMORY_CONFIG), metrics=metrics))
+        bf_redis = BloomFilterRedis(
+            redis_db_config,
+            dict(bloom_filter_key=key, redis_meta_key='{}_meta'.format(key), redis_count_key='{}_count'.format(key)),
+            dict(settings.getdict('BLOOM_DUPEFILTER_REDIS_CONFIG', BLOOM_DUPEFILTER_REDIS_CONFIG), metrics=metrics),
+        )
+        prometheus_file = settings.get('BLOOM_DUPEFILTER_PROMETHEUS_FILE')
+        return cls(
+            bf_memory,
+            bf_redis,
+            crawler=getattr(spider, 'crawler', None),
+            batch_size=settings.getint('BLOOM_DUPEFILTER_BATCH_SIZE', 1000),
+            flush_interval=settings.getfloat('BLOOM_DUPEFILTER_FLUSH_INTERVAL', 1),
+            debug=settings.getbool('DUPEFILTER_DEBUG'),
+            metrics_interval=settings.getfloat('BLOOM_DUPEFILTER_METRICS_INTERVAL', 60),
+            prometheus_file=prometheus_file % {'spider': spider.name} if prometheus_file else None,
+            metrics_fill_ratio=settings.getbool('BLOOM_DUPEFILTER_METRICS_FILL_RATIO', False),
+        )
+
+    def request_fingerprint(self, request):
+        """
+        请求的指纹, 优先使用 crawler 中配置的 REQUEST_FINGERPRINTER_CLASS
+        """
+        if self.crawler is not None and hasattr(self.crawler, 'request_fingerprinter'):
+            fp = self.crawler.request_fingerprinter.fingerprint(request)
+        else:
+            fp = request_fingerprint(request)
+        return fp.hex() if isinstance(fp, bytes) else fp
+
+    def open(self):
+        """
+        批量模式下, 定时把暂存的请求批量发送到 redis 中, 在第一次暂存请求时调用, 此时 reactor 已经在运行
+        """
+        if self._flush_task is None:
+            self._flush_task = task.LoopingCall(self.flush)
+            self._flush_task.start(self.flush_interval, now=False)
+
+    def request_seen(self, request):
+        """
+        判断请求是否已经存在
+        :return: True 表示请求已经存在, 或者在批量模式下暂存起来了, scheduler 不会把它放入队列中
+        """
+        fp = self.request_fingerprint(request)
+        if fp in self._passed:
+            self._passed.discard(fp)
+            return False
+
+        # 内存中已经存在的请求, redis 中也肯定存在, 或者在暂存的请求中
+        if self.bf_memory.exists(fp):
+            self._inc_stats('memory', hit=True)
+            return True
+        self.bf_memory.add(fp)
+        self._inc_stats('memory', hit=False)
+
+        if not self.is_batch:
+            is_exists = self.bf_redis.add_if_absent(fp)
+            self._inc_stats('redis', hit=is_exists)
+            return is_exists
+
+        self.open()
+        self._pending.append((fp, request))
+        self._last_pending = request
+        if len(self._pending) >= self.batch_size:
+            # 在函数中导入 reactor, 以免在 scrapy 安装 TWISTED_REACTOR 之前安装默认的 reactor
+            from twisted.internet import reactor
+            # 不在 scheduler.enqueue_request 中重新调度请求, 而是在下一次 reactor 循环中发送
+            reactor.callLater(0, self.flush)
+        return True
+
+    def requests_seen_many(self, requests):
+        """
+        批量判断请求是否已经存在, 并添加到两层过滤器中, 同一批请求中重复出现的请求, 只有第一次出现时被认为是不存在的
+        内存型和 redis 型都只需要一次批量操作, exe_gen_seeds 中一次生成大量请求时使用
+        :return: 与 requests 等长的 bool 列表, True 表示请求已经存在
+        """
+        fps = [self.request_fingerprint(_request) for _request in requests]
+        mask = [bool(_is_exists) for _is_exists in self.bf_memory.add_if_absent_many(fps)]
+        _absent = [_i for _i, _is_exists in enumerate(mask) if not _is_exists]
+        self._inc_stats('memory', hit=True, count=len(fps) - len(_absent))
+        self._inc_stats('memory', hit=False, count=len(_absent))
+
+        for _i, _is_exists in zip(_absent, self.bf_redis.add_if_absent_many([fps[_i] for _i in _absent])):
+            mask[_i] = _is_exists
+            self._inc_stats('redis', hit=_is_exists)
+        return mask
+
+    def _add_if_absent_many(self, fps):
+        """
+        在线程池中执行, batch_size 为 1 时使用 lua 脚本原子的判断并添加
+        """
+        if self.batch_size == 1:
+            return [self.bf_redis.add_if_absent(_fp) for _fp in fps]
+        return self.bf_redis.add_if_absent_many(fps)
+
+    def flush(self):
+        """
+        把暂存的请求批量发送到 redis 中判断并添加, redis 中不存在的请求重新交给 engine 调度
+        访问 redis 在线程池中执行, 已经有 flush 在执行时直接返回它的 Deferred, 正在导出监控指标时等导出结束后再发送
+        :return: Deferred, 结果为重新调度的请求数量
+        """
+        if self._flushing is not None:
+            return self._flushing
+        if self._exporting is not None:
+            return defer.succeed(0)
+        if not self._pending:
+            return defer.succeed(0)
+        pending, self._pending = self._pending[:self.batch_size], self._pending[self.batch_size:]
+        self._flushing = threads.deferToThread(self._add_if_absent_many, [_fp for _fp, _ in pending])
+        self._flushing.addCallback(self._schedule, pending)
+        self._flushing.addErrback(self._flush_failed, pending)
+        self._flushing.addBoth(self._flush_done)
+        return self._flushing
+
+    def _flush_failed(self, failure, pending):
+        """
+        redis 暂时不可用时, 把这一批请求放回暂存列表的头部, 下一次 flush 时重试
+        """
+        logger.warning('failed to flush {} pending requests to redis: {}'.format(len(pending), failure.value))
+        if not self._closed:
+            self._pending[:0] = pending
+        return 0
+
+    def _flush_done(self, scheduled):
+        """
+        flush 结束后, 暂存的请求还有 batch_size 个时继续发送
+        """
+        self._flushing = None
+        self._flush_if_full()
+        return scheduled
+
+    def _flush_if_full(self):
+        """
+        暂存的请求还有 batch_size 个时, 在下一次 reactor 循环中继续发送
+        """
+        if not self._closed and len(self._pending) >= self.batch_size:
+            from twisted.internet import reactor
+            reactor.callLater(0, self.flush)
+
+    def _schedule(self, mask, pending):
+        """
+        在 reactor 线程中处理 add_if_absent_many 的结果, redis 中不存在的请求重新交给 engine 调度
+        :return: 重新调度的请求数量
+        """
+        if self.stats:
+            self.stats.inc_value('bloom_dupefilter/redis/batches')
+        if self._closed:
+            logger.warning('{} requests are dropped without crawling after dupefilter closed'.format(
+                sum(not _is_exists for _is_exists in mask)))
+            return 0
+
+        scheduled = 0
+        for (_fp, _request), _is_exists in zip(pending, mask):
+            self._inc_stats('redis', hit=_is_exists)
+            if _is_exists:
+                self.log(_request, self.crawler.spider)
+                continue
+            self._passed.add(_fp)
+            self.crawler.engine.crawl(_request)
+            scheduled += 1
+        return scheduled
+
+    def _spider_idle(self, spider):
+        """
+        爬虫空闲时, 还有暂存的请求或者正在执行的 flush 时, 继续发送, 不关闭爬虫
+        重新调度的请求会使爬虫不再空闲, 全部发送完且没有重新调度的请求时, 下一次空闲时关闭爬虫
+        """
+        if self._pending or self._flushing is not None:
+            self.flush()
+            raise DontCloseSpider
+
+    def _inc_stats(self, tier, hit, count=1):
+        """
+        记录每一层的命中数量和命中率
+        """
+        if hit:
+            self._hits[tier] += count
+        else:
+            self._misses[tier] += count
+        if not self.stats or not count:
+            return
+        self.stats.inc_value('bloom_dupefilter/{}/{}'.format(tier, 'hit' if hit else 'miss'), count)
+        self.stats.set_value(
+            'bloom_dupefilter/{}/hit_ratio'.format(tier),
+            round(self._hits[tier] / (self._hits[tier] + self._misses[tier]), 4),
+        )
+
+    def get_metrics(self):
+        """
+        获取两层过滤器的监控指标, 设置了 prometheus_file 时同时写入文件
+        在线程池中执行, 计算填充率时的 BITCOUNT 和 bitarray.count() 不会阻塞 reactor
+        :return: {过滤器名称: 监控指标}
+        """
+        key = self.bf_redis.redis_filter_key_base
+        metrics = {
+            '{}:memory'.format(key): self.bf_memory.get_metrics(fill_ratio=self.metrics_fill_ratio),
+            '{}:redis'.format(key): self.bf_redis.get_metrics(fill_ratio=self.metrics_fill_ratio),
+        }
+        if self.prometheus_file:
+            dump_prometheus(self.prometheus_file, metrics)
+        return metrics
+
+    def export_metrics(self):
+        """
+        在正在执行的 flush 结束之后, 在线程池中获取两层过滤器的监控指标, 再在 reactor 线程中保存到 scrapy stats 中
+        已经有导出在执行时直接返回它的 Deferred
+        :return: Deferred, 结果为 {过滤器名称: 监控指标}
+        """
+        if self._exporting is not None:
+            return self._exporting
+        d = self._exporting = self._after_flush()
+        d.addCallback(lambda _: threads.deferToThread(self.get_metrics))
+        d.addCallback(self._save_metrics)
+        d.addBoth(self._export_done)
+        return d
+
+    def _after_flush(self):
+        """
+        返回在正在执行的 flush 结束之后触发的 Deferred, 不改变 flush 的结果
+        """
+        d = defer.Deferred()
+        if self._flushing is None:
+            d.callback(None)
+            return d
+
+        def _fire(result):
+            d.callback(None)
+            return result
+        self._flushing.addBoth(_fire)
+        return d
+
+    def _save_metrics(self, metrics):
+        """
+        在 reactor 线程中把监控指标保存到 scrapy stats 中
+        """
+        if self.stats:
+            for _name, _metrics in metrics.items():
+                metrics_to_stats(self.stats, _metrics, prefix='bloom_dupefilter/{}'.format(_name.rsplit(':', 1)[-1]))
+        return metrics
+
+    def _export_done(self, result):
+        """
+        导出结束后, 继续发送导出期间暂存的请求
+        """
+        self._exporting = None
+        self._flush_if_full()
+        return result
+
+    def _try_export_metrics(self):
+        """
+        定时任务中导出监控指标, redis 暂时不可用时只记录日志, 以免定时任务停止
+        """
+        d = self.export_metrics()
+        d.addErrback(lambda failure: logger.warning(
+            'failed to export bloom dupefilter metrics: {}'.format(failure.value)))
+        return d
+
+    def close(self, reason=''):
+        """
+        关闭时停止定时任务, 此时 engine 已经不能再调度请求,
+        剩余的暂存请求不添加到 redis 中, 以便下次运行时重新生成
+        :return: 开启 metrics 时返回最后一次导出的 Deferred, spider_closed 信号会等待它结束
+        """
+        self._closed = True
+        if self._flush_task is not None and self._flush_task.running:
+            self._flush_task.stop()
+        if self._pending:
+            logger.warning('{} pending requests are dropped without crawling'.format(len(self._pending)))
+            self._pending = []
+        if self._metrics_task is not None and self._metrics_task.running:
+            self._metrics_task.stop()
+        logger.info('bloom dupefilter hits: {}, misses: {}'.format(self._hits, self._misses))
+        if self.is_metrics:
+            return self._try_export_metrics()
+
+    def clear(self):
+        """
+        scheduler 不保留数据 (SCHEDULER_PERSIST = False) 时, 删除 redis 中布隆过滤器的所有 key
+        """
+        self.bf_redis.redis_cli.delete(*self.bf_redis._filter_list, self.bf_redis.redis_meta_key)
+
+    def log(self, request, spider):
+        """
+        记录重复请求, 与 scrapy_redis.dupefilter.RFPDupeFilter.log 相同, 暂存的请求不记录
+        """
+        if request is self._last_pending:
+            self._last_pending = None
+            return
+        if self.debug:
+            msg = "Filtered duplicate request: %(request)s"
+            logger.debug(msg, {'request': request}, extra={'spider': spider})
+        elif self.logdupes:
+            msg = ("Filtered duplicate request %(request)s"
+                   " - no more duplicates will be shown"
+                   " (see DUPEFILTER_DEBUG to show all duplicates)")
+            logger.debug(msg, {'request': request}, extra={'spider': spider})
+            self.logdupes = False
+        if self.stats:
+            self.stats.inc_value('bloom_dupefilter/filtered')
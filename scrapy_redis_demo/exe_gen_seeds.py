@@ -119,6 +119,38 @@ class SeedsGenerator(object):
         self.spider.scheduler.enqueue_request(r)
         self.total_seeds_generated += 1
 
+    def do_gen_seeds_many(self, urls, parse_func='parse', priority=100, handle_all=True):
+        """
+        一次生成大量需要去重的种子
+        使用 dupefilter.BloomDupeFilter 时, 所有请求只需要一次批量判断, 而不是每个请求访问一次 redis
+        """
+        logger.info(f'do gen {self.spider.name} seeds, candidate urls: {len(urls)}')
+
+        if not hasattr(self.spider, parse_func):
+            self.spider.set_parse_func(parse_func)
+
+        requests = [
+            scrapy.Request(
+                url=url,
+                headers=self.headers,
+                callback=getattr(self.spider, parse_func),
+                priority=priority,
+                meta={
+                    "handle_httpstatus_all": handle_all,
+                }
+            ) for url in urls
+        ]
+
+        df = self.spider.scheduler.df
+        if hasattr(df, 'requests_seen_many'):
+            mask = df.requests_seen_many(requests)
+            # 已经去重过的请求, 不需要在 enqueue_request 中再次去重
+            requests = [r.replace(dont_filter=True) for r, is_seen in zip(requests, mask) if not is_seen]
+
+        for r in requests:
+            if self.spider.scheduler.enqueue_request(r):
+                self.total_seeds_generated += 1
+
     def gen_seeds(self):
         logger.info(f"start to gen requests for spider: [{self.spider.name}]")
 
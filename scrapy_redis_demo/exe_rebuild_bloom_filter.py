@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+# 从 mysql 中读取历史 url, 重建使用新配置 (hash_seeds_num, memory_size 等) 的 redis 布隆过滤器
+# 修改线上布隆过滤器的配置时, 已有的 filter key 都会失效, 使用本脚本迁移:
+#   1. 把 mysql 中的历史 url 写入新的 key 中, 如 python exe_rebuild_bloom_filter.py -p demo_dev -t demo -k bf_url_v2 --bf-config '{...}'
+#   2. 修改爬虫使用的 key 和配置, 重启爬虫
+#   3. 使用 --where 再次执行, 补上重建期间新增的 url, 如 --where "crawl >= '2024-01-01 00:00:00'"
+import argparse
+import asyncio
+import json
+import os
+import re
+import sys
+
+import aiomysql
+from scrapy import Request
+
+try:
+    # scrapy >= 2.7
+    from scrapy.utils.request import fingerprint as request_fingerprint
+except ImportError:
+    from scrapy.utils.request import request_fingerprint
+
+from utils import get_logger
+from utils.project import get_project_settings
+
+# bloom_filter 中的模块使用的是平级导入
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bloom_filter'))
+
+from async_redis_bloom_filter import BloomFilterRedisAsync  # noqa: E402
+
+logger = get_logger(re.split(r"[/.\\]", __file__)[-2])
+
+
+class RebuildBloomFilter(object):
+    """
+    使用流式游标 (SSCursor) 从 mysql 中分批读取 url, 不会把整张表读入内存,
+    每一批使用一次 BloomFilterRedisAsync.add_many 写入 redis, 写入当前批次的同时读取下一批
+    """
+
+    def __init__(self, params):
+        """
+        :param params: 从 cmd 中获取的参数
+        """
+        self.params = params
+        settings = get_project_settings(params["config_name"])
+
+        mysql_configs = settings.get('MYSQL_CONFIGS', {})
+        redis_config = settings.get('REDIS_CONFIG')
+
+        if not mysql_configs or not redis_config:
+            raise Exception("no MYSQL_CONFIGS or REDIS_CONFIG in settings")
+
+        mysql_name = params['mysql_name'] or list(mysql_configs.keys())[0]
+        if mysql_name not in mysql_configs:
+            raise Exception(f"no mysql [{mysql_name}] in MYSQL_CONFIGS")
+
+        self.mysql_config = mysql_configs[mysql_name]
+        self.table_name = params['table_name']
+        self.where = params['where']
+        self.batch_size = params['batch_size']
+        self.fingerprint = params['fingerprint']
+
+        key = params['bloom_filter_key']
+        self.bf = BloomFilterRedisAsync(
+            redis_config,
+            dict(bloom_filter_key=key, redis_meta_key='{}_meta'.format(key), redis_count_key='{}_count'.format(key)),
+            params['bf_config'],
+        )
+
+    def _to_data(self, url):
+        """
+        写入布隆过滤器的数据, BloomDupeFilter 中保存的是请求的指纹, 而不是 url
+        """
+        if self.fingerprint:
+            return request_fingerprint(Request(url)).hex()
+        return url
+
+    async def _fetch(self, cur):
+        rows = await cur.fetchmany(self.batch_size)
+        return [self._to_data(_row[0]) for _row in rows if _row[0]]
+
+    async def rebuild(self):
+        """
+        fetchmany 和 add_many 交替进行, 上一批的 add_many 完成之前, 已经开始读取下一批
+        """
+        await self.bf.open()
+        sql = "SELECT `url` FROM `{}`".format(self.table_name)
+        if self.where:
+            sql += " WHERE {}".format(self.where)
+        logger.info(f"rebuild bloom filter [{self.bf.redis_filter_key_base}] from sql: [{sql}]")
+
+        conn = await aiomysql.connect(**self.mysql_config)
+        total = 0
+        try:
+            async with conn.cursor(aiomysql.SSCursor) as cur:
+                await cur.execute(sql)
+                data_list = await self._fetch(cur)
+                while data_list:
+                    add_task = asyncio.ensure_future(self.bf.add_many(data_list))
+                    next_data_list = await self._fetch(cur)
+                    await add_task
+                    total += len(data_list)
+                    logger.info(f"add [{total}] urls, data saved: [{self.bf.data_saved}]")
+                    data_list = next_data_list
+        finally:
+            conn.close()
+            await self.bf.close()
+
+        logger.info(f"rebuild finished, add [{total}] urls, data saved: [{self.bf.data_saved}]")
+
+    async def run(self):
+
+        logger.info("start to rebuild bloom filter")
+        await self.rebuild()
+
+
+def get_parser():
+    """
+    由于要捕捉 cmd 传递的参数, 所以必须要使用 函数,  不能使用类
+    :return:
+    """
+    logger.info("get arg parser from cmd")
+    parser = argparse.ArgumentParser(description="rebuild redis bloom filter from urls in mysql")
+
+    # 要运行哪个项目, 即 scrapy.cfg 中的 project 中的 设置 demo_dev, demo_dev 等
+    parser.add_argument("--project", "-p", type=str, required=True,
+                        help="settings of project")
+
+    parser.add_argument("--table", "-t", type=str, required=True,
+                        help="mysql table with url column, such as demo, news")
+
+    parser.add_argument("--bloom_filter_key", "-k", type=str, required=True,
+                        help="redis key of the new bloom filter")
+
+    # 新的布隆过滤器的配置, json 格式, 与 BloomFilterRedis 的 bf_config 相同
+    parser.add_argument("--bf-config", type=str, required=True,
+                        help="bf_config of the new bloom filter in json")
+
+    parser.add_argument("--where", "-w", type=str, required=False, default=None,
+                        help="where clause of the sql, for replaying urls added during rebuild")
+
+    parser.add_argument("--fingerprint", "-f", action="store_true",
+                        help="save request fingerprint instead of url, for BloomDupeFilter")
+
+    parser.add_argument("--mysql", "-m", type=str, required=False, default=None,
+                        help="name of mysql in MYSQL_CONFIGS, default is the first one")
+
+    parser.add_argument("--batch_size", "-bs", type=int, required=False, default=10000,
+                        help="batch urls read from mysql and add to redis")
+
+    return parser
+
+
+def parse_params(parser: argparse.ArgumentParser):
+    """
+    解析 argparse 中传递过来的参数
+    """
+    logger.info("parse params from arg parser")
+
+    args = parser.parse_args()
+
+    params = dict(
+        config_name=args.project,
+        table_name=args.table,
+        bloom_filter_key=args.bloom_filter_key,
+        bf_config=json.loads(args.bf_config),
+        where=args.where,
+        fingerprint=args.fingerprint,
+        mysql_name=args.mysql,
+        batch_size=args.batch_size,
+    )
+
+    return params
+
+
+async def main():
+
+    params = parse_params(get_parser())
+
+    rbf = RebuildBloomFilter(params=params)
+    await rbf.run()
+
+
+if __name__ == '__main__':
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main())
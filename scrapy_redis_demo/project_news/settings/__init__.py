@@ -117,7 +117,32 @@ LOG_SHORT_NAMES = False
 SCHEDULER = "scrapy_redis.scheduler.Scheduler"
 
 # Ensure all spiders share same duplicates filter through redis.
-DUPEFILTER_CLASS = "scrapy_redis.dupefilter.RFPDupeFilter"
+# DUPEFILTER_CLASS = "scrapy_redis.dupefilter.RFPDupeFilter"
+# 使用 内存型 和 redis 型两层布隆过滤器去重, redis 中只占用固定大小的 bitmap, 而不是保存所有请求指纹的 set
+DUPEFILTER_CLASS = "dupefilter.BloomDupeFilter"
+
+# 布隆过滤器在 redis 中的 key
+BLOOM_DUPEFILTER_KEY = 'dupefilter:%(spider)s'
+
+# 每个节点的内存型布隆过滤器, 对 1000W 个请求进行去重
+BLOOM_DUPEFILTER_MEMORY_CONFIG = dict(
+    data_size_per_filter=10 ** 7,
+    memory_size=100,
+    hash_seeds_num=5,
+    error_rate_threshold=1e-6,
+)
+
+# 所有节点共用的 redis 型布隆过滤器, 对 1.4 亿个请求进行去重, 使用 500M 内存, 误判率 十万分之一
+BLOOM_DUPEFILTER_REDIS_CONFIG = dict(
+    data_size_per_key=14 * 10 ** 7,
+    memory_size=500,
+    hash_seeds_num=8,
+    error_rate_threshold=1e-5,
+)
+
+# 内存中不存在的请求, 每隔 1 秒或达到 1000 个时, 批量发送到 redis 中去重, 设置为 1 时每个请求都同步访问 redis
+BLOOM_DUPEFILTER_BATCH_SIZE = 1000
+BLOOM_DUPEFILTER_FLUSH_INTERVAL = 1
 
 # Default requests serializer is pickle, but it can be changed to any module
 # with loads and dumps functions. Note that pickle is not compatible between